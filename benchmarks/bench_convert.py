@@ -0,0 +1,56 @@
+"""
+Measure the stages of a spec upload's conversion: building the Spec, converting the operations (in the request
+process), and encoding the results with an increasing number of encoding processes.
+
+    python -m benchmarks.bench_convert [n_paths]
+"""
+import os
+import sys
+import time
+
+from openapi_core import create_spec
+
+from benchmarks.synthetic import openapi_spec
+from server_impl.projects_fs.fs_internals import dump_yaml
+from server_impl.spec_utils.converter import convert_operation, encode_parallel, plan_operations
+
+
+def worker_counts():
+    n = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= n:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != n:
+        counts.append(n)
+    return counts
+
+
+def main(n_paths: int):
+    content = openapi_spec(n_paths)
+    start = time.perf_counter()
+    api = create_spec(content)
+    print('create_spec: %.3f s' % (time.perf_counter() - start))
+
+    start = time.perf_counter()
+    flat = []
+    for path, method, mod_id in plan_operations(api):
+        module, graph = convert_operation(api, path, method, mod_id)
+        flat.append((mod_id, module.flatten(), graph.flatten()))
+    print('convert %d operations: %.3f s' % (len(flat), time.perf_counter() - start))
+
+    # The first call for a worker count starts the pool, later ones reuse it
+    print('%8s %10s %10s %8s' % ('workers', 'first (s)', 'time (s)', 'speedup'))
+    baseline = None
+    for workers in worker_counts():
+        start = time.perf_counter()
+        encode_parallel(flat, dump_yaml, workers)
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        encode_parallel(flat, dump_yaml, workers)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print('%8d %10.3f %10.3f %7.1fx' % (workers, first, elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,117 @@
+"""
+Measure graph_analysis on large graphs: building the indexes, the analyses, and keeping them up to date through edits
+compared to rebuilding them. The scan column is one successor lookup without indexes (a pass over the edges and ports),
+which every step of a traversal would need otherwise.
+
+    python -m benchmarks.bench_graph_analysis [n_nodes ...]
+"""
+import sys
+import time
+import timeit
+from typing import Callable
+
+from benchmarks.synthetic import graph_dict
+from server_impl.projects_fs.graph_analysis import GraphAnalysis
+from server_impl.projects_fs.graph_log import apply_ops
+from server_impl.projects_fs.packed_graph import PackedGraph
+
+
+def _time(fn: Callable[[], object], repeat: int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def _time_on_copy(analysis: GraphAnalysis, fn: Callable[[GraphAnalysis], object], repeat: int) -> float:
+    """
+    Time ``fn`` on a fresh copy of ``analysis``, so cached results are not reused. The copy is not timed.
+    """
+    times = []
+    for _ in range(repeat):
+        a = analysis.copy()
+        start = time.perf_counter()
+        fn(a)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _scan_successors(graph: dict, node_id: str) -> set:
+    ports = graph['ports']
+    return {ports[e['dst']]['node_id'] for e in graph['edges'].values() if ports[e['src']]['node_id'] == node_id}
+
+
+def _edit(n_nodes: int, i: int) -> list:
+    """
+    A typical editor PATCH: a new node with two ports, wired in between two existing nodes.
+    """
+    node_id, p_in, p_out = 'x%d' % i, 'xi%d' % i, 'xo%d' % i
+    a, b = 'n%d' % (i % (n_nodes - 1)), 'n%d' % (i % (n_nodes - 1) + 1)
+    return [
+        {'op': 'put', 'section': 'ports', 'id': p_in, 'value': {'port_id': p_in, 'direction': 'IN',
+                                                                  'node_id': node_id}},
+        {'op': 'put', 'section': 'ports', 'id': p_out, 'value': {'port_id': p_out, 'direction': 'OUT',
+                                                                   'node_id': node_id}},
+        {'op': 'put', 'section': 'nodes', 'id': node_id, 'value': {'abstract_node_id': node_id,
+                                                                   'ports': [p_in, p_out]}},
+        {'op': 'put', 'section': 'edges', 'id': 'xe%d' % i, 'value': {'src': 'p%d' % (int(a[1:]) * 3 + 1),
+                                                                      'dst': p_in}},
+        {'op': 'put', 'section': 'edges', 'id': 'xf%d' % i, 'value': {'src': p_out,
+                                                                      'dst': 'p%d' % (int(b[1:]) * 3)}},
+    ]
+
+
+def bench(n_nodes: int, repeat: int = 5, edits: int = 100) -> dict:
+    graph = graph_dict(n_nodes)
+    packed = PackedGraph.pack(graph)
+    analysis = GraphAnalysis(graph)
+    ordered = analysis.copy()
+    ordered.topological_order()
+    batches = [_edit(n_nodes, i) for i in range(edits)]
+
+    def incremental(a: GraphAnalysis):
+        for ops in batches:
+            a.apply(ops)
+            a.topological_order()
+            a.dead_nodes()
+
+    edited = graph
+    for ops in batches:
+        edited = apply_ops(edited, ops)
+
+    def packed_chain():
+        p = packed
+        p.analysis()
+        for ops in batches:
+            p = p.apply(ops)
+        p.analysis().topological_order()
+
+    return {
+        'nodes': n_nodes,
+        'build_s': _time(lambda: GraphAnalysis(graph), repeat),
+        'build_packed_s': _time(lambda: GraphAnalysis(packed), repeat),
+        'topo_s': _time_on_copy(analysis, GraphAnalysis.topological_order, repeat),
+        'cycles_s': _time_on_copy(analysis, GraphAnalysis.cycles, repeat),
+        'dead_s': _time_on_copy(analysis, GraphAnalysis.dead_nodes, repeat),
+        'reach_s': _time_on_copy(analysis, GraphAnalysis.response_reachable, repeat),
+        'scan_s': _time(lambda: _scan_successors(graph, 'n%d' % (n_nodes // 2)), repeat),
+        'copy_s': _time(analysis.copy, repeat),
+        'edit_s': _time_on_copy(ordered, incremental, repeat) / edits,
+        'rebuild_s': _time(lambda: GraphAnalysis(edited).topological_order(), repeat),
+        'packed_chain_s': _time(packed_chain, repeat),
+    }
+
+
+def main(sizes):
+    print('Times in ms. edit: one PATCH (a node, two ports, two edges) applied incrementally, with the topological '
+          'order and dead nodes after it.')
+    print('%8s %8s %9s %7s %7s %7s %7s %7s %7s %8s %9s %9s' % (
+        'nodes', 'build', 'b.packed', 'topo', 'cycles', 'dead', 'reach', 'scan', 'copy', 'edit', 'rebuild',
+        'p.chain'))
+    for n in sizes:
+        r = bench(n)
+        print('%8d %8.1f %9.1f %7.1f %7.1f %7.1f %7.1f %7.2f %7.1f %8.3f %9.1f %9.1f' % (
+            r['nodes'], r['build_s'] * 1e3, r['build_packed_s'] * 1e3, r['topo_s'] * 1e3, r['cycles_s'] * 1e3,
+            r['dead_s'] * 1e3, r['reach_s'] * 1e3, r['scan_s'] * 1e3, r['copy_s'] * 1e3, r['edit_s'] * 1e3,
+            r['rebuild_s'] * 1e3, r['packed_chain_s'] * 1e3))
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [10000, 50000, 100000])
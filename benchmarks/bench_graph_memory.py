@@ -0,0 +1,71 @@
+"""
+Compare the memory use and conversion times of the cached graph formats: the flattened dict, the inflated
+openapi_server models, and the PackedGraph that the graph cache keeps.
+
+    python -m benchmarks.bench_graph_memory [n_nodes ...]
+"""
+import gc
+import marshal
+import sys
+import timeit
+import tracemalloc
+from typing import Callable
+
+from benchmarks.synthetic import graph_dict
+from openapi_server.models import FlowGraph
+from server_impl.projects_fs.graph_views import select_graph
+from server_impl.projects_fs.packed_graph import PackedGraph
+
+
+def _retained(build: Callable[[bytes], object], payload: bytes) -> int:
+    """
+    The memory held by the result of ``build``. The graph is loaded from ``payload`` inside of the measurement, so
+    strings that the result shares with it are counted too.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build(payload)
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def _time(fn: Callable[[], object], repeat: int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def bench(n_nodes: int, repeat: int = 5) -> dict:
+    graph = graph_dict(n_nodes)
+    payload = marshal.dumps(graph)
+    packed = PackedGraph.pack(graph)
+    node_ids = ['n%d' % i for i in range(0, n_nodes, max(1, n_nodes // 20))]
+    return {
+        'nodes': n_nodes,
+        'dict_bytes': _retained(marshal.loads, payload),
+        'model_bytes': _retained(lambda p: FlowGraph.inflate(marshal.loads(p)), payload),
+        'packed_bytes': _retained(lambda p: PackedGraph.pack(marshal.loads(p)), payload),
+        'pack_s': _time(lambda: PackedGraph.pack(graph), repeat),
+        'inflate_s': _time(lambda: FlowGraph.inflate(marshal.loads(payload)), repeat),
+        'packed_inflate_s': _time(lambda: FlowGraph.inflate(packed.to_dict()), repeat),
+        'select_s': _time(lambda: select_graph(graph, None, node_ids), repeat),
+        'packed_select_s': _time(lambda: packed.select(None, node_ids), repeat),
+    }
+
+
+def main(sizes):
+    print('%8s %12s %12s %12s %9s %11s %11s %10s %11s' % (
+        'nodes', 'dict bytes', 'model bytes', 'packed bytes', 'pack (s)', 'inflate (s)', 'p.infl (s)', 'select (s)',
+        'p.sel (s)'))
+    for n in sizes:
+        r = bench(n)
+        print('%8d %12d %12d %12d %9.4f %11.4f %11.4f %10.5f %11.5f' % (
+            r['nodes'], r['dict_bytes'], r['model_bytes'], r['packed_bytes'], r['pack_s'], r['inflate_s'],
+            r['packed_inflate_s'], r['select_s'], r['packed_select_s']))
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [1000, 10000, 50000])
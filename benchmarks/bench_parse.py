@@ -0,0 +1,65 @@
+"""
+Compare parsing uploaded specifications with the pure-Python YAML loader (the previous upload path) against
+spec_utils.parse.parse_spec, for JSON and YAML files of about the given sizes in MB.
+
+    python -m benchmarks.bench_parse [size_mb ...]
+"""
+import io
+import json
+import sys
+import timeit
+from typing import Tuple
+
+import yaml
+
+from benchmarks.synthetic import openapi_spec
+from server_impl.spec_utils import parse
+from server_impl.spec_utils.hashing import canonical_hash
+
+
+def _spec_file(fmt: str, size: int) -> Tuple[dict, bytes]:
+    """
+    A synthetic specification, and its encoding in ``fmt`` of about ``size`` bytes.
+    """
+    def encode(n_paths: int) -> Tuple[dict, bytes]:
+        content = openapi_spec(n_paths)
+        if fmt == 'json':
+            return content, json.dumps(content).encode()
+        return content, yaml.dump(content, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper)).encode()
+    sample = 100
+    n_paths = max(1, int(sample * size / len(encode(sample)[1])))
+    return encode(n_paths)
+
+
+def _time(fn, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def bench(fmt: str, size_mb: int, repeat: int) -> dict:
+    content, data = _spec_file(fmt, size_mb << 20)
+    assert parse.parse_spec(io.BytesIO(data), 'spec.' + fmt)[0] == content
+    return {
+        'format': fmt,
+        'bytes': len(data),
+        'safe_load_s': _time(lambda: yaml.safe_load(io.BytesIO(data)), repeat),
+        'parse_spec_s': _time(lambda: parse.parse_spec(io.BytesIO(data), 'spec.' + fmt), repeat),
+        'canonical_hash_s': _time(lambda: canonical_hash(content), repeat),
+    }
+
+
+def main(sizes):
+    print('libyaml: %s' % (parse.YamlLoader is not yaml.SafeLoader))
+    print('%6s %12s %13s %14s %10s %18s' % ('format', 'bytes', 'safe_load (s)', 'parse_spec (s)', 'speedup',
+                                             'canonical hash (s)'))
+    for size_mb in sizes:
+        # The pure-Python loader takes minutes on the largest files
+        repeat = 3 if size_mb <= 1 else 1
+        for fmt in ('json', 'yaml'):
+            r = bench(fmt, size_mb, repeat)
+            print('%6s %12d %13.3f %14.3f %9.1fx %18.3f' % (r['format'], r['bytes'], r['safe_load_s'],
+                                                            r['parse_spec_s'], r['safe_load_s'] / r['parse_spec_s'],
+                                                            r['canonical_hash_s']))
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [1, 10, 50])
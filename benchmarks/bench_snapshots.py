@@ -0,0 +1,46 @@
+"""
+Compare loading a graph file with the YAML parser against loading its binary snapshot.
+
+    python -m benchmarks.bench_snapshots [n_nodes ...]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+import yaml
+
+from benchmarks.synthetic import graph_dict
+from server_impl.projects_fs.fs_internals import read_yaml
+from server_impl.projects_fs.snapshots import read_snapshot, write_snapshot, snapshot_name
+
+
+def bench(n_nodes: int, repeat: int = 5):
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench-graph.yaml')
+        with open(filename, 'w') as f:
+            yaml.safe_dump(graph_dict(n_nodes), f)
+        write_snapshot(filename, read_yaml(filename))
+
+        t_yaml = min(timeit.repeat(lambda: read_yaml(filename), number=1, repeat=repeat))
+        t_snap = min(timeit.repeat(lambda: read_snapshot(filename), number=1, repeat=repeat))
+        assert read_snapshot(filename) == read_yaml(filename)
+        return {
+            'nodes': n_nodes,
+            'yaml_bytes': os.path.getsize(filename),
+            'snapshot_bytes': os.path.getsize(snapshot_name(filename)),
+            'yaml_s': t_yaml,
+            'snapshot_s': t_snap,
+        }
+
+
+def main(sizes):
+    print('%8s %12s %12s %10s %12s %8s' % ('nodes', 'yaml bytes', 'snap bytes', 'yaml (s)', 'snapshot (s)', 'speedup'))
+    for n in sizes:
+        r = bench(n)
+        print('%8d %12d %12d %10.4f %12.5f %7.0fx' % (r['nodes'], r['yaml_bytes'], r['snapshot_bytes'], r['yaml_s'],
+                                                     r['snapshot_s'], r['yaml_s'] / r['snapshot_s']))
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [100, 1000, 10000])
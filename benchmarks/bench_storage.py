@@ -0,0 +1,121 @@
+"""
+Compare the file system and SQLite storage backends.
+
+    python -m benchmarks.bench_storage [--projects N] [--modules N] [--nodes N] [--repeat N]
+
+Both backends are filled with the same synthetic projects (by default 10 projects of 1000 modules each). Every read
+is timed cold (fresh in-memory caches and connections) and warm.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import traceback
+from typing import Callable, List
+
+
+def _timed(fn: Callable[[], object], repeat: int, setup: Callable[[], None] = None) -> float:
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def populate(storage, n_projects: int, n_modules: int, n_nodes: int) -> float:
+    from openapi_server.models import ProjectDetails
+    from benchmarks.synthetic import graph_dict
+    from server_impl.projects_fs.file_names import FileNames
+
+    graph = graph_dict(n_nodes)
+    start = time.perf_counter()
+    for p in range(n_projects):
+        tag = 'bench%d' % p
+        os.makedirs(FileNames.project_dir(tag), exist_ok=True)
+        storage.save_project(ProjectDetails(tag=tag, name='Benchmark %d' % p, last_modified=datetime.datetime.now(),
+                                            description='Synthetic project', api_version='1.0'))
+        modules = {}
+        for m in range(n_modules):
+            mod_id = 'm%d' % m
+            module = {'tag': mod_id, 'url': '/resource%d/{id}' % m, 'method': random.choice(['GET', 'POST']),
+                      'operation_id': 'operation%d' % m, 'status': 'OK'}
+            modules[mod_id] = (storage.encode(module), storage.encode(graph))
+        storage.save_modules(tag, modules)
+    return time.perf_counter() - start
+
+
+def bench(backend: str, args) -> dict:
+    from server_impl.projects_fs.fs_internals import CacheRegistry
+    from server_impl.projects_fs.listing import ListQuery
+    from server_impl.projects_fs.storage import make_storage
+
+    storage = make_storage(backend)
+    results = {'populate': populate(storage, args.projects, args.modules, args.nodes)}
+
+    def cold():
+        CacheRegistry.clear()
+        if hasattr(storage, 'close'):
+            storage.close()
+
+    tag = 'bench%d' % (args.projects // 2)
+    mods = ['m%d' % random.randrange(args.modules) for _ in range(args.graphs)]
+    cases = [
+        ('list_projects', storage.list_projects),
+        ('project_details', lambda: storage.project_details(tag)),
+        ('list_modules', lambda: storage.list_modules(tag)),
+        ('list_modules_page', lambda: storage.list_modules_page(tag, ListQuery('url', limit=50))),
+        ('load_graph x%d' % args.graphs, lambda: [storage.load_graph(tag, mod) for mod in mods]),
+    ]
+    for name, fn in cases:
+        results[name + ' cold'] = _timed(fn, args.repeat, cold)
+        fn()
+        results[name + ' warm'] = _timed(fn, args.repeat)
+    return results
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--projects', type=int, default=10)
+    parser.add_argument('--modules', type=int, default=1000, help='Modules per project')
+    parser.add_argument('--nodes', type=int, default=20, help='Nodes per graph')
+    parser.add_argument('--graphs', type=int, default=100, help='Graphs loaded per run')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for backend in ('fs', 'sqlite'):
+        with tempfile.TemporaryDirectory(prefix='dp-bench-storage-') as tmp:
+            # file_names reads PROJECT_DIR at import time, so each backend runs in its own process
+            pid = os.fork()
+            if pid == 0:
+                os.environ['PROJECT_DIR'] = tmp
+                status = 1
+                try:
+                    with open(os.path.join(tmp, 'result.json'), 'w') as f:
+                        json.dump(bench(backend, args), f)
+                    status = 0
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    os._exit(status)
+            os.waitpid(pid, 0)
+            with open(os.path.join(tmp, 'result.json'), 'r') as f:
+                results[backend] = json.load(f)
+
+    print('%d projects x %d modules, %d nodes per graph' % (args.projects, args.modules, args.nodes))
+    print('%-26s %12s %12s %8s' % ('case', 'fs (s)', 'sqlite (s)', 'ratio'))
+    for name in results['fs']:
+        fs_t, sql_t = results['fs'][name], results['sqlite'][name]
+        print('%-26s %12.5f %12.5f %7.2fx' % (name, fs_t, sql_t, fs_t / sql_t if sql_t else float('inf')))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
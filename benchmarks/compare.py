@@ -0,0 +1,46 @@
+"""
+Compare two result files from benchmarks.run.
+
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 0.10]
+
+Exits with status 1 if any case got slower (by median) by more than the threshold.
+"""
+import argparse
+import json
+import sys
+from typing import List
+
+
+def _load(filename: str) -> dict:
+    with open(filename, 'r') as f:
+        report = json.load(f)
+    return {(r['name'], r['mode']): r for r in report['results']}
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Allowed slowdown, as a fraction')
+    args = parser.parse_args(argv)
+
+    base = _load(args.baseline)
+    cand = _load(args.candidate)
+    regressions = 0
+    print('%-20s %-5s %12s %12s %8s' % ('case', 'mode', 'base (s)', 'new (s)', 'ratio'))
+    for key in sorted(set(base) & set(cand)):
+        b = base[key]['median_s']
+        c = cand[key]['median_s']
+        ratio = c / b if b else float('inf')
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('%-20s %-5s %12.6f %12.6f %7.2fx%s' % (key[0], key[1], b, c, ratio, flag))
+    for key in sorted(set(base) ^ set(cand)):
+        print('%-20s %-5s only in %s' % (key[0], key[1], 'baseline' if key in base else 'candidate'))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,180 @@
+"""
+Benchmark the main read and upload paths against a synthetic PROJECT_DIR.
+
+    python -m benchmarks.run [--projects N] [--modules N] [--nodes N] [--spec-paths N] [--repeat N] [--output FILE]
+
+A temporary project directory is generated (unless --project-dir is given), then every case is timed with cold
+caches (CacheRegistry.clear() before each run) and with warm caches. The results are written as JSON, and two result
+files can be compared with benchmarks.compare.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, List, Optional
+
+import yaml
+
+from benchmarks.synthetic import openapi_spec, grow_graph
+
+
+def _timed(fn: Callable[[], object], repeat: int, setup: Optional[Callable[[], None]] = None) -> List[float]:
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _summary(name: str, mode: str, times: List[float], **extra) -> dict:
+    ret = {
+        'name': name,
+        'mode': mode,
+        'runs': len(times),
+        'min_s': min(times),
+        'median_s': statistics.median(times),
+        'mean_s': statistics.mean(times),
+    }
+    ret.update(extra)
+    return ret
+
+
+def _spec_file(content: dict, filename: str = 'spec.yaml'):
+    from werkzeug.datastructures import FileStorage
+    return FileStorage(stream=io.BytesIO(yaml.safe_dump(content).encode()), filename=filename)
+
+
+def populate(n_projects: int, n_modules: int, n_nodes: int):
+    """
+    Fill PROJECT_DIR with projects created through the normal upload path, then grow their graphs to ``n_nodes``.
+    """
+    from openapi_server.models import NewProject
+    from server_impl.projects_fs import fs, ProjectWrapper
+    from server_impl.projects_fs.fs_internals import Patterns, read_yaml, save_yaml
+
+    content = openapi_spec(n_modules, methods=('get',))
+    for p in range(n_projects):
+        tag = 'bench%d' % p
+        fs.make_project(NewProject(tag=tag, name='Benchmark %d' % p, description='Synthetic project'))
+        wrapper = ProjectWrapper(tag)
+        wrapper.set_api(_spec_file(content))
+        wrapper.finish()
+        if n_nodes:
+            for module in fs.list_modules(tag):
+                filename = Patterns.project_graph_file(tag, module.tag)
+                save_yaml(filename, grow_graph(read_yaml(filename), n_nodes))
+
+
+def run(args) -> dict:
+    from openapi_core import create_spec
+    from server_impl.controllers_impl.ProjectsAPIController_impl import upload_api_file
+    from server_impl.projects_fs import fs
+    from server_impl.projects_fs.fs_internals import CacheRegistry
+    from server_impl.spec_utils import valid_or_raise
+    from server_impl.spec_utils.validate import clear_caches
+    from server_impl.spec_utils.converter import convert, plan_operations
+
+    if not args.project_dir:
+        populate(args.projects, args.modules, args.nodes)
+
+    results = []
+    cold = CacheRegistry.clear
+    projects = fs.list_projects()
+    tag = projects[0].tag
+    mod = fs.list_modules(tag)[0].tag
+
+    cases = [
+        ('list_projects', fs.list_projects),
+        ('list_modules', lambda: fs.list_modules(tag)),
+        ('load_graph', lambda: fs.load_graph(tag, mod)),
+    ]
+    for name, fn in cases:
+        results.append(_summary(name, 'cold', _timed(fn, args.repeat, cold)))
+        fn()
+        results.append(_summary(name, 'warm', _timed(fn, args.repeat)))
+
+    spec = openapi_spec(args.spec_paths)
+    api = create_spec(spec)
+    # The operations that become modules (the converter takes one method per path)
+    n_ops = len(plan_operations(api))
+    results.append(_summary('valid_or_raise', 'cold', _timed(lambda: valid_or_raise(spec), args.repeat, clear_caches),
+                            operations=n_ops))
+    results.append(_summary('valid_or_raise', 'warm', _timed(lambda: valid_or_raise(spec), args.repeat),
+                            operations=n_ops))
+    results.append(_summary('create_spec', 'cold', _timed(lambda: create_spec(spec), args.repeat), operations=n_ops))
+    results.append(_summary('convert', 'cold', _timed(lambda: convert(api), args.repeat), operations=n_ops))
+
+    # A fresh project for every cold upload, and re-uploads of an identical spec for warm ones
+    from openapi_server.models import NewProject
+    counter = [0]
+
+    def new_project():
+        counter[0] += 1
+        upload_tag = 'upload%d' % counter[0]
+        fs.make_project(NewProject(tag=upload_tag, name='Upload', description=''))
+        return upload_tag
+
+    upload_tags = []
+    results.append(_summary('upload_api_file', 'cold', _timed(
+        lambda: upload_api_file(upload_tags[-1], _spec_file(spec)), args.repeat,
+        lambda: (cold(), clear_caches(), upload_tags.append(new_project()))), operations=n_ops))
+    results.append(_summary('upload_api_file', 'warm', _timed(
+        lambda: upload_api_file(upload_tags[-1], _spec_file(spec)), args.repeat), operations=n_ops))
+
+    return {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': {k: v for k, v in vars(args).items() if k != 'output'},
+        },
+        'results': results,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--projects', type=int, default=50, help='Number of synthetic projects')
+    parser.add_argument('--modules', type=int, default=20, help='Modules per project')
+    parser.add_argument('--nodes', type=int, default=200, help='Nodes per graph')
+    parser.add_argument('--spec-paths', type=int, default=500, help='Paths in the synthetic spec (2 operations each)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per case')
+    parser.add_argument('--project-dir', help='Use an existing PROJECT_DIR instead of generating one')
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='dp-bench-') as tmp:
+        # Must be set before server_impl is imported, file_names reads it at import time
+        os.environ['PROJECT_DIR'] = args.project_dir or tmp
+        report = run(args)
+
+    encoded = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(encoded)
+    else:
+        print(encoded)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
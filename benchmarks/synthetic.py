@@ -0,0 +1,154 @@
+"""
+Generators for synthetic data that has the same shape as the files stored in PROJECT_DIR.
+"""
+
+
+def graph_dict(n_nodes: int, ports_per_node: int = 3) -> dict:
+    """
+    Build a flattened FlowGraph with ``n_nodes`` nodes, chained together by one edge per node.
+    :param n_nodes: The number of nodes in the graph (including the request and response nodes).
+    :type n_nodes: int
+    :param ports_per_node: The number of ports attached to each node.
+    :type ports_per_node: int
+    :rtype: dict
+    """
+    ports = {}
+    nodes = {}
+    edges = {}
+    layouts = {}
+    for n in range(n_nodes):
+        node_id = 'n%d' % n
+        port_ids = []
+        for p in range(ports_per_node):
+            port_id = 'p%d' % (n * ports_per_node + p)
+            ports[port_id] = {
+                'port_id': port_id,
+                'type': 'TEXT' if p % 2 else 'NUM',
+                'is_array': p == 2,
+                'direction': 'IN' if p == 0 else 'OUT',
+                'node_id': node_id,
+            }
+            port_ids.append(port_id)
+        layout_id = 'l%d' % n
+        layouts[layout_id] = {'layout_id': layout_id, 'x': (n % 40) * 120, 'y': (n // 40) * 80}
+        nodes[node_id] = {
+            'abstract_node_id': node_id,
+            'node_type': 'ConstantNode',
+            'layout_id': layout_id,
+            'ports': port_ids,
+            'value': 'constant value %d' % n,
+        }
+        if n > 0:
+            edge_id = 'e%d' % n
+            edges[edge_id] = {
+                'edge_id': edge_id,
+                'src': 'p%d' % ((n - 1) * ports_per_node + 1),
+                'dst': 'p%d' % (n * ports_per_node),
+            }
+    return {
+        'request_id': 'n0',
+        'response_id': 'n%d' % (n_nodes - 1),
+        'ports': ports,
+        'nodes': nodes,
+        'edges': edges,
+        'plugs': {},
+        'layouts': layouts,
+        'validators': {},
+        'schemas': {},
+    }
+
+
+def openapi_spec(n_paths: int, methods=('get', 'post'), n_schemas: int = 10) -> dict:
+    """
+    Build an OpenAPI 3 document with ``n_paths`` paths, one operation per method on each, all referring to a shared
+    set of component schemas.
+    :param n_paths: The number of paths.
+    :type n_paths: int
+    :param methods: The operations on each path.
+    :param n_schemas: The number of shared component schemas.
+    :type n_schemas: int
+    :rtype: dict
+    """
+    schemas = {}
+    for s in range(n_schemas):
+        schemas['Schema%d' % s] = {
+            'type': 'object',
+            'required': ['id'],
+            'properties': {
+                'id': {'type': 'string'},
+                'count': {'type': 'integer', 'format': 'int32'},
+                'tags': {'type': 'array', 'items': {'type': 'string'}},
+                'next': {'$ref': '#/components/schemas/Schema%d' % ((s + 1) % n_schemas)},
+            },
+        }
+    paths = {}
+    for p in range(n_paths):
+        schema_ref = {'$ref': '#/components/schemas/Schema%d' % (p % n_schemas)}
+        path_item = {}
+        for method in methods:
+            op = {
+                'operationId': '%s%d' % (method, p),
+                'summary': 'Operation %s %d' % (method, p),
+                'parameters': [
+                    {'name': 'item_id', 'in': 'path', 'required': True, 'schema': {'type': 'string'}},
+                    {'name': 'limit', 'in': 'query', 'schema': {'type': 'integer'}},
+                ],
+                'responses': {
+                    '200': {'description': 'OK', 'content': {'application/json': {'schema': schema_ref}}},
+                    '404': {'description': 'Not Found'},
+                },
+            }
+            if method in ('post', 'put', 'patch'):
+                op['requestBody'] = {'content': {'application/json': {'schema': schema_ref}}}
+            path_item[method] = op
+        paths['/resource%d/{item_id}' % p] = path_item
+    return {
+        'openapi': '3.0.2',
+        'info': {'title': 'Synthetic API', 'version': '1.0.0'},
+        'paths': paths,
+        'components': {'schemas': schemas},
+    }
+
+
+def grow_graph(graph: dict, n_nodes: int) -> dict:
+    """
+    Enlarge a flattened FlowGraph (e.g. one produced by the converter) to about ``n_nodes`` nodes, by cloning its
+    nodes and ports under new ids. The clones keep the shape of the originals, so the result still inflates.
+    :param graph: A flattened FlowGraph
+    :type graph: dict
+    :param n_nodes: The number of nodes wanted.
+    :type n_nodes: int
+    :rtype: dict
+    """
+    nodes = graph.get('nodes') or {}
+    ports = graph.get('ports') or {}
+    if not nodes:
+        return graph
+    fixed = {graph.get('request_id'), graph.get('response_id')}
+    templates = [k for k in nodes if k not in fixed] or list(nodes)
+
+    def rewrite(value, mapping: dict):
+        if isinstance(value, dict):
+            return {k: rewrite(v, mapping) for k, v in value.items()}
+        if isinstance(value, list):
+            return [rewrite(v, mapping) for v in value]
+        if isinstance(value, str):
+            return mapping.get(value, value)
+        return value
+
+    copy = 0
+    while len(nodes) < n_nodes:
+        copy += 1
+        mapping = {}
+        for node_id in templates:
+            mapping[node_id] = '%sc%d' % (node_id, copy)
+        for port_id, port in ports.items():
+            if port.get('node_id') in templates:
+                mapping[port_id] = '%sc%d' % (port_id, copy)
+        for node_id in templates:
+            nodes[mapping[node_id]] = rewrite(nodes[node_id], mapping)
+        for port_id in [p for p in ports if p in mapping]:
+            ports[mapping[port_id]] = rewrite(ports[port_id], mapping)
+    graph['nodes'] = nodes
+    graph['ports'] = ports
+    return graph
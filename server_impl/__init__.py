@@ -1,2 +1,2 @@
 from .initialize import init_hook
-from .tags import is_valid_tag, TagBuilder
+from .tags import is_valid_tag, suggest_tags, TagBuilder
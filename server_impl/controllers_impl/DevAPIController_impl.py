@@ -1,4 +1,11 @@
 # import connexion.app
+import logging
+
+from flask import Response
+
+from server_impl import metrics
+
+log = logging.getLogger(__name__)
 
 
 def dev_repl_post(body):
@@ -7,11 +14,18 @@ def dev_repl_post(body):
     if type(body) == bytes:
         body = body.decode()
 
-    print('REPL: ' + body)
+    log.info('REPL: %s', body)
     try:
         result = str(eval(body))
     except Exception as e:
-        print(e)
+        log.info('REPL failed: %s', e)
         return str(e), 400
-    print(result)
-    return result
\ No newline at end of file
+    log.info('REPL result: %s', result)
+    return result
+
+
+def dev_metrics_get():
+    """
+    Request latencies, cache statistics and I/O counters in the Prometheus text format.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
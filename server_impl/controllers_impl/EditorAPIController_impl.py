@@ -2,14 +2,37 @@ from openapi_server.models import FlowGraph
 from server_impl.errors import EBadRequest
 from server_impl.errors.custom_errors import ENotFound
 from server_impl.projects_fs import ProjectWrapper
+from server_impl import projects_fs as fs
+import connexion
+
+from server_impl.controllers_impl.api_utils import cached_json, conditional, query_validator, validator_headers
+from server_impl.projects_fs.graph_views import parse_list
 
 
 def get_graph(proj_id, mod_id) -> FlowGraph:
-    wrapper = ProjectWrapper(proj_id)
-    if wrapper is None:
-        raise ENotFound("No project exists with tag '%s'" % proj_id)
+    # ?fields=layouts,nodes selects sections, ?nodes=n1,n2 only sends those nodes and what belongs to them
+    args = connexion.request.args
+    fields = parse_list(args.get('fields'))
+    node_ids = parse_list(args.get('nodes'))
+    if fields is not None or node_ids is not None:
+        return conditional(query_validator(fs.graph_validator(proj_id, mod_id)),
+                           lambda: fs.load_graph_view(proj_id, mod_id, fields, node_ids))
+
+    def produce():
+        wrapper = ProjectWrapper(proj_id)
+        if wrapper is None:
+            raise ENotFound("No project exists with tag '%s'" % proj_id)
+        return wrapper.get_graph(mod_id)
+
+    return cached_json(('graph', proj_id, mod_id), fs.graph_validator(proj_id, mod_id), produce)
+
 
-    return wrapper.get_graph(mod_id)
+def patch_graph(proj_id, mod_id):
+    """
+    Apply a list of graph operations (see projects_fs.graph_log). The reply is a 204 with the graph's new ETag.
+    """
+    validator = fs.patch_graph(proj_id, mod_id, connexion.request.get_json(silent=True))
+    return '', 204, validator_headers(validator)
 
     # graph_wrapper = wrapper.wrap_graph(mod_id)
     # return graph_wrapper.graph
@@ -4,10 +4,15 @@ from werkzeug.datastructures import FileStorage
 from openapi_server.models import TagStatus, NewProject, ProjectDetails, Module
 from server_impl.projects_fs import ProjectWrapper, list_modules
 from server_impl import projects_fs as fs
+from server_impl.controllers_impl.api_utils import cached_json, list_query, paginated
 
 
 def get_module_list(proj_id: str) -> List[Module]:
-    return list_modules(proj_id)
+    # Sort by url, name (operation id), tag, method or status. Filter by name prefix, method and status.
+    query = list_query('url', filters=('method', 'status'))
+    if query is not None:
+        return paginated(fs.module_list_validator(proj_id), lambda: fs.list_modules_page(proj_id, query))
+    return cached_json(('modules', proj_id), fs.module_list_validator(proj_id), lambda: list_modules(proj_id))
     # wrapper = ProjectWrapper(proj_id)
     # if wrapper is None:
     #     return 404
@@ -6,6 +6,7 @@ from openapi_server.models import TagStatus, NewProject, ProjectDetails
 from server_impl.projects_fs import ProjectWrapper
 from server_impl import projects_fs as fs
 from server_impl import is_valid_tag
+from server_impl.controllers_impl.api_utils import cached_json, send_file_ranged, list_query, paginated
 
 urlSafe = re.compile('^[a-zA-Z0-9_-]*$')
 # Project IDs that would conflict with other URLs
@@ -18,9 +19,15 @@ def get_projects():
      # noqa: E501
 
 
+    Supports the listing parameters limit, cursor, sort (tag, name or last_modified), order and prefix (of the name),
+    see api_utils.list_query. Without any of them the full list is returned.
+
     :rtype: List[ProjectBrief]
     """
-    return fs.list_projects()
+    query = list_query('name')
+    if query is not None:
+        return paginated(fs.project_list_validator(), lambda: fs.list_projects_page(query))
+    return cached_json(('projects',), fs.project_list_validator(), fs.list_projects)
 
 
 def get_project_details(proj_id: str):
@@ -33,9 +40,10 @@ def get_project_details(proj_id: str):
 def check_tag(tag):
     if not is_valid_tag(tag):
         return TagStatus(legal=False, available=False, message='Only letters, numbers, _, and - are allowed')
-    if tag in reservedTags:
-        return TagStatus(legal=True, available=False)
-    return TagStatus(legal=True, available=fs.project_tag_available(tag))
+    if tag.lower() not in reservedTags and fs.project_tag_available(tag):
+        return TagStatus(legal=True, available=True)
+    suggestions = fs.suggest_project_tags(tag, reservedTags)
+    return TagStatus(legal=True, available=False, message='Already taken. Available: %s' % ', '.join(suggestions))
 
 
 def add_project(proj: NewProject):
@@ -73,6 +81,12 @@ def delete_project(proj_id):
     return fs.delete_project(proj_id)
 
 
+def _spec_mimetype(filename: str) -> str:
+    if filename.endswith('.json'):
+        return 'application/json'
+    return 'application/x-yaml'
+
+
 def download_api_file(proj_id):
     """Download the OpenAPI specification file.
 
@@ -86,7 +100,7 @@ def download_api_file(proj_id):
     wrapper = ProjectWrapper(proj_id)
     if wrapper is None:
         return 404
-    return wrapper.read_api()
+    return send_file_ranged(wrapper.api_path(), wrapper.api_validator(), _spec_mimetype(wrapper.api_filename))
 
 
 def upload_api_file(proj_id: str, specfile: FileStorage):
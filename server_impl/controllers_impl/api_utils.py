@@ -0,0 +1,193 @@
+import datetime
+import mimetypes
+import os
+from typing import Callable, Optional, Sequence, Tuple
+
+import connexion
+from flask import Response, json
+from werkzeug.http import http_date, quote_etag
+from werkzeug.urls import url_encode
+from werkzeug.wsgi import wrap_file
+
+from server_impl.errors import EBadRequest
+from server_impl.projects_fs import ListQuery, Page, response_body
+from server_impl.projects_fs.caches import make_etag
+
+MAX_PAGE_SIZE = 1000
+
+# Full lists and graphs are sent from the response cache, encoded once per version and compressed once per encoding.
+#
+#   RESPONSE_ENCODINGS=gzip,deflate      - The content codings offered to clients that accept them (empty: none)
+#   RESPONSE_COMPRESS_MIN_BYTES=1024     - Smaller bodies are always sent uncompressed
+#   CACHE_RESPONSES_MAX_BYTES=67108864   - See caches.EvictionPolicy.from_env
+response_encodings = [e.strip() for e in os.getenv('RESPONSE_ENCODINGS', 'gzip,deflate').split(',') if e.strip()]
+compress_min_bytes = int(os.getenv('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+
+# Query parameters that switch a list endpoint from the plain full list to a (sorted, filtered or paged) listing
+_listing_params = {'limit', 'cursor', 'sort', 'order', 'prefix'}
+
+
+def validator_headers(validator: Tuple[str, float]) -> dict:
+    etag, last_modified = validator
+    return {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(last_modified),
+        # Allow caching, but make clients revalidate every time
+        'Cache-Control': 'no-cache',
+    }
+
+
+def not_modified(validator: Tuple[str, float]) -> bool:
+    """
+    Evaluate the conditional headers of the current request against a validator. If-None-Match takes precedence over
+    If-Modified-Since, as in RFC 7232.
+    :param validator: (etag, last_modified) for the current version of the resource.
+    :type validator: Tuple[str, float]
+    :return: True if the client's copy is still current, so a 304 can be sent.
+    :rtype: bool
+    """
+    etag, last_modified = validator
+    request = connexion.request
+    if 'If-None-Match' in request.headers:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    if since is not None:
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        modified = datetime.datetime.fromtimestamp(int(last_modified), datetime.timezone.utc)
+        return modified <= since
+    return False
+
+
+def conditional(validator: Tuple[str, float], produce: Callable[[], object]):
+    """
+    Answer a GET with 304 Not Modified if the client already has the current version, and only call ``produce`` to build
+    the body otherwise. Both responses carry the validator headers.
+    :param validator: (etag, last_modified) for the current version of the resource.
+    :type validator: Tuple[str, float]
+    :param produce: Builds the response body
+    :type produce: () -> object
+    :return: A (body, status, headers) tuple for connexion
+    """
+    headers = validator_headers(validator)
+    if not_modified(validator):
+        return '', 304, headers
+    return produce(), 200, headers
+
+
+def cached_json(key: tuple, validator: Tuple[str, float], produce: Callable[[], object]):
+    """
+    Like conditional(), but the body is taken from the response cache, in the content coding that the client prefers.
+    ``produce`` is only called when the current version is not cached yet.
+    :param key: Identifies the resource, e.g. ('graph', project, module).
+    :type key: tuple
+    :param validator: (etag, last_modified) for the current version of the resource.
+    :type validator: Tuple[str, float]
+    :param produce: Builds the response body
+    :type produce: () -> object
+    :rtype: Response
+    """
+    etag, _ = validator
+    headers = validator_headers(validator)
+    headers['Vary'] = 'Accept-Encoding'
+    if not_modified(validator):
+        return Response(status=304, headers=headers)
+    encoding = connexion.request.accept_encodings.best_match(response_encodings + ['identity'], default='identity')
+    body = response_body(key, etag, 'identity', lambda: (json.dumps(produce()) + '\n').encode())
+    if encoding != 'identity' and len(body) >= compress_min_bytes:
+        body = response_body(key, etag, encoding, lambda: body)
+        headers['Content-Encoding'] = encoding
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+def send_file_ranged(path: str, validator: Tuple[str, float], mimetype: str = None) -> Response:
+    """
+    Stream a file from disk instead of reading it into memory. The file is handed to the server's wsgi.file_wrapper, so
+    servers that support it use sendfile. Range, If-Range and the conditional headers are handled by the response, so
+    the reply may be a 200, 206, 304 or 416.
+    :param path: The file to send.
+    :type path: str
+    :param validator: (etag, last_modified) of the file.
+    :type validator: Tuple[str, float]
+    :param mimetype: The content type. Guessed from the file name if not given.
+    :type mimetype: str
+    :rtype: Response
+    """
+    etag, last_modified = validator
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    request = connexion.request
+    f = open(path, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    response = Response(wrap_file(request.environ, f), mimetype=mimetype, direct_passthrough=True)
+    response.content_length = size
+    response.set_etag(etag)
+    response.last_modified = datetime.datetime.fromtimestamp(int(last_modified), datetime.timezone.utc)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+
+
+def query_validator(validator: Tuple[str, float]) -> Tuple[str, float]:
+    """
+    Derive the validator for a representation selected by the query string (a page, a sort order, a subset of fields).
+    """
+    etag, last_modified = validator
+    return make_etag(etag, connexion.request.query_string), last_modified
+
+
+def list_query(default_sort: str, filters: Sequence[str] = ()) -> Optional[ListQuery]:
+    """
+    Read the listing parameters of the current request: limit, cursor, sort, order (asc or desc), prefix, and one
+    parameter per filter (repeatable or comma separated).
+    :param default_sort: The field to sort by if the request does not say.
+    :type default_sort: str
+    :param filters: The filters that this list supports.
+    :type filters: Sequence[str]
+    :return: None if the request has none of the parameters, so the full list should be sent as before.
+    :rtype: Optional[ListQuery]
+    """
+    args = connexion.request.args
+    if not any(name in args for name in _listing_params.union(filters)):
+        return None
+    limit = args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise EBadRequest("'limit' must be a number")
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise EBadRequest("'limit' must be between 1 and %d" % MAX_PAGE_SIZE)
+    order = args.get('order', 'asc').lower()
+    if order not in ('asc', 'desc'):
+        raise EBadRequest("'order' must be 'asc' or 'desc'")
+    selected = {}
+    for name in filters:
+        values = [v for arg in args.getlist(name) for v in arg.split(',') if v]
+        if values:
+            selected[name] = values
+    return ListQuery(args.get('sort', default_sort), descending=order == 'desc', limit=limit,
+                     cursor=args.get('cursor'), prefix=args.get('prefix'), filters=selected)
+
+
+def paginated(validator: Tuple[str, float], produce: Callable[[], Page]):
+    """
+    Like conditional(), for one page of a listing. The body is the list of entries on the page. If there are more,
+    the cursor for the next page is sent in the X-Next-Cursor header and as a Link with rel="next".
+    :param validator: (etag, last_modified) of the whole list.
+    :type validator: Tuple[str, float]
+    :param produce: Finds the page
+    :type produce: () -> Page
+    :return: A (body, status, headers) tuple for connexion
+    """
+    request = connexion.request
+    validator = query_validator(validator)
+    headers = validator_headers(validator)
+    if not_modified(validator):
+        return '', 304, headers
+    page = produce()
+    if page.next_cursor is not None:
+        args = request.args.copy()
+        args['cursor'] = page.next_cursor
+        headers['X-Next-Cursor'] = page.next_cursor
+        headers['Link'] = '<%s?%s>; rel="next"' % (request.base_url, url_encode(args))
+    return page.items, 200, headers
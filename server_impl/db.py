@@ -1,13 +1,182 @@
-from flaskext.mysql import MySQL
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional, Sequence, Tuple, TYPE_CHECKING
 
 from openapi_server.models import ProjectBrief, ProjectDetails
+from server_impl import metrics
 
-mysql = None
+if TYPE_CHECKING:
+    from flaskext.mysql import MySQL
 
+log = logging.getLogger(__name__)
 
-def init(sqlInstance: MySQL):
-    global mysql
-    mysql = sqlInstance
+# Connections are borrowed from a bounded pool for the duration of one query, so any number of concurrent requests
+# share at most `max_size` connections. The pool takes any DB-API 2 connect function, e.g. flask-mysql's
+# MySQL.connect, or sqlite3.connect (with check_same_thread=False and paramstyle='qmark') for testing.
+
+pool: Optional['ConnectionPool'] = None
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connect: Callable[[], object], max_size: int = 10, timeout: float = 30.0,
+                 check_after: float = 30.0, paramstyle: str = 'format'):
+        """
+        :param connect: Opens a new DB-API connection.
+        :type connect: () -> Connection
+        :param max_size: The maximum number of open connections.
+        :type max_size: int
+        :param timeout: Seconds to wait for a free connection before raising PoolTimeout.
+        :type timeout: float
+        :param check_after: Connections that were idle for longer than this are checked before they are handed out.
+        :type check_after: float
+        :param paramstyle: The driver's parameter style. Queries are written with %s and translated for 'qmark'.
+        :type paramstyle: str
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.paramstyle = paramstyle
+        self._idle: Deque[Tuple[object, float]] = deque()
+        self._open = 0
+        self._cond = threading.Condition()
+        self._statements: Dict[str, str] = {}
+        self.waits = 0
+        self.discarded = 0
+
+    def _healthy(self, con) -> bool:
+        try:
+            ping = getattr(con, 'ping', None)
+            if ping is not None:
+                ping(False)
+            else:
+                con.cursor().execute('SELECT 1')
+            return True
+        except Exception as e:
+            log.info('Dropping a broken database connection: %s', e)
+            return False
+
+    def _close(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._open -= 1
+            self.discarded += 1
+            self._cond.notify()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    # Most recently used first, so surplus connections go idle and can time out on the server
+                    con, last_used = self._idle.pop()
+                    break
+                if self._open < self.max_size:
+                    self._open += 1
+                    con = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout('No database connection available after %.1f seconds' % self.timeout)
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                self._cond.wait(remaining)
+        # Connecting and health checks happen outside of the lock
+        if con is None:
+            try:
+                return self.connect()
+            except BaseException:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+        if time.monotonic() - last_used > self.check_after and not self._healthy(con):
+            self._close(con)
+            return self.acquire()
+        return con
+
+    def release(self, con, broken: bool = False):
+        if not broken:
+            try:
+                # Do not hand out a connection with an open transaction
+                con.rollback()
+            except Exception:
+                broken = True
+        if broken:
+            self._close(con)
+            return
+        with self._cond:
+            self._idle.append((con, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        con = self.acquire()
+        try:
+            yield con
+        except BaseException as e:
+            # A failed query does not have to mean a broken connection, so check before dropping it
+            self.release(con, broken=isinstance(e, Exception) and not self._healthy(con))
+            raise
+        self.release(con)
+
+    def statement(self, sql: str) -> str:
+        """
+        Translate a query written with %s placeholders to the driver's style. Each distinct query is translated once,
+        and always maps to the same string, so drivers that cache prepared statements by text (e.g. sqlite3) reuse them.
+        """
+        ret = self._statements.get(sql)
+        if ret is None:
+            ret = sql.replace('%s', '?') if self.paramstyle == 'qmark' else sql
+            self._statements[sql] = ret
+        return ret
+
+    def close(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for con, _ in idle:
+            self._close(con)
+
+    def statistics(self) -> dict:
+        with self._cond:
+            return {'open': self._open, 'idle': len(self._idle), 'max_size': self.max_size, 'waits': self.waits,
+                    'discarded': self.discarded}
+
+
+def _collect_pool_metrics():
+    if pool is None:
+        return
+    stats = pool.statistics()
+    yield 'dp_db_connections_open', 'gauge', 'Open database connections.', [({}, stats['open'])]
+    yield 'dp_db_connections_idle', 'gauge', 'Idle database connections in the pool.', [({}, stats['idle'])]
+    yield 'dp_db_pool_waits_total', 'counter', 'Times a request waited for a free connection.', [({}, stats['waits'])]
+    yield 'dp_db_connections_discarded_total', 'counter', 'Broken connections that were closed.', \
+        [({}, stats['discarded'])]
+
+
+metrics.add_collector(_collect_pool_metrics)
+
+
+def init(sqlInstance: 'MySQL', max_size: int = 10):
+    init_pool(ConnectionPool(sqlInstance.connect, max_size))
+
+
+def init_pool(connection_pool: ConnectionPool):
+    global pool
+    pool = connection_pool
 
 
 class Database:
@@ -16,29 +185,43 @@ class Database:
     handling is also appropriate. If the return value is something that can be passed back to flask/connexion, then the
     method name starts with an 'h'. (As in, ready to be sent back over http(s))
     """
-    def __init__(self):
-        self.con = mysql.connect()
-        self.cur = self.con.cursor()
+    FETCH_BATCH = 500
 
-    def hProjectList(self):
-        self.cur.execute("SELECT tag, name, last_modified FROM project")
-        ret = []
-        for row in self.cur:
-            print(row)
-            ret.append(ProjectBrief(*row))
+    def __init__(self, connection_pool: ConnectionPool = None):
+        self.pool = connection_pool if connection_pool is not None else pool
 
-        self.con.close()
-        return ret
+    def _rows(self, sql: str, args: Sequence = ()) -> Iterator[tuple]:
+        with self.pool.connection() as con:
+            cur = con.cursor()
+            try:
+                cur.execute(self.pool.statement(sql), args)
+                while True:
+                    batch = cur.fetchmany(self.FETCH_BATCH)
+                    if not batch:
+                        break
+                    yield from batch
+            finally:
+                cur.close()
+
+    def _one(self, sql: str, args: Sequence = ()) -> Optional[tuple]:
+        with self.pool.connection() as con:
+            cur = con.cursor()
+            try:
+                cur.execute(self.pool.statement(sql), args)
+                return cur.fetchone()
+            finally:
+                cur.close()
+
+    def hProjectList(self):
+        return [ProjectBrief(*row) for row in self._rows("SELECT tag, name, last_modified FROM project")]
 
     def hProjectDetails(self, tag):
-        rows = self.cur.execute("SELECT tag, name, last_modified, description, api_spec_url FROM project WHERE tag = %s", tag)
-        if rows == 0:
+        data = self._one("SELECT tag, name, last_modified, description, api_spec_url FROM project WHERE tag = %s",
+                         (tag,))
+        if data is None:
             return 'Not Found', 404
-
-        data = self.cur.fetchone()
         return ProjectDetails(*data)
 
     def tagAvailable(self, tag):
-        self.cur.execute("SELECT EXISTS(SELECT 1 FROM project WHERE tag = %s)", tag)
-        result = self.cur.fetchone()
-        return result[0] == 1
+        result = self._one("SELECT EXISTS(SELECT 1 FROM project WHERE tag = %s)", (tag,))
+        return result[0] == 0
@@ -0,0 +1,55 @@
+from typing import Dict, Iterable, List, Mapping, Set, Tuple
+
+# Algorithms on plain directed graphs (id -> successors), shared by the spec and flow graph code. Kept free of other
+# server_impl imports, so either side can use them without loading the other.
+
+
+def strongly_connected(graph: Mapping[str, Iterable[str]]) -> Tuple[Dict[str, int], Set[str]]:
+    """
+    Find the strongly connected components of a directed graph (id -> successors) with Tarjan's algorithm, iteratively
+    so large graphs do not exhaust the stack. Used for the references of a spec (spec_utils.hashing) and for
+    projects_fs.graph_analysis.
+    :return: (The component of each id, the ids that are part of a cycle)
+    :rtype: Tuple[Dict[str, int], Set[str]]
+    """
+    components: Dict[str, int] = {}
+    index: Dict[str, int] = {}
+    low: Dict[str, int] = {}
+    on_stack: Set[str] = set()
+    stack: List[str] = []
+    cyclic: Set[str] = set()
+    for start in graph:
+        if start in index:
+            continue
+        work = [(start, iter(graph.get(start, ())))]
+        index[start] = low[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        while work:
+            ref, targets = work[-1]
+            for target in targets:
+                if target not in index:
+                    index[target] = low[target] = len(index)
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(graph.get(target, ()))))
+                    break
+                if target in on_stack:
+                    low[ref] = min(low[ref], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[ref])
+                if low[ref] == index[ref]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        components[member] = index[ref]
+                        component.append(member)
+                        if member == ref:
+                            break
+                    if len(component) > 1 or ref in graph.get(ref, ()):
+                        cyclic.update(component)
+    return components, cyclic
@@ -1,5 +1,14 @@
+import logging
+import os
+import time
+
 from connexion import App, Api
-from flask import g
+from flask import g, request
+
+from server_impl import metrics
+from server_impl.controllers_impl.DevAPIController_impl import dev_metrics_get
+
+log = logging.getLogger(__name__)
 
 # keyFile = os.path.join('..', '..', '..', 'keys.json')
 # if os.path.exists(keyFile):
@@ -23,8 +32,48 @@ def _save_paths(api: Api):
         }
 
 
+def _configure_logging():
+    # LOG_LEVEL=DEBUG brings back the detailed tracing, the default keeps the request path quiet
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+def _record_latency(response):
+    start = g.get('request_start')
+    if start is not None:
+        rule = request.url_rule
+        metrics.request_latency.observe(time.perf_counter() - start, method=request.method,
+                                        endpoint=rule.rule if rule is not None else 'unmatched',
+                                        status=str(response.status_code))
+    return response
+
+
+def _init_metrics(app: App, api: Api):
+    flask_app = app.app
+    flask_app.before_request(_start_timer)
+    flask_app.after_request(_record_latency)
+    # Plain Flask route, so the metrics do not have to be part of the generated API
+    flask_app.add_url_rule(api.base_path.rstrip('/') + '/dev/metrics', 'dev_metrics', dev_metrics_get,
+                           methods=['GET'])
+
+
+def _init_graph_edits(app: App, api: Api):
+    # Graph edits are not part of the generated API (yet), so PATCH is added as a plain Flask route next to the GET
+    # Imported here, the controllers import server_impl, which imports this module
+    from server_impl.controllers_impl.EditorAPIController_impl import patch_graph
+    app.app.add_url_rule(api.base_path.rstrip('/') + '/projects/<proj_id>/modules/<mod_id>/graph', 'patch_graph',
+                         patch_graph, methods=['PATCH'])
+
+
 def init_hook(app: App, api: Api):
-    print("Custom initialization...")
+    _configure_logging()
+    log.info("Custom initialization...")
     _save_paths(api)
+    _init_metrics(app, api)
+    _init_graph_edits(app, api)
 
     return
@@ -0,0 +1,144 @@
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# A small in-process metrics registry, rendered in the Prometheus text format by GET /dev/metrics. Counters and
+# histograms are updated on the request path, so they only take a lock and add to a number. Values owned by other
+# components (e.g. the cache statistics) are read when the metrics are rendered, through collectors.
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Seconds. Chosen to cover cache hits (sub-millisecond) up to large spec uploads.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in items)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_labels(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s counter' % self.name]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append('%s%s %s' % (self.name, _format_labels(labels), _format_value(value)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket (non-cumulative, the last one is +Inf), sum]
+        self._values: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> List[str]:
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1])) for k, v in self._values.items())
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(labels, (('le', _format_value(bound)),)),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(labels), repr(total)))
+            lines.append('%s_count%s %d' % (self.name, _format_labels(labels), cumulative))
+        return lines
+
+
+# A collector returns (name, type, documentation, [(labels, value), ...]) for each metric it owns
+Sample = Tuple[Dict[str, str], float]
+Collected = Tuple[str, str, str, List[Sample]]
+
+_metrics: List = []
+_collectors: List[Callable[[], Iterable[Collected]]] = []
+
+
+def counter(name: str, documentation: str) -> Counter:
+    c = Counter(name, documentation)
+    _metrics.append(c)
+    return c
+
+
+def histogram(name: str, documentation: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+    h = Histogram(name, documentation, buckets)
+    _metrics.append(h)
+    return h
+
+
+def add_collector(collector: Callable[[], Iterable[Collected]]):
+    """
+    Register a function that reports metrics kept elsewhere. It is called every time the metrics are rendered.
+    """
+    _collectors.append(collector)
+
+
+def render() -> str:
+    """
+    :return: All metrics in the Prometheus text exposition format (version 0.0.4).
+    :rtype: str
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        for name, kind, documentation, samples in collector():
+            lines.append('# HELP %s %s' % (name, documentation))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, _format_labels(_labels(labels)), _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+request_latency = histogram('dp_request_duration_seconds', 'Time spent handling HTTP requests.')
+bytes_read = counter('dp_io_read_bytes_total', 'Bytes read from PROJECT_DIR.')
+bytes_written = counter('dp_io_written_bytes_total', 'Bytes written to PROJECT_DIR.')
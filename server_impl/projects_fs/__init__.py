@@ -1,4 +1,6 @@
-from .fs import list_projects
-from .fs import project_details, list_modules, load_graph
-from .fs import project_tag_available, make_project, delete_project
+from .fs import list_projects, list_projects_page, list_modules_page
+from .fs import project_details, list_modules, load_graph, load_graph_view, patch_graph, analyze_graph
+from .fs import project_list_validator, module_list_validator, graph_validator, response_body
+from .fs import project_tag_available, suggest_project_tags, make_project, delete_project
+from .listing import ListQuery, Page
 from .project_wrapper import ProjectWrapper
@@ -1,10 +1,112 @@
-from typing import Callable, List, TypeVar, Generic
+from collections import OrderedDict
+from typing import Callable, List, TypeVar, Generic, Optional, Tuple
 from glob import glob
+import gzip
+import hashlib
+import logging
 import os
+import threading
+import time
+import zlib
+
+from .watcher import Pattern, get_watcher, split_patterns
+
+log = logging.getLogger(__name__)
+
+
+def make_etag(*parts) -> str:
+    """
+    Build a strong entity tag from the values that identify one version of some data, e.g. file names, mtimes and sizes.
+    """
+    return hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+
+
+def glob_files(pattern: Pattern) -> List[str]:
+    """
+    The files matched by a glob pattern, or by any of a tuple of them.
+    """
+    patterns = split_patterns(pattern)
+    if len(patterns) == 1:
+        return glob(patterns[0])
+    return list(dict.fromkeys(f for p in patterns for f in glob(p)))
+
+
+def fingerprint(pattern: Pattern) -> Tuple[int, int, int]:
+    """
+    :return: (number of files, newest mtime in ns, total size) of the files matched by a glob pattern (or patterns).
+    :rtype: Tuple[int, int, int]
+    """
+    count = newest = total = 0
+    for x in glob_files(pattern):
+        try:
+            st = os.stat(x)
+        except FileNotFoundError:
+            continue
+        count += 1
+        newest = max(newest, st.st_mtime_ns)
+        total += st.st_size
+    return count, newest, total
+
+
+class CacheStats:
+    """
+    Counters for one cache (or a map of caches). Hits are counted without a lock, so under heavy concurrency the
+    numbers are approximate.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+        self.load_time = 0.0
+
+    def as_dict(self) -> dict:
+        return dict(self.__dict__)
+
+
+class EvictionPolicy:
+    def __init__(self, max_entries: int = None, max_bytes: int = None, ttl: float = None):
+        """
+        Limits for a CacheMap or CacheDoubleMap. Entries are evicted in least recently used order. Any limit that is
+        None is not enforced.
+        :param max_entries: The maximum number of keys to keep.
+        :type max_entries: int
+        :param max_bytes: The maximum size of the cached data, approximated by the size of the source files.
+        :type max_bytes: int
+        :param ttl: Evict entries that have not been accessed for this many seconds.
+        :type ttl: float
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+    @classmethod
+    def from_env(cls, name: str) -> 'EvictionPolicy':
+        """
+        Read the limits from CACHE_<NAME>_MAX_ENTRIES, CACHE_<NAME>_MAX_BYTES and CACHE_<NAME>_TTL, falling back to
+        CACHE_MAX_ENTRIES, CACHE_MAX_BYTES and CACHE_TTL.
+        """
+        def lookup(setting: str, parse: Callable):
+            value = os.getenv('CACHE_%s_%s' % (name.upper(), setting), os.getenv('CACHE_%s' % setting))
+            return parse(value) if value else None
+        return cls(lookup('MAX_ENTRIES', int), lookup('MAX_BYTES', int), lookup('TTL', float))
+
+
+class LockStripes:
+    """
+    A fixed pool of locks shared by many keys, so a map with thousands of entries does not need a lock per entry.
+    """
+    def __init__(self, count: int = 64):
+        self.locks = [threading.Lock() for _ in range(count)]
+
+    def of(self, key: str) -> threading.Lock:
+        return self.locks[hash(key) % len(self.locks)]
 
 
 class GlobCache:
-    def __init__(self, pattern: str, accessor: Callable, accessor_args: List = None):
+    def __init__(self, pattern: Pattern, accessor: Callable, accessor_args: List = None, stats: CacheStats = None,
+                 lock: threading.Lock = None):
         self.pattern = pattern
         self.accessor = accessor
         if accessor_args:
@@ -12,26 +114,148 @@ class GlobCache:
         else:
             self.args = []
         self._data = None
-        self.cached_time = self.last_modified()
+        self._dirty = True
+        # Incremented by every invalidation, so one that arrives during a load is not lost
+        self._generation = 0
+        # Held while loading, so concurrent misses for this entry run the accessor only once
+        self._lock = lock if lock is not None else threading.Lock()
+        self.stats = stats if stats is not None else CacheStats()
+        self.size = 0
+        self.last_access = 0.0
+        self._etag: Optional[str] = None
+        # The fingerprint of the files that the cached data was read from
+        self._fp: Optional[Tuple[int, int, int]] = None
+        # Called as on_load(cache, previous_size) after the data was (re)loaded
+        self.on_load: Optional[Callable[['GlobCache', int], None]] = None
+        self.watcher = get_watcher()
+        if self.watcher is not None and not self.watcher.subscribe(self):
+            # The files can not be watched, check them on every read
+            self.watcher = None
+        self.cached_time = 0
+
+    def _watched(self) -> bool:
+        """
+        True if changes are pushed to this entry by a running watcher, so its dirty flag can be trusted.
+        """
+        return self.watcher is not None and self.watcher.running()
 
     def last_modified(self) -> float:
-        files = glob(self.pattern)
+        files = glob_files(self.pattern)
         if len(files) == 0:
             return 0
         return max([os.path.getmtime(x) for x in files])
 
+    def signature(self):
+        """
+        A cheap fingerprint of the files matched by the pattern. Unlike last_modified, this also changes when a file is
+        deleted.
+        """
+        files = glob_files(self.pattern)
+        return len(files), max([os.path.getmtime(x) for x in files], default=0)
+
+    def fingerprint(self) -> Tuple[int, int, int]:
+        return fingerprint(self.pattern)
+
+    def validator(self) -> Tuple[str, float]:
+        """
+        Get a strong ETag and the Last-Modified time for the data, without loading it. In a watched mode a clean entry
+        answers from memory, otherwise the files are stat'ed.
+        :return: (etag, last_modified)
+        :rtype: Tuple[str, float]
+        """
+        if self._etag is not None and not self._dirty and self._watched():
+            return self._etag, self.cached_time
+        fp = self.fingerprint()
+        return make_etag(self.pattern, fp), fp[1] / 1e9
+
+    def invalidate(self):
+        self._generation += 1
+        self._dirty = True
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.unsubscribe(self)
+
+    def _fresh(self, fp: Optional[Tuple[int, int, int]]) -> bool:
+        # Unwatched entries compare the fingerprint that validator() builds the ETag from, so the data and the ETag
+        # always describe the same files (the newest mtime alone does not change when a file is deleted)
+        if self._data is None:
+            return False
+        if fp is None:
+            return not self._dirty
+        return fp == self._fp
+
+    def _load(self, fp: Optional[Tuple[int, int, int]]):
+        generation = self._generation
+        previous_size = self.size
+        if fp is None:
+            # Taken before loading, so a change during the load produces a new ETag afterwards
+            fp = self.fingerprint()
+        m = fp[1] / 1e9
+        if self._data is not None and fp == self._fp:
+            # The files are as they were when the data was read (or last updated), e.g. this process' own write was
+            # already applied with update(), so only the freshness markers are out of date
+            self.stats.hits += 1
+            self.cached_time = m
+            self._dirty = self._generation != generation
+            return self._data
+        self.stats.misses += 1
+        start = time.perf_counter()
+        data = self.accessor(*self.args)
+        self.stats.load_time += time.perf_counter() - start
+        # Publish the data before the freshness markers, so a concurrent reader never pairs new markers with old data
+        self._data = data
+        self.cached_time = m
+        self._dirty = self._generation != generation
+        self.size = fp[2]
+        self._fp = fp
+        self._etag = make_etag(self.pattern, fp)
+        if self.on_load is not None:
+            self.on_load(self, previous_size)
+        return data
+
+    def update(self, transform: Callable[[object], object], before: Tuple[int, int, int],
+               after: Tuple[int, int, int]):
+        """
+        Apply a change that this process made to the files to the cached data, instead of reading them again. This is
+        only done if the cache holds the version from right before the change, otherwise the entry is left to reload.
+        The entry stays invalidated, the next access finds that the files still match ``after`` and skips the load.
+        :param transform: Builds the new data from the cached data.
+        :type transform: (object) -> object
+        :param before: fingerprint() from before the change
+        :type before: Tuple[int, int, int]
+        :param after: fingerprint() from right after the change
+        :type after: Tuple[int, int, int]
+        """
+        with self._lock:
+            if self._data is None or self._fp != before:
+                return
+            fp = after
+            previous_size = self.size
+            self._data = transform(self._data)
+            self.cached_time = fp[1] / 1e9
+            self.size = fp[2]
+            self._fp = fp
+            self._etag = make_etag(self.pattern, fp)
+            if self.on_load is not None:
+                self.on_load(self, previous_size)
+
     @property
     def data(self):
-        m = self.last_modified()
-        if self._data is not None:
-            if m == self.cached_time:
-                # No changes, return cached version
-                print('CACHE HIT')
+        self.last_access = time.monotonic()
+        fp = None if self._watched() else self.fingerprint()
+        if self._fresh(fp):
+            # No changes, return cached version
+            log.debug('Cache hit: %s', self.pattern)
+            self.stats.hits += 1
+            return self._data
+        with self._lock:
+            if self._fresh(fp):
+                # Another request loaded it while this one was waiting
+                self.stats.coalesced += 1
                 return self._data
-        self.cached_time = m
-        print('CACHE MISS')
-        self._data = self.accessor(*self.args)
-        return self._data
+            log.debug('Cache miss: %s', self.pattern)
+            return self._load(fp)
 
     def filter(self, filter_fn):
         # Cache may be empty, in which case there is nothing to do...
@@ -39,61 +263,272 @@ class GlobCache:
             self._data = filter(filter_fn, self._data)
 
 
-class CacheMap:
+class BoundedCacheMap:
+    """
+    Common part of CacheMap and CacheDoubleMap: a map from a key to a GlobCache, kept in least recently used order so
+    that the map can be held to an EvictionPolicy. Evicting an entry just drops its GlobCache, the next access builds a
+    new one, so eviction never interferes with the mtime checks done by the GlobCache itself.
+    """
+    def __init__(self, accessor: Callable, policy: EvictionPolicy = None):
+        self.caches: 'OrderedDict[str, GlobCache]' = OrderedDict()
+        self.accessor = accessor
+        self.policy = policy if policy is not None else EvictionPolicy()
+        self.stats = CacheStats()
+        self.total_size = 0
+        # Guards the map itself. Loads happen outside of it, under the entry's stripe lock.
+        self._lock = threading.RLock()
+        self._stripes = LockStripes(int(os.getenv('CACHE_LOCK_STRIPES', '64')))
+
+    def _get(self, ckey: str, pattern: Callable[[], Pattern], args: List) -> GlobCache:
+        with self._lock:
+            self._expire()
+            cache = self.caches.get(ckey)
+            if cache is not None:
+                self.caches.move_to_end(ckey)
+                return cache
+        # Building a GlobCache may touch the file system, so do it outside the map lock
+        created = GlobCache(pattern(), self.accessor, args, stats=self.stats, lock=self._stripes.of(ckey))
+        with self._lock:
+            cache = self.caches.get(ckey)
+            if cache is not None:
+                # Another thread got there first
+                created.close()
+                self.caches.move_to_end(ckey)
+                return cache
+            created.on_load = self._loaded
+            self.caches[ckey] = created
+            self._enforce(keep=created)
+        return created
+
+    def _loaded(self, cache: GlobCache, previous_size: int):
+        with self._lock:
+            if cache.on_load is None:
+                # Evicted while loading
+                return
+            self.total_size += cache.size - previous_size
+            self._enforce(keep=cache)
+
+    def _drop(self, ckey: str):
+        cache = self.caches.pop(ckey)
+        self.total_size -= cache.size
+        # A request may still hold the evicted cache, it must no longer count against this map
+        cache.on_load = None
+        cache.close()
+
+    def _expire(self):
+        ttl = self.policy.ttl
+        if ttl is None:
+            return
+        cutoff = time.monotonic() - ttl
+        # The oldest entries are at the front, so stop at the first one that is still fresh.
+        while self.caches:
+            ckey, cache = next(iter(self.caches.items()))
+            if cache.last_access >= cutoff:
+                break
+            self._drop(ckey)
+            self.stats.expirations += 1
+
+    def _over_budget(self) -> bool:
+        p = self.policy
+        if p.max_entries is not None and len(self.caches) > p.max_entries:
+            return True
+        return p.max_bytes is not None and self.total_size > p.max_bytes
+
+    def _enforce(self, keep: GlobCache = None):
+        while self.caches and self._over_budget():
+            ckey, cache = next(iter(self.caches.items()))
+            if cache is keep:
+                # Never evict the entry that is being returned, even if it is larger than the whole budget.
+                break
+            self._drop(ckey)
+            self.stats.evictions += 1
+
+    def _remove(self, ckey: str):
+        with self._lock:
+            if ckey in self.caches:
+                self._drop(ckey)
+
+    def remove_where(self, match: Callable[..., bool]):
+        """
+        Drop every entry whose keys match, e.g. all graphs of a project.
+        :param match: Called with the keys of each entry.
+        :type match: (*str) -> bool
+        """
+        with self._lock:
+            for ckey in [ckey for ckey, cache in self.caches.items() if match(*cache.args)]:
+                self._drop(ckey)
+
+    def clear(self):
+        """
+        Drop every entry (the statistics are kept).
+        """
+        with self._lock:
+            for ckey in list(self.caches.keys()):
+                self._drop(ckey)
+
+    def statistics(self) -> dict:
+        with self._lock:
+            ret = self.stats.as_dict()
+            ret['entries'] = len(self.caches)
+            ret['bytes'] = self.total_size
+        return ret
+
+
+class CacheMap(BoundedCacheMap):
 
-    def __init__(self, pattern: Callable, accessor: Callable):
+    def __init__(self, pattern: Callable, accessor: Callable, policy: EvictionPolicy = None):
         """
         Build a map from some key to a glob cache per key.
         :param pattern: A function that returns the glob pattern for this key.
         :type pattern: (str) -> str
         :param accessor: A function that takes the key returns the data for use in the cache.
         :type accessor: (str) -> obj
+        :param policy: Limits on the number and size of the cached entries.
+        :type policy: EvictionPolicy
         """
+        super(CacheMap, self).__init__(accessor, policy)
         self.patternBuilder = pattern
-        self.caches = dict()
-        self.accessor = accessor
 
     def of(self, key):
-        cache = self.caches.get(key)
-        if cache is None:
-            cache = GlobCache(self.patternBuilder(key), self.accessor, [key])
-            self.caches[key] = cache
-        return cache
+        return self._get(key, lambda: self.patternBuilder(key), [key])
 
     def remove(self, key):
-        if key in self.caches:
-            del self.caches[key]
+        self._remove(key)
 
 
 T = TypeVar('T')
 
 
-class CacheDoubleMap(Generic[T]):
+class CacheDoubleMap(BoundedCacheMap, Generic[T]):
 
-    def __init__(self, pattern: Callable[[str, str], str], accessor: Callable[[str, str], T]):
+    def __init__(self, pattern: Callable[[str, str], str], accessor: Callable[[str, str], T],
+                 policy: EvictionPolicy = None):
         """
         Build a map from some key to a glob cache per key.
-        :param pattern: A function that returns the glob pattern for these two keys.
-        :type pattern: (str, str) -> str
+        :param pattern: A function that returns the glob pattern (or a tuple of them) for these two keys.
+        :type pattern: (str, str) -> str | Tuple[str, ...]
         :param accessor: A function that takes the key returns the data for use in the cache.
         :type accessor: (str, str) -> obj
+        :param policy: Limits on the number and size of the cached entries.
+        :type policy: EvictionPolicy
         """
+        super(CacheDoubleMap, self).__init__(accessor, policy)
         self.patternBuilder = pattern
-        self.caches = dict()
-        self.accessor = accessor
 
     def _compound_key(self, key1: str, key2: str) -> str:
         return "%s ~.~ %s" % (key1, key2)
 
     def of(self, key1: str, key2: str):
         ckey = self._compound_key(key1, key2)
-        cache = self.caches.get(ckey)
-        if cache is None:
-            cache = GlobCache(self.patternBuilder(key1, key2), self.accessor, [key1, key2])
-            self.caches[ckey] = cache
-        return cache
+        return self._get(ckey, lambda: self.patternBuilder(key1, key2), [key1, key2])
 
     def remove(self, key1: str, key2: str):
-        ckey = self._compound_key(key1, key2)
-        if ckey in self.caches:
-            del self.caches[ckey]
\ No newline at end of file
+        self._remove(self._compound_key(key1, key2))
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    if encoding == 'deflate':
+        # HTTP's deflate is the zlib format
+        return zlib.compress(body, 6)
+    raise ValueError('Unknown content encoding: %s' % encoding)
+
+
+class EncodedResponse:
+    """
+    The encoded body of one version of a resource, and the compressed variants that were asked for so far.
+    """
+    __slots__ = ('etag', 'variants', 'size')
+
+    def __init__(self, etag: str, body: bytes):
+        self.etag = etag
+        self.variants = {'identity': body}
+        self.size = len(body)
+
+
+class ResponseCache:
+    """
+    Response bodies that are ready to send, so a cached resource is not encoded to JSON (and compressed) again for every
+    request. Each resource keeps the body of one version, identified by its ETag. A request with another ETag replaces
+    it, so the bytes are invalidated together with the cache entry they were built from. Entries are evicted in least
+    recently used order to stay within max_entries and max_bytes (ttl is not used).
+    """
+    def __init__(self, policy: EvictionPolicy = None, default_max_bytes: int = 64 << 20):
+        self.policy = policy if policy is not None else EvictionPolicy()
+        if self.policy.max_bytes is None:
+            self.policy.max_bytes = default_max_bytes
+        self.stats = CacheStats()
+        self.total_size = 0
+        self._entries: 'OrderedDict[Tuple, EncodedResponse]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple, etag: str, encoding: str, encode: Callable[[], bytes]) -> bytes:
+        """
+        :param key: Identifies the resource (and representation).
+        :type key: Tuple
+        :param etag: The current ETag of the resource.
+        :type etag: str
+        :param encoding: 'identity', 'gzip' or 'deflate'
+        :type encoding: str
+        :param encode: Builds the uncompressed body, if it is not cached.
+        :type encode: () -> bytes
+        :rtype: bytes
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.etag == etag:
+                self._entries.move_to_end(key)
+                body = entry.variants.get(encoding)
+                if body is not None:
+                    self.stats.hits += 1
+                    return body
+        self.stats.misses += 1
+        start = time.perf_counter()
+        if entry is None or entry.etag != etag:
+            entry = EncodedResponse(etag, encode())
+        body = entry.variants['identity']
+        if encoding != 'identity':
+            body = _compress(body, encoding)
+        self.stats.load_time += time.perf_counter() - start
+        with self._lock:
+            current = self._entries.pop(key, None)
+            if current is not None:
+                self.total_size -= current.size
+                if current.etag == etag:
+                    # Cached by now, possibly by another request, add to that
+                    entry = current
+            if encoding not in entry.variants:
+                entry.variants[encoding] = body
+                entry.size += len(body)
+            self._entries[key] = entry
+            self.total_size += entry.size
+            self._evict()
+        return body
+
+    def _evict(self):
+        p = self.policy
+        while len(self._entries) > 1 and ((p.max_entries is not None and len(self._entries) > p.max_entries) or
+                                          self.total_size > p.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self.total_size -= evicted.size
+            self.stats.evictions += 1
+
+    def remove_where(self, match: Callable[[Tuple], bool]):
+        """
+        Drop the bodies of every resource whose key matches.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                self.total_size -= self._entries.pop(key).size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_size = 0
+
+    def statistics(self) -> dict:
+        with self._lock:
+            ret = self.stats.as_dict()
+            ret['entries'] = len(self._entries)
+            ret['bytes'] = self.total_size
+        return ret
@@ -14,6 +14,11 @@ if not os.path.isdir(PROJ_DIR):
 class FileNames:
     name_brief = 'brief.yaml'
     name_details = 'details.yaml'
+    name_index = '.project-index.jsonl'
+
+    @classmethod
+    def project_index(cls) -> str:
+        return os.path.join(PROJ_DIR, FileNames.name_index)
 
     @classmethod
     def project_dir(cls, tag: str) -> str:
@@ -1,77 +1,153 @@
-from typing import List, Optional, Tuple
+from typing import Callable, List, Optional, Tuple
 from glob import glob
 
 from werkzeug.datastructures import FileStorage
 
 from openapi_server.models import ProjectBrief, ProjectDetails, NewProject, StringConstants, FlowGraph, Module
 
+import logging
 import os
 import yaml
 
 from server_impl.errors import EBadRequest
-from server_impl.errors.custom_errors import ENotFound
-from server_impl.projects_fs.caches import GlobCache, CacheMap
+from server_impl.tags import suggest_tags
+from server_impl.errors.custom_errors import ENotFound, EConflict
 import datetime
 import shutil
 
 from server_impl.projects_fs.file_names import FileNames, PROJ_DIR
-from server_impl.projects_fs.fs_internals import CacheRegistry, save_project, read_yaml
+from server_impl.projects_fs.graph_analysis import GraphAnalysis
+from server_impl.projects_fs.graph_log import validate_ops
+from server_impl.projects_fs.listing import ListQuery, Page
+from server_impl.projects_fs.fs_internals import project_index, CacheRegistry
+from server_impl.projects_fs.storage import get_storage
+from server_impl.projects_fs.watcher import notify_changed
+
+log = logging.getLogger(__name__)
 
 
 def list_projects() -> List[ProjectBrief]:
-    return CacheRegistry.project_list.data
+    return get_storage().list_projects()
+
+
+def list_projects_page(query: ListQuery) -> Page:
+    return get_storage().list_projects_page(query)
 
 
 def list_modules(tag: str) -> List[Module]:
-    return CacheRegistry.module_list.of(tag).data
+    return get_storage().list_modules(tag)
+
+
+def list_modules_page(tag: str, query: ListQuery) -> Page:
+    return get_storage().list_modules_page(tag, query)
 
 
 def load_graph(tag: str, mod: str) -> FlowGraph:
-    return CacheRegistry.graphs.of(tag, mod).data
+    return get_storage().load_graph(tag, mod)
+
+
+def load_graph_view(tag: str, mod: str, fields: List[str] = None, node_ids: List[str] = None) -> dict:
+    """
+    Some sections and/or nodes of a graph, see graph_views.select_graph.
+    """
+    return get_storage().load_graph_view(tag, mod, fields, node_ids)
+
+
+def analyze_graph(tag: str, mod: str) -> GraphAnalysis:
+    """
+    The structure of a graph: topological order, cycles, dead nodes, reachability. See graph_analysis.
+    """
+    return get_storage().analyze_graph(tag, mod)
+
+
+def patch_graph(tag: str, mod: str, ops: list) -> Tuple[str, float]:
+    """
+    Apply a list of graph operations (see graph_log) to a graph.
+    :return: The validator of the updated graph
+    :rtype: Tuple[str, float]
+    """
+    get_storage().patch_graph(tag, mod, validate_ops(ops))
+    return graph_validator(tag, mod)
+
+
+def response_body(key: tuple, etag: str, encoding: str, encode: Callable[[], bytes]) -> bytes:
+    """
+    The encoded body of a response, from the response cache. See caches.ResponseCache.
+    """
+    return CacheRegistry.responses.get(key, etag, encoding, encode)
+
+
+def project_list_validator() -> Tuple[str, float]:
+    return get_storage().project_list_validator()
+
+
+def module_list_validator(tag: str) -> Tuple[str, float]:
+    return get_storage().module_list_validator(tag)
+
+
+def graph_validator(tag: str, mod: str) -> Tuple[str, float]:
+    return get_storage().graph_validator(tag, mod)
 
 
 def lookup_tag(tag: str) -> Optional[Tuple[ProjectDetails, str]]:
     project_dir = FileNames.project_dir(tag)
     if not os.path.exists(project_dir):
         return None
-    return CacheRegistry.project_details.of(tag).data, project_dir
+    details = get_storage().project_details(tag)
+    if details is None:
+        return None
+    return details, project_dir
 
 
 def project_details(tag: str) -> Optional[ProjectDetails]:
-    project_dir = FileNames.project_dir(tag)
-    if not os.path.exists(project_dir):
-        return None
-    return CacheRegistry.project_details.of(tag).data
+    return get_storage().project_details(tag)
 
 
 def project_tag_available(tag: str) -> bool:
-    return tag.lower() not in [x.lower() for x in os.listdir(PROJ_DIR)]
+    return not project_index.contains(tag)
+
+
+def suggest_project_tags(tag: str, reserved: List[str] = (), count: int = 3) -> List[str]:
+    """
+    Free tags similar to ``tag``, for when it is taken.
+    :param reserved: Additional tags that can not be used (lowercase).
+    :type reserved: List[str]
+    """
+    return suggest_tags(tag, lambda t: t.lower() in reserved or project_index.contains(t), count)
 
 
 def make_project(proj: NewProject):
     dirname = FileNames.project_dir(proj.tag)
-    os.makedirs(dirname)
-
-    project = ProjectDetails(tag=proj.tag, name=proj.name, last_modified=datetime.datetime.now(),
-                             description=proj.description, api_version=StringConstants.NOT_SET.value)
-    save_project(project)
+    with project_index.transaction():
+        if project_index.contains(proj.tag):
+            raise EConflict("Project Tag Conflict")
+        try:
+            os.makedirs(dirname)
+        except FileExistsError:
+            raise EConflict("Project Tag Conflict")
+
+        project = ProjectDetails(tag=proj.tag, name=proj.name, last_modified=datetime.datetime.now(),
+                                 description=proj.description, api_version=StringConstants.NOT_SET.value)
+        get_storage().save_project(project)
     return project
 
 
 def delete_project(tag: str):
     dirname = FileNames.project_dir(tag)
-    if os.path.exists(dirname):
-        shutil.rmtree(dirname)
-        CacheRegistry.project_details.remove(tag)
-        CacheRegistry.project_list.filter(lambda proj: proj.tag == tag)
-        return
-    else:
-        raise ENotFound("No project exists with tag '%s'" % tag)
+    with project_index.transaction():
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+            notify_changed(dirname, is_dir=True)
+            get_storage().delete_project(tag)
+            project_index.remove(tag)
+            return
+        else:
+            raise ENotFound("No project exists with tag '%s'" % tag)
 
 
 def update_project(project: ProjectDetails):
     project.last_modified = datetime.datetime.now()
-    save_project(project)
+    get_storage().save_project(project)
 
 
 def add_api(tag: str, api: FileStorage):
@@ -80,7 +156,7 @@ def add_api(tag: str, api: FileStorage):
         project, dirname = match
 
         api.save(dirname)
-        print('API File Saved: %s' % api.filename)
+        log.info('API File Saved: %s', api.filename)
         update_project(project)
     else:
         return True, 404
@@ -1,15 +1,28 @@
 from enum import Enum
 
+import logging
 import yaml
 import os
 
-from typing import Union, List
-
-from openapi_server.models import ProjectBrief, ProjectDetails, Module, FlowGraph
-from server_impl.projects_fs.caches import GlobCache, CacheMap, CacheDoubleMap
+from typing import Union, List, Optional, Tuple
+
+from openapi_server.models import ProjectBrief, ProjectDetails, Module
+from server_impl import metrics
+from server_impl.errors.custom_errors import ENotFound
+from server_impl.projects_fs import graph_log
+from server_impl.projects_fs.caches import GlobCache, CacheMap, CacheDoubleMap, EvictionPolicy, ResponseCache
+from server_impl.projects_fs.listing import Field, Listing
+from server_impl.projects_fs.packed_graph import PackedGraph
+from server_impl.projects_fs.project_index import ProjectIndex
+from server_impl.projects_fs.shared_cache import get_shared_cache, shared_load
+from server_impl.projects_fs.snapshots import load_with_snapshot, write_snapshot
+from server_impl.projects_fs.watcher import notify_changed
+from server_impl.projects_fs.writes import write_batch, write_file
 from .file_names import FileNames, PROJ_DIR
 from glob import glob
 
+log = logging.getLogger(__name__)
+
 
 def repr_datetime_as_string(dumper, data):
     return dumper.represent_str(data.isoformat())
@@ -27,19 +40,32 @@ yaml.SafeDumper.add_representer(Enum, repr_enum)
 
 def read_yaml(filename: str) -> Union[dict, list, object]:
     with open(filename, 'r') as f:
+        metrics.bytes_read.inc(os.fstat(f.fileno()).st_size)
         data = yaml.safe_load(f)
     return data
 
 
 def save_yaml(filename: str, data: object):
-    with open(filename, 'w+') as f:
-        yaml.safe_dump(data, f)
+    write_file(filename, yaml.safe_dump(data))
 
 
+def dump_yaml(data: object) -> str:
+    return yaml.safe_dump(data)
+
+
+def write_files(files: List[Tuple[str, str]]):
+    """
+    Write a batch of already serialized files as one group commit (see writes.WriteBatch).
+    :param files: (filename, content) pairs
+    :type files: List[Tuple[str, str]]
+    """
+    with write_batch():
+        for filename, content in files:
+            write_file(filename, content)
 
-class Patterns:
-    project_list = os.path.join(PROJ_DIR, '*', FileNames.name_brief)
 
+
+class Patterns:
     @classmethod
     def project_details(cls, tag: str):
         return os.path.join(FileNames.project_dir(tag), '*.yaml')
@@ -56,21 +82,49 @@ class Patterns:
     def project_graph_file(tag: str, mod: str):
         return os.path.join(FileNames.project_dir(tag), 'modules', '%s-graph.yaml' % mod)
 
+    @staticmethod
+    def project_graph_log(tag: str, mod: str):
+        return os.path.join(FileNames.project_dir(tag), 'modules', '%s-graph.log.yaml' % mod)
 
-def construct_project_list():
-    ret = []
-    for f in glob(Patterns.project_list):
-        raw = read_yaml(f)
-        proj = ProjectBrief.inflate(raw)
-        ret.append(proj)
-    return ret
+    @classmethod
+    def project_graph_files(cls, tag: str, mod: str):
+        return cls.project_graph_file(tag, mod), cls.project_graph_log(tag, mod)
+
+    @staticmethod
+    def project_hashes_file(tag: str):
+        return os.path.join(FileNames.project_dir(tag), 'modules', 'operation-hashes.json')
+
+    @staticmethod
+    def project_ref_index_file(tag: str):
+        return os.path.join(FileNames.project_dir(tag), 'modules', 'ref-index.json')
+
+
+def scan_projects() -> Tuple[List[dict], List[str]]:
+    """
+    Walk PROJECT_DIR to (re)build the project index.
+    :return: (The content of every brief.yaml, Names in PROJECT_DIR that are not projects)
+    :rtype: Tuple[List[dict], List[str]]
+    """
+    briefs = []
+    reserved = []
+    for name in os.listdir(PROJ_DIR):
+        if name.startswith('.'):
+            continue
+        brief_file = os.path.join(PROJ_DIR, name, FileNames.name_brief)
+        if os.path.exists(brief_file):
+            briefs.append(read_yaml(brief_file))
+        else:
+            reserved.append(name)
+    return briefs, reserved
 
 
 def debug_dict(data: dict, msg = None):
+    if not log.isEnabledFor(logging.DEBUG):
+        return
     if msg:
-        print(msg)
+        log.debug(msg)
     for key in data.keys():
-        print('%s: %s' % (key, str(data[key])))
+        log.debug('%s: %s', key, data[key])
 
 
 def construct_project_details(tag: str):
@@ -78,45 +132,196 @@ def construct_project_details(tag: str):
     details = read_yaml(FileNames.project_details(tag))
     combined = {**brief, **details}
 
-    debug_dict(ProjectDetails.inflate(combined).flatten(), 'BUILT')
-    return ProjectDetails.inflate(combined)
+    ret = ProjectDetails.inflate(combined)
+    if log.isEnabledFor(logging.DEBUG):
+        debug_dict(ret.flatten(), 'BUILT')
+    return ret
 
 
-def construct_module_list(tag: str) -> List[Module]:
-    ret = []
-    for f in glob(Patterns.project_modules(tag)):
-        raw = read_yaml(f)
-        mod = Module.inflate(raw)
-        ret.append(mod)
-    return ret
+def _read_module_files(tag: str) -> List[dict]:
+    return [load_with_snapshot(f, read_yaml) for f in glob(Patterns.project_modules(tag))]
+
+
+# The fields the module list can be sorted and filtered by
+MODULE_FIELDS = {
+    'tag': Field('tag'),
+    'name': Field('operation_id', 'operationId'),
+    'url': Field('url'),
+    'method': Field('method'),
+    'status': Field('status'),
+}
+
 
+class ModuleListing(Listing):
+    """
+    The raw modules of one project. The full list of models is only inflated if it is asked for, pages inflate just
+    their own entries.
+    """
+    def __init__(self, raw_modules: List[dict]):
+        super(ModuleListing, self).__init__(MODULE_FIELDS, 'name')
+        self.raw_modules = raw_modules
+        for i, raw in enumerate(raw_modules):
+            self.put(str(raw.get('tag') or i), raw)
+        self._modules: Optional[List[Module]] = None
 
-def construct_graph(tag: str, mod: str) -> FlowGraph:
+    @property
+    def modules(self) -> List[Module]:
+        if self._modules is None:
+            self._modules = [Module.inflate(dict(raw)) for raw in self.raw_modules]
+        return self._modules
+
+
+def construct_module_list(tag: str) -> ModuleListing:
+    pattern = Patterns.project_modules(tag)
+    raw_modules = shared_load('modules:%s' % tag, os.path.abspath(os.path.dirname(pattern)), pattern,
+                              lambda: _read_module_files(tag))
+    return ModuleListing(raw_modules)
+
+
+def _read_graph(tag: str, mod: str) -> dict:
+    filename = Patterns.project_graph_file(tag, mod)
+    with graph_log.locked(Patterns.project_graph_log(tag, mod), exclusive=False) as f:
+        data = load_with_snapshot(filename, read_yaml)
+        if f is not None:
+            ops = graph_log.read_log(f)
+            if ops:
+                data = graph_log.apply_ops(data, ops)
+    return data
+
+
+def construct_graph(tag: str, mod: str) -> PackedGraph:
     filename = Patterns.project_graph_file(tag, mod)
-    data = read_yaml(filename)
-    return FlowGraph.inflate(data)
+    data = shared_load('graph:%s' % filename, os.path.abspath(os.path.dirname(filename)),
+                       Patterns.project_graph_files(tag, mod), lambda: _read_graph(tag, mod))
+    return PackedGraph.pack(data)
+
+
+# Start listening for this process' writes before anything is written
+get_shared_cache()
+
+project_index = ProjectIndex(FileNames.project_index(), scan_projects)
 
 
 class CacheRegistry:
-    project_list = GlobCache(Patterns.project_list, construct_project_list)
-    project_details = CacheMap(Patterns.project_details, construct_project_details)
-    module_list = CacheMap(Patterns.project_modules, construct_module_list)
-    graphs = CacheDoubleMap(Patterns.project_graph_file, construct_graph)
+    project_list = project_index
+    project_details = CacheMap(Patterns.project_details, construct_project_details,
+                               EvictionPolicy.from_env('project_details'))
+    module_list = CacheMap(Patterns.project_modules, construct_module_list, EvictionPolicy.from_env('module_list'))
+    graphs = CacheDoubleMap(Patterns.project_graph_files, construct_graph, EvictionPolicy.from_env('graphs'))
+    # Encoded (and compressed) bodies of the responses built from the caches above
+    responses = ResponseCache(EvictionPolicy.from_env('responses'))
+
+    @classmethod
+    def clear(cls):
+        """
+        Empty every in-memory cache, e.g. to measure cold loads. On-disk tiers (snapshots, shared cache) are kept.
+        """
+        cls.project_list.clear()
+        cls.project_details.clear()
+        cls.module_list.clear()
+        cls.graphs.clear()
+        cls.responses.clear()
+
+    @classmethod
+    def remove_project(cls, tag: str):
+        """
+        Drop every cache entry of a deleted project, with its watcher subscription. Tags are case insensitive, and the
+        entries are keyed by the tag as it was requested.
+        """
+        tag = tag.lower()
+        cls.project_details.remove_where(lambda t: t.lower() == tag)
+        cls.module_list.remove_where(lambda t: t.lower() == tag)
+        cls.graphs.remove_where(lambda t, mod: t.lower() == tag)
+        # ('modules', tag) and ('graph', tag, mod)
+        cls.responses.remove_where(lambda key: len(key) > 1 and key[1].lower() == tag)
+
+    @classmethod
+    def statistics(cls) -> dict:
+        return {
+            'project_details': cls.project_details.statistics(),
+            'module_list': cls.module_list.statistics(),
+            'graphs': cls.graphs.statistics(),
+            'responses': cls.responses.statistics(),
+        }
+
+
+_cache_metrics = [
+    ('hits', 'counter', 'Cache lookups answered from memory.'),
+    ('misses', 'counter', 'Cache lookups that loaded the data.'),
+    ('coalesced', 'counter', 'Cache misses that waited for a concurrent load instead of loading.'),
+    ('evictions', 'counter', 'Cache entries evicted to stay within the eviction policy.'),
+    ('expirations', 'counter', 'Cache entries dropped because their TTL passed.'),
+    ('load_time', 'counter', 'Seconds spent loading cache entries.'),
+    ('entries', 'gauge', 'Entries currently in the cache.'),
+    ('bytes', 'gauge', 'Approximate size of the cached data, in bytes of source files.'),
+]
+
+
+def _collect_cache_metrics():
+    stats = CacheRegistry.statistics()
+    for key, kind, documentation in _cache_metrics:
+        name = 'dp_cache_%s%s' % (key if key != 'load_time' else 'load_seconds', '_total' if kind == 'counter' else '')
+        yield name, kind, documentation, [({'cache': cache}, values[key]) for cache, values in sorted(stats.items())]
+
+
+metrics.add_collector(_collect_cache_metrics)
+
+
+def patch_graph(tag: str, mod: str, ops: List[dict]):
+    """
+    Append operations to the log of a graph, and apply them to the cached graph. See graph_log.
+    """
+    if not os.path.exists(Patterns.project_graph_file(tag, mod)):
+        raise ENotFound("No module '%s' in project '%s'" % (mod, tag))
+    cache = CacheRegistry.graphs.of(tag, mod)
+    log_file = Patterns.project_graph_log(tag, mod)
+    with graph_log.locked(log_file, exclusive=True) as f:
+        before = cache.fingerprint()
+        size = graph_log.append(f, ops)
+        after = cache.fingerprint()
+        notify_changed(log_file)
+    # Outside of the log lock, a concurrent load holds the cache lock while it waits for the log
+    cache.update(lambda graph: graph.apply(ops), before, after)
+    if size >= graph_log.compact_bytes:
+        graph_log.compact_later(log_file, lambda: compact_graph(tag, mod))
+
+
+def compact_graph(tag: str, mod: str):
+    """
+    Fold the operation log of a graph into the graph file.
+    """
+    filename = Patterns.project_graph_file(tag, mod)
+    log_file = Patterns.project_graph_log(tag, mod)
+    cache = CacheRegistry.graphs.of(tag, mod)
+    with graph_log.locked(log_file, exclusive=True) as f:
+        ops = graph_log.read_log(f)
+        if not ops or not os.path.exists(filename):
+            return
+        before = cache.fingerprint()
+        data = graph_log.apply_ops(load_with_snapshot(filename, read_yaml), ops)
+        write_file(filename, dump_yaml(data))
+        # Readers that miss the cache should not have to parse the new graph file
+        write_snapshot(filename, data)
+        f.truncate(0)
+        after = cache.fingerprint()
+        notify_changed(log_file)
+    log.debug('Compacted %d operations into %s', len(ops), filename)
+    cache.update(lambda graph: graph, before, after)
 
 
 def save_project(details: ProjectDetails):
-    print('_save_project: Description: %s' % details.description)
     data = details.flatten()
-    print(data)
+    log.debug('Saving project %s: %s', details.tag, data)
 
     brief_data = ProjectBrief.inflate(data).flatten()
     file_brief, file_detail = FileNames.project_info(details.tag)
-    print('Saving to file: %s' % file_brief)
-    save_yaml(file_brief, brief_data)
-
     # Remove brief fields from detail fields
     for key in brief_data:
         del data[key]
 
-    print('Saving to file: %s' % file_detail)
-    save_yaml(file_detail, data)
+    log.debug('Saving to files: %s, %s', file_brief, file_detail)
+    with project_index.transaction():
+        with write_batch():
+            save_yaml(file_brief, brief_data)
+            save_yaml(file_detail, data)
+        project_index.put(brief_data)
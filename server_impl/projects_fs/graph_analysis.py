@@ -0,0 +1,378 @@
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from server_impl.graph_utils import strongly_connected
+
+# Structural analysis of a flattened FlowGraph. Ports belong to nodes and edges connect ports, so questions about the
+# flow between nodes (order, cycles, what feeds the response) would otherwise need a scan of every port and edge for
+# each step. A GraphAnalysis indexes the graph once:
+#
+#   port -> node      - from the port's node_id, or else the node that lists the port
+#   edge -> ports     - the edge's src and dst, or else the first two ports it refers to (ordered OUT -> IN)
+#   port -> edges     - to relink the edges of a port that is added, moved or removed
+#   node -> nodes     - successors and predecessors, with the number of edges between each pair
+#
+# apply() updates the indexes for graph operations (see graph_log) instead of rebuilding them. Results are computed on
+# first use and kept until the next change. A topological order survives most edits: removals never break it, added
+# nodes go last, and an added edge only invalidates it if it points backwards.
+
+
+class GraphAnalysis:
+    def __init__(self, graph):
+        """
+        :param graph: A FlowGraph, or anything with the get() of a flattened one (a dict, a PackedGraph).
+        """
+        if hasattr(graph, 'flatten'):
+            graph = graph.flatten()
+        self.request_id: Optional[str] = graph.get('request_id')
+        self.response_id: Optional[str] = graph.get('response_id')
+        self.nodes: Set[str] = set()
+        self.succ: Dict[str, Dict[str, int]] = {}
+        self.pred: Dict[str, Dict[str, int]] = {}
+        # node -> the ports it lists, port -> the node it names (if any), port -> direction
+        self.listed: Dict[str, Tuple[str, ...]] = {}
+        self.declared: Dict[str, Optional[str]] = {}
+        self.directions: Dict[str, Optional[str]] = {}
+        self.port_node: Dict[str, str] = {}
+        # The reverse of declared and port_node
+        self.declaring: Dict[str, Set[str]] = {}
+        self.owned: Dict[str, Set[str]] = {}
+        self.edges: Dict[str, dict] = {}
+        self.edge_nodes: Dict[str, Tuple[str, str]] = {}
+        self.port_edges: Dict[str, Set[str]] = {}
+        self._clear_results()
+        self._order: Optional[List[str]] = None
+        self._position: Dict[str, int] = {}
+
+        for node_id, node in (graph.get('nodes') or {}).items():
+            self.nodes.add(node_id)
+            self.succ[node_id] = {}
+            self.pred[node_id] = {}
+            self.listed[node_id] = self._listed_ports(node)
+        for port_id, port in (graph.get('ports') or {}).items():
+            port = port if isinstance(port, dict) else {}
+            self._declare(port_id, port.get('node_id'))
+            self.directions[port_id] = port.get('direction')
+        for node_id, ports in self.listed.items():
+            for port_id in ports:
+                if port_id in self.declared:
+                    self.port_node.setdefault(port_id, node_id)
+        for port_id, node_id in self.declared.items():
+            if node_id in self.nodes:
+                self.port_node[port_id] = node_id
+        for port_id, node_id in self.port_node.items():
+            self.owned.setdefault(node_id, set()).add(port_id)
+        for edge_id, edge in (graph.get('edges') or {}).items():
+            self._add_edge(edge_id, edge if isinstance(edge, dict) else {})
+
+    def copy(self) -> 'GraphAnalysis':
+        ret = GraphAnalysis.__new__(GraphAnalysis)
+        ret.request_id = self.request_id
+        ret.response_id = self.response_id
+        ret.nodes = set(self.nodes)
+        ret.succ = {k: dict(v) for k, v in self.succ.items()}
+        ret.pred = {k: dict(v) for k, v in self.pred.items()}
+        ret.listed = dict(self.listed)
+        ret.declared = dict(self.declared)
+        ret.directions = dict(self.directions)
+        ret.port_node = dict(self.port_node)
+        ret.declaring = {k: set(v) for k, v in self.declaring.items()}
+        ret.owned = {k: set(v) for k, v in self.owned.items()}
+        ret.edges = dict(self.edges)
+        ret.edge_nodes = dict(self.edge_nodes)
+        ret.port_edges = {k: set(v) for k, v in self.port_edges.items()}
+        ret._clear_results()
+        ret._order = list(self._order) if self._order is not None else None
+        ret._position = dict(self._position)
+        return ret
+
+    # Indexes ##########################################################################################################
+
+    def _listed_ports(self, node) -> Tuple[str, ...]:
+        if not isinstance(node, dict):
+            return ()
+        return tuple(x for x in node.get('ports') or () if isinstance(x, str))
+
+    def _endpoints(self, edge_id: str, edge: dict) -> List[str]:
+        src, dst = edge.get('src'), edge.get('dst')
+        if isinstance(src, str) and isinstance(dst, str):
+            return [src, dst]
+        ports = [x for x in edge.values() if isinstance(x, str) and x != edge_id]
+        return ports[:2]
+
+    def _add_edge(self, edge_id: str, edge: dict):
+        self.edges[edge_id] = edge
+        for port_id in self._endpoints(edge_id, edge):
+            self.port_edges.setdefault(port_id, set()).add(edge_id)
+        self._link(edge_id)
+
+    def _remove_edge(self, edge_id: str):
+        edge = self.edges.pop(edge_id, None)
+        if edge is None:
+            return
+        self._unlink(edge_id)
+        for port_id in self._endpoints(edge_id, edge):
+            edges = self.port_edges.get(port_id)
+            if edges is not None:
+                edges.discard(edge_id)
+                if not edges:
+                    del self.port_edges[port_id]
+
+    def _link(self, edge_id: str):
+        ports = self._endpoints(edge_id, self.edges[edge_id])
+        if len(ports) != 2:
+            return
+        src, dst = ports
+        if self.directions.get(src) == 'IN' and self.directions.get(dst) == 'OUT':
+            src, dst = dst, src
+        u, v = self.port_node.get(src), self.port_node.get(dst)
+        if u is None or v is None:
+            return
+        self.edge_nodes[edge_id] = (u, v)
+        self.succ[u][v] = self.succ[u].get(v, 0) + 1
+        self.pred[v][u] = self.pred[v].get(u, 0) + 1
+        self._clear_results()
+        if self._order is not None and self._position[u] >= self._position[v]:
+            self._order = None
+
+    def _unlink(self, edge_id: str):
+        link = self.edge_nodes.pop(edge_id, None)
+        if link is None:
+            return
+        u, v = link
+        for adjacent, a, b in ((self.succ, u, v), (self.pred, v, u)):
+            count = adjacent[a][b] - 1
+            if count:
+                adjacent[a][b] = count
+            else:
+                del adjacent[a][b]
+        self._clear_results()
+
+    def _relink_ports(self, port_ids: Iterable[str]):
+        edge_ids = set()
+        for port_id in port_ids:
+            edge_ids |= self.port_edges.get(port_id, set())
+        for edge_id in edge_ids:
+            self._unlink(edge_id)
+            self._link(edge_id)
+
+    def _declare(self, port_id: str, node_id: Optional[str]):
+        previous = self.declared.get(port_id)
+        if previous is not None:
+            self.declaring[previous].discard(port_id)
+        self.declared[port_id] = node_id
+        if node_id is not None:
+            self.declaring.setdefault(node_id, set()).add(port_id)
+
+    def _owner(self, port_id: str) -> Optional[str]:
+        if port_id not in self.declared:
+            return None
+        node_id = self.declared[port_id]
+        if node_id in self.nodes:
+            return node_id
+        # The first node (in the order of the graph) that lists the port
+        for node_id in self.succ:
+            if node_id in self.nodes and port_id in self.listed[node_id]:
+                return node_id
+        return None
+
+    def _set_owners(self, port_ids: Iterable[str]):
+        changed = []
+        for port_id in port_ids:
+            owner = self._owner(port_id)
+            previous = self.port_node.get(port_id)
+            if owner != previous:
+                if previous is not None:
+                    self.owned[previous].discard(port_id)
+                if owner is None:
+                    del self.port_node[port_id]
+                else:
+                    self.port_node[port_id] = owner
+                    self.owned.setdefault(owner, set()).add(port_id)
+                changed.append(port_id)
+        self._relink_ports(changed)
+
+    def _put_node(self, node_id: str, node):
+        old = self.listed.get(node_id, ())
+        if node_id not in self.nodes:
+            self.nodes.add(node_id)
+            self.succ[node_id] = {}
+            self.pred[node_id] = {}
+            self._clear_results()
+            if self._order is not None:
+                if node_id in self._position:
+                    # Removed and added again, its old place may be wrong
+                    self._order = None
+                else:
+                    self._position[node_id] = len(self._order)
+                    self._order.append(node_id)
+            self.listed[node_id] = self._listed_ports(node)
+            self._set_owners(self.declaring.get(node_id, set()) | set(self.listed[node_id]))
+        else:
+            self.listed[node_id] = self._listed_ports(node)
+            self._set_owners(set(old) | set(self.listed[node_id]))
+
+    def _remove_node(self, node_id: str):
+        if node_id not in self.nodes:
+            return
+        self.nodes.discard(node_id)
+        listed = self.listed.pop(node_id, ())
+        self._set_owners(set(self.owned.get(node_id, ())) | set(listed))
+        self.owned.pop(node_id, None)
+        del self.succ[node_id]
+        del self.pred[node_id]
+        self._clear_results()
+
+    def _put_port(self, port_id: str, port):
+        port = port if isinstance(port, dict) else {}
+        self._declare(port_id, port.get('node_id'))
+        direction = port.get('direction')
+        if direction != self.directions.get(port_id):
+            self.directions[port_id] = direction
+            self._relink_ports([port_id])
+        self._set_owners([port_id])
+
+    def _remove_port(self, port_id: str):
+        if port_id not in self.declared:
+            return
+        self._declare(port_id, None)
+        del self.declared[port_id]
+        self.directions.pop(port_id, None)
+        self._set_owners([port_id])
+
+    def apply(self, ops: List[dict]) -> 'GraphAnalysis':
+        """
+        Update the indexes for graph operations (see graph_log), in place.
+        :return: self
+        :rtype: GraphAnalysis
+        """
+        for op in ops:
+            kind = op['op']
+            if kind == 'set':
+                setattr(self, op['field'], op['value'])
+                self._clear_results()
+                continue
+            section, entry_id = op['section'], op['id']
+            if section == 'nodes':
+                if kind == 'remove':
+                    self._remove_node(entry_id)
+                elif kind == 'put' or 'ports' in op['value'] or entry_id not in self.nodes:
+                    # A merge that does not touch the ports of an existing node changes nothing here
+                    self._put_node(entry_id, op['value'])
+            elif section == 'ports':
+                if kind == 'remove':
+                    self._remove_port(entry_id)
+                elif kind == 'put':
+                    self._put_port(entry_id, op['value'])
+                else:
+                    previous = {'node_id': self.declared.get(entry_id), 'direction': self.directions.get(entry_id)}
+                    self._put_port(entry_id, {**previous, **op['value']})
+            elif section == 'edges':
+                edge = self.edges.get(entry_id) if kind == 'merge' else None
+                self._remove_edge(entry_id)
+                if kind != 'remove':
+                    self._add_edge(entry_id, {**(edge or {}), **op['value']})
+        return self
+
+    # Results ##########################################################################################################
+
+    def _clear_results(self):
+        self._cycles: Optional[List[List[str]]] = None
+        self._forward: Optional[Set[str]] = None
+        self._backward: Optional[Set[str]] = None
+
+    def reachable(self, start: str, reverse: bool = False) -> Set[str]:
+        """
+        The nodes that can be reached from ``start`` by following edges (or that can reach it, if ``reverse``),
+        including ``start`` itself.
+        :rtype: Set[str]
+        """
+        if start not in self.nodes:
+            return set()
+        adjacent = self.pred if reverse else self.succ
+        seen = {start}
+        queue = deque([start])
+        while queue:
+            for v in adjacent[queue.popleft()]:
+                if v not in seen:
+                    seen.add(v)
+                    queue.append(v)
+        return seen
+
+    def from_request(self) -> Set[str]:
+        """
+        The nodes that the request node leads to.
+        """
+        if self._forward is None:
+            self._forward = self.reachable(self.request_id) if self.request_id is not None else set()
+        return self._forward
+
+    def to_response(self) -> Set[str]:
+        """
+        The nodes that feed into the response node.
+        """
+        if self._backward is None:
+            self._backward = self.reachable(self.response_id, reverse=True) if self.response_id is not None else set()
+        return self._backward
+
+    def response_reachable(self) -> bool:
+        """
+        Whether there is a path from the request node to the response node.
+        """
+        return self.response_id is not None and self.response_id in self.from_request()
+
+    def dead_nodes(self) -> Set[str]:
+        """
+        The nodes whose output never reaches the response node (not counting the request and response nodes).
+        """
+        live = self.to_response()
+        return {n for n in self.nodes if n not in live and n != self.request_id and n != self.response_id}
+
+    def cycles(self) -> List[List[str]]:
+        """
+        The groups of nodes that form cycles (strongly connected components with more than one node, or with an edge
+        from a node to itself), each in sorted order.
+        """
+        if self._cycles is None:
+            components, cyclic = strongly_connected(self.succ)
+            groups: Dict[int, List[str]] = {}
+            for node_id in cyclic:
+                groups.setdefault(components[node_id], []).append(node_id)
+            self._cycles = sorted(sorted(group) for group in groups.values())
+        return self._cycles
+
+    def has_cycles(self) -> bool:
+        if self._order is not None:
+            return False
+        return bool(self.cycles())
+
+    def topological_order(self) -> Optional[List[str]]:
+        """
+        The nodes ordered so that every edge points forwards (Kahn's algorithm, ties in the order the nodes were
+        added).
+        :return: The order, or None if the graph has cycles.
+        :rtype: Optional[List[str]]
+        """
+        if self._order is None:
+            indegree = {n: len(self.pred[n]) for n in self.nodes}
+            queue = deque(n for n in self._insertion_order() if not indegree[n])
+            order = []
+            while queue:
+                u = queue.popleft()
+                order.append(u)
+                for v in self.succ[u]:
+                    indegree[v] -= 1
+                    if not indegree[v]:
+                        queue.append(v)
+            if len(order) != len(self.nodes):
+                return None
+            self._order = order
+            self._position = {n: i for i, n in enumerate(order)}
+        if len(self._order) != len(self.nodes):
+            # Removed nodes are dropped lazily
+            self._order = [n for n in self._order if n in self.nodes]
+            self._position = {n: i for i, n in enumerate(self._order)}
+        return list(self._order)
+
+    def _insertion_order(self) -> List[str]:
+        return list(self.succ)
@@ -0,0 +1,208 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Callable, Hashable, IO, Iterator, List, Optional, Set
+
+from server_impl import metrics
+from server_impl.errors import EBadRequest
+from server_impl.projects_fs.graph_views import ID_FIELDS, SECTIONS
+from server_impl.projects_fs.writes import fsync_enabled
+
+log = logging.getLogger(__name__)
+
+# Graphs are edited with deltas. Every PATCH appends its operations to a log next to the graph, and readers get the
+# graph with the log replayed on top, so an edit costs as much as the delta rather than a rewrite of the whole graph.
+# Once a log is large enough, a background thread compacts it into the graph file.
+#
+#   <mod>-graph.yaml      - The graph as of the last compaction
+#   <mod>-graph.log.yaml  - The operations since then. Each line is a YAML list item holding one operation in JSON
+#                           (flow) style, so the file stays valid YAML. A torn last line (a crash during an append) is
+#                           ignored, and cut off by the next append.
+#
+# Operations:
+#   {"op": "put", "section": "nodes", "id": "n3", "value": {...}}      - Add or replace an entry
+#   {"op": "merge", "section": "layouts", "id": "n3", "value": {...}}  - Set some fields of an entry (creating it)
+#   {"op": "remove", "section": "edges", "id": "e7"}                   - Remove an entry if it exists
+#   {"op": "set", "field": "request_id", "value": "n1"}                - Set request_id or response_id
+#
+# Every operation sets absolute values, so replaying a log on a graph that already contains it gives the same graph.
+# That makes compaction safe to interrupt: the graph file is replaced first, and the log is emptied after.
+#
+# Appends, compactions and reads of a graph take an flock on its log (exclusive for the writers, shared for readers).
+#
+#   GRAPH_LOG_COMPACT_BYTES=65536  - Compact a log once it is this large
+
+OPERATIONS = ('put', 'merge', 'remove', 'set')
+
+compact_bytes = int(os.getenv('GRAPH_LOG_COMPACT_BYTES', '65536'))
+
+
+def validate_ops(ops) -> List[dict]:
+    """
+    Check the operations of a PATCH request.
+    :return: The operations
+    :rtype: List[dict]
+    """
+    if not isinstance(ops, list):
+        raise EBadRequest('Expected a list of graph operations')
+    for i, op in enumerate(ops):
+        if not isinstance(op, dict) or op.get('op') not in OPERATIONS:
+            raise EBadRequest("Operation %d: 'op' must be one of: %s" % (i, ', '.join(OPERATIONS)))
+        if op['op'] == 'set':
+            if op.get('field') not in ID_FIELDS:
+                raise EBadRequest("Operation %d: 'field' must be one of: %s" % (i, ', '.join(ID_FIELDS)))
+            continue
+        if op.get('section') not in SECTIONS:
+            raise EBadRequest("Operation %d: 'section' must be one of: %s" % (i, ', '.join(SECTIONS)))
+        if not isinstance(op.get('id'), str) or not op['id']:
+            raise EBadRequest("Operation %d: 'id' is required" % i)
+        if op['op'] != 'remove' and not isinstance(op.get('value'), dict):
+            raise EBadRequest("Operation %d: 'value' must be an object" % i)
+    return ops
+
+
+def apply_ops(graph: dict, ops: List[dict]) -> dict:
+    """
+    Replay operations on a flattened graph. The graph is not modified (it may be shared with concurrent readers), only
+    the sections that are changed are copied.
+    :rtype: dict
+    """
+    ret = dict(graph)
+    copied: Set[str] = set()
+    for op in ops:
+        kind = op['op']
+        if kind == 'set':
+            ret[op['field']] = op['value']
+            continue
+        section = op['section']
+        if section not in copied:
+            ret[section] = dict(ret.get(section) or {})
+            copied.add(section)
+        entries = ret[section]
+        if kind == 'put':
+            entries[op['id']] = op['value']
+        elif kind == 'merge':
+            entries[op['id']] = {**(entries.get(op['id']) or {}), **op['value']}
+        else:
+            entries.pop(op['id'], None)
+    return ret
+
+
+def encode_ops(ops: List[dict]) -> bytes:
+    return ''.join('- %s\n' % json.dumps(op, separators=(',', ':')) for op in ops).encode()
+
+
+def read_log(f: IO) -> List[dict]:
+    f.seek(0)
+    ops = []
+    size = 0
+    for line in f:
+        if not line.endswith(b'\n'):
+            log.warning('Ignoring a torn operation at the end of %s', f.name)
+            break
+        size += len(line)
+        try:
+            ops.append(json.loads(line[2:]))
+        except ValueError:
+            log.warning('Ignoring the rest of %s after an unreadable operation', f.name)
+            break
+    metrics.bytes_read.inc(size)
+    return ops
+
+
+def append(f: IO, ops: List[dict]) -> int:
+    """
+    Append operations to an open log.
+    :return: The size of the log afterwards
+    :rtype: int
+    """
+    end = f.seek(0, os.SEEK_END)
+    if end:
+        f.seek(end - 1)
+        if f.read(1) != b'\n':
+            # Cut off a torn operation, or everything appended after it would be unreadable
+            f.seek(0)
+            f.truncate(f.read().rfind(b'\n') + 1)
+    content = encode_ops(ops)
+    f.write(content)
+    f.flush()
+    if fsync_enabled:
+        os.fsync(f.fileno())
+    metrics.bytes_written.inc(len(content))
+    return f.tell()
+
+
+@contextmanager
+def locked(filename: str, exclusive: bool) -> Iterator[Optional[IO]]:
+    """
+    Open a log and lock it. A writer (exclusive) creates the log, a reader gets None if there is none.
+    """
+    try:
+        f = open(filename, 'a+b' if exclusive else 'rb')
+    except FileNotFoundError:
+        yield None
+        return
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield f
+    finally:
+        # Closing the file releases the lock
+        f.close()
+
+
+class Compactor:
+    """
+    Runs compactions on a background thread. A log that is already waiting to be compacted is not queued again.
+    """
+    def __init__(self):
+        self._queue: 'queue.Queue[Hashable]' = queue.Queue()
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='graph-compactor', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            with self._lock:
+                job = self._jobs.pop(key)
+            try:
+                job()
+            except Exception as e:
+                log.warning('Compacting %s failed: %s', key, e)
+            finally:
+                self._queue.task_done()
+
+    def schedule(self, key: Hashable, job: Callable[[], None]):
+        with self._lock:
+            queued = key in self._jobs
+            self._jobs[key] = job
+        if not queued:
+            self._queue.put(key)
+
+    def flush(self):
+        self._queue.join()
+
+
+_compactor: Optional[Compactor] = None
+_compactor_lock = threading.Lock()
+
+
+def compact_later(key: Hashable, job: Callable[[], None]):
+    global _compactor
+    if _compactor is None:
+        with _compactor_lock:
+            if _compactor is None:
+                _compactor = Compactor()
+    _compactor.schedule(key, job)
+
+
+def flush_compactions():
+    if _compactor is not None:
+        _compactor.flush()
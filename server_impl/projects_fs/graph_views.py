@@ -0,0 +1,97 @@
+from typing import Iterable, List, Optional, Sequence, Set
+
+from server_impl.errors import EBadRequest
+
+# Partial views of a flattened FlowGraph, for clients that only need some sections or some nodes (e.g. the layouts,
+# or the nodes in the editor's viewport). The selected parts are taken from the cached graph as they are, so nothing
+# outside of the selection is copied or serialized.
+
+ID_FIELDS = ('request_id', 'response_id')
+SECTIONS = ('ports', 'nodes', 'edges', 'plugs', 'layouts', 'validators', 'schemas')
+# Sections that are shared definitions rather than parts of particular nodes
+SHARED_SECTIONS = ('schemas',)
+
+
+def entry_refs(entry) -> Set[str]:
+    """
+    The ids that an entry may refer to: its top level string values, and the strings in its top level lists.
+    """
+    ret = set()
+    if not isinstance(entry, dict):
+        return ret
+    for value in entry.values():
+        if isinstance(value, str):
+            ret.add(value)
+        elif isinstance(value, list):
+            ret.update(x for x in value if isinstance(x, str))
+    return ret
+
+
+def parse_list(value: Optional[str]) -> Optional[List[str]]:
+    if value is None:
+        return None
+    return [x for x in value.split(',') if x]
+
+
+def check_fields(fields: Optional[Iterable[str]]) -> Sequence[str]:
+    """
+    :return: The requested sections, or all of them if ``fields`` is None.
+    :rtype: Sequence[str]
+    """
+    if fields is None:
+        return SECTIONS
+    fields = list(fields)
+    unknown = [f for f in fields if f not in SECTIONS]
+    if unknown:
+        raise EBadRequest("Unknown graph section '%s'. Use any of: %s" % (unknown[0], ', '.join(SECTIONS)))
+    return fields
+
+
+def filter_section(section: Optional[dict], node_refs: Set[str], selected: Set[str]) -> dict:
+    """
+    The entries of a section that the selected nodes refer to, or that refer to a selected node or port.
+    """
+    return {k: v for k, v in (section or {}).items() if k in node_refs or not selected.isdisjoint(entry_refs(v))}
+
+
+def select_graph(graph: dict, fields: Iterable[str] = None, node_ids: Iterable[str] = None) -> dict:
+    """
+    Select parts of a flattened graph. The request and response ids are always included.
+    :param graph: The flattened graph.
+    :type graph: dict
+    :param fields: The sections to include. All of them if None.
+    :type fields: Iterable[str]
+    :param node_ids: Only include these nodes, and the entries of the other sections that belong to them (ports of the
+    nodes, edges and plugs on those ports, their layouts, ...). Shared sections (schemas) are not filtered.
+    :type node_ids: Iterable[str]
+    :rtype: dict
+    """
+    fields = check_fields(fields)
+    ret = {k: graph.get(k) for k in ID_FIELDS}
+    if node_ids is None:
+        for f in fields:
+            ret[f] = graph.get(f)
+        return ret
+
+    all_nodes = graph.get('nodes') or {}
+    nodes = {n: all_nodes[n] for n in node_ids if n in all_nodes}
+    selected = set(nodes)
+    # Nodes list their ports and layout; ports also point back at their node
+    node_refs = set()
+    for node in nodes.values():
+        node_refs |= entry_refs(node)
+    ports = {}
+    for port_id, port in (graph.get('ports') or {}).items():
+        if port_id in node_refs or (isinstance(port, dict) and port.get('node_id') in selected):
+            ports[port_id] = port
+    selected |= set(ports)
+    for f in fields:
+        if f == 'nodes':
+            ret[f] = nodes
+        elif f == 'ports':
+            ret[f] = ports
+        elif f in SHARED_SECTIONS:
+            ret[f] = graph.get(f)
+        else:
+            ret[f] = filter_section(graph.get(f), node_refs, selected)
+    return ret
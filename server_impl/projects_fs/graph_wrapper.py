@@ -1,3 +1,4 @@
+import logging
 import os
 
 from openapi_server.models import FlowGraph, Module, RequestNode, UrlSegment, Port, PortDirection, PortType, \
@@ -8,6 +9,8 @@ from server_impl.errors.custom_errors import ENotFound
 from server_impl.projects_fs.fs_internals import read_yaml
 import yaml
 
+log = logging.getLogger(__name__)
+
 
 class ObjectView(object):
     def __init__(self, data: dict):
@@ -82,7 +85,7 @@ def build_request(op: OperationObject):
     ret = RequestNode()
 
 def build_graph(specfile: str, module: Module) -> FlowGraph:
-    print('TRACE')
+    log.debug('Building graph for %s', module.tag)
     raw: dict = read_yaml(specfile)
     paths_object = raw['paths']
 
@@ -0,0 +1,226 @@
+import base64
+import bisect
+import datetime
+import json
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from server_impl.errors import EBadRequest
+
+# Sorted, filtered and paginated views over the raw (not inflated) records of a list, e.g. the project index or the
+# modules of one project. A SortedIndex keeps (sort value, id) pairs in order, so a page is found with a binary search
+# on the cursor, and only the records on the page are inflated into models.
+#
+# A cursor is the (sort value, id) of the last entry of the previous page, so pages stay consistent while entries are
+# added or removed in between requests.
+
+SortKey = Tuple[str, str]
+
+
+def sort_value(value) -> str:
+    """
+    Normalize a field for sorting: case-insensitive for text, ISO format for dates, and missing values first.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if hasattr(value, 'value'):
+        # Enums, e.g. MethodType
+        value = value.value
+    return str(value).lower()
+
+
+class Field:
+    def __init__(self, *names: str):
+        """
+        A field of a raw record. The generated models may flatten a field under its attribute name or its JSON name,
+        so every alternative is tried.
+        :param names: The keys the field may be stored under.
+        """
+        self.names = names
+
+    def get(self, record: dict):
+        for name in self.names:
+            if name in record:
+                return record[name]
+        return None
+
+
+class SortedIndex:
+    def __init__(self, field: Field):
+        """
+        The ids of a set of records in order of one field, maintained incrementally.
+        :param field: The field to sort by. Ties are broken by id.
+        :type field: Field
+        """
+        self.field = field
+        self._keys: List[SortKey] = []
+        self._by_id: Dict[str, SortKey] = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def put(self, rid: str, record: dict):
+        self.discard(rid)
+        key = (sort_value(self.field.get(record)), rid)
+        bisect.insort(self._keys, key)
+        self._by_id[rid] = key
+
+    def discard(self, rid: str):
+        key = self._by_id.pop(rid, None)
+        if key is not None:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def key_of(self, rid: str) -> Optional[SortKey]:
+        return self._by_id.get(rid)
+
+    def scan(self, after: Optional[SortKey] = None, descending: bool = False,
+             start: Optional[str] = None) -> Iterator[SortKey]:
+        """
+        Iterate over the keys, starting after the cursor ``after`` or, if there is none, at the first key with a sort
+        value of at least ``start``.
+        """
+        keys = self._keys
+        if descending:
+            if after is not None:
+                i = bisect.bisect_left(keys, after)
+            else:
+                i = len(keys)
+            for j in range(i - 1, -1, -1):
+                yield keys[j]
+        else:
+            if after is not None:
+                i = bisect.bisect_right(keys, after)
+            elif start is not None:
+                i = bisect.bisect_left(keys, (start, ''))
+            else:
+                i = 0
+            for j in range(i, len(keys)):
+                yield keys[j]
+
+
+def encode_cursor(key: SortKey) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> SortKey:
+    try:
+        value, rid = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return str(value), str(rid)
+    except (ValueError, TypeError):
+        raise EBadRequest('Invalid cursor')
+
+
+class ListQuery:
+    def __init__(self, sort: str, descending: bool = False, limit: int = None, cursor: str = None,
+                 prefix: str = None, filters: Dict[str, Sequence[str]] = None):
+        """
+        :param sort: The name of the field to sort by.
+        :type sort: str
+        :param descending: Reverse the order.
+        :type descending: bool
+        :param limit: The maximum number of entries on a page. None returns everything after the cursor.
+        :type limit: int
+        :param cursor: The next_cursor of the previous page.
+        :type cursor: str
+        :param prefix: Only include entries whose name starts with this (case-insensitive).
+        :type prefix: str
+        :param filters: Only include entries where the field has one of the given values (case-insensitive).
+        :type filters: Dict[str, Sequence[str]]
+        """
+        self.sort = sort
+        self.descending = descending
+        self.limit = limit
+        self.cursor = cursor
+        self.prefix = prefix.lower() if prefix else None
+        self.filters = {k: {sort_value(v) for v in values} for k, values in (filters or {}).items() if values}
+
+
+class Page:
+    def __init__(self, items: list, next_cursor: Optional[str]):
+        self.items = items
+        self.next_cursor = next_cursor
+
+
+class Listing:
+    """
+    Records keyed by id, with a SortedIndex per sortable field. The indexes are built on first use and then kept up to
+    date by put() and discard().
+    """
+    def __init__(self, fields: Dict[str, Field], name_field: str):
+        """
+        :param fields: The fields that can be sorted or filtered by, by their public name.
+        :type fields: Dict[str, Field]
+        :param name_field: The field matched by ListQuery.prefix.
+        :type name_field: str
+        """
+        self.fields = fields
+        self.name_field = name_field
+        self.records: Dict[str, dict] = {}
+        self._indexes: Dict[str, SortedIndex] = {}
+
+    def put(self, rid: str, record: dict):
+        self.records[rid] = record
+        for index in self._indexes.values():
+            index.put(rid, record)
+
+    def discard(self, rid: str):
+        if self.records.pop(rid, None) is not None:
+            for index in self._indexes.values():
+                index.discard(rid)
+
+    def reset(self):
+        self.records = {}
+        self._indexes = {}
+
+    def index(self, sort: str) -> SortedIndex:
+        index = self._indexes.get(sort)
+        if index is None:
+            field = self.fields.get(sort)
+            if field is None:
+                raise EBadRequest("Can not sort by '%s'. Use one of: %s" % (sort, ', '.join(sorted(self.fields))))
+            index = SortedIndex(field)
+            for rid, record in self.records.items():
+                index.put(rid, record)
+            self._indexes[sort] = index
+        return index
+
+    def _matches(self, record: dict, query: ListQuery) -> bool:
+        if query.prefix is not None:
+            if not sort_value(self.fields[self.name_field].get(record)).startswith(query.prefix):
+                return False
+        for name, allowed in query.filters.items():
+            if sort_value(self.fields[name].get(record)) not in allowed:
+                return False
+        return True
+
+    def page(self, query: ListQuery, inflate: Callable[[dict], object]) -> Page:
+        """
+        Find one page of entries. Only the records on the page are passed to ``inflate``.
+        :type query: ListQuery
+        :param inflate: Builds the model for a raw record.
+        :type inflate: (dict) -> object
+        :rtype: Page
+        """
+        for name in query.filters:
+            if name not in self.fields:
+                raise EBadRequest("Can not filter by '%s'" % name)
+        index = self.index(query.sort)
+        after = decode_cursor(query.cursor) if query.cursor else None
+        # Sorted by name, a prefix is a contiguous range
+        ranged = query.prefix is not None and query.sort == self.name_field and not query.descending
+        start = query.prefix if ranged else None
+        selected = []
+        last = None
+        for key in index.scan(after, query.descending, start):
+            if ranged and not key[0].startswith(query.prefix):
+                break
+            record = self.records[key[1]]
+            if not self._matches(record, query):
+                continue
+            if query.limit is not None and len(selected) == query.limit:
+                # There is at least one more entry, so hand out a cursor
+                return Page([inflate(dict(r)) for r in selected], encode_cursor(last))
+            selected.append(record)
+            last = key
+        return Page([inflate(dict(r)) for r in selected], None)
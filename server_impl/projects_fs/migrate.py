@@ -0,0 +1,63 @@
+import argparse
+import os
+import sys
+from typing import List
+
+from server_impl.projects_fs.file_names import FileNames
+from server_impl.projects_fs.storage import StorageEngine, make_storage, BACKEND_FS, BACKEND_SQLITE
+
+
+def migrate(source: StorageEngine, dest: StorageEngine, batch_size: int = 500) -> dict:
+    """
+    Copy every project, module and graph from one storage backend to another. Existing entries in ``dest`` with the
+    same tags are replaced, so an interrupted migration can simply be run again.
+    :param batch_size: The number of modules written per transaction.
+    :type batch_size: int
+    :return: Counts of what was copied.
+    :rtype: dict
+    """
+    projects = modules = 0
+    for brief in source.list_projects():
+        tag = brief.tag
+        details = source.project_details(tag)
+        if details is None:
+            continue
+        # The project directory holds the spec file and the upload state with either backend
+        os.makedirs(FileNames.project_dir(tag), exist_ok=True)
+        dest.save_project(details)
+        batch = {}
+        for module in source.list_modules(tag):
+            graph = source.load_graph_data(tag, module.tag)
+            batch[module.tag] = (dest.encode(module.flatten()), dest.encode(graph))
+            if len(batch) >= batch_size:
+                dest.save_modules(tag, batch)
+                modules += len(batch)
+                batch = {}
+        if batch:
+            dest.save_modules(tag, batch)
+            modules += len(batch)
+        projects += 1
+    return {'projects': projects, 'modules': modules}
+
+
+def main(argv: List[str]):
+    """
+    Copy all projects between storage backends, e.g.:
+
+        python -m server_impl.projects_fs.migrate --from fs --to sqlite
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--from', dest='source', choices=(BACKEND_FS, BACKEND_SQLITE), default=BACKEND_FS)
+    parser.add_argument('--to', dest='dest', choices=(BACKEND_FS, BACKEND_SQLITE), default=BACKEND_SQLITE)
+    args = parser.parse_args(argv)
+    if args.source == args.dest:
+        parser.error('--from and --to must be different backends')
+
+    counts = migrate(make_storage(args.source), make_storage(args.dest))
+    print('Copied %d projects and %d modules from %s to %s' % (counts['projects'], counts['modules'], args.source,
+                                                               args.dest))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
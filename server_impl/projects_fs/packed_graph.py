@@ -0,0 +1,392 @@
+import sys
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from openapi_server.models import FlowGraph
+from server_impl.projects_fs.graph_analysis import GraphAnalysis
+from server_impl.projects_fs.graph_log import apply_ops
+from server_impl.projects_fs.graph_views import ID_FIELDS, SECTIONS, SHARED_SECTIONS, check_fields, filter_section, \
+    select_graph, entry_refs
+
+# The in-memory form of a cached graph. A flattened graph is a dict per port, node, edge, ... which for big graphs
+# costs far more memory than the data itself, and inflating it into the openapi_server models costs even more. A
+# PackedGraph keeps each section as a Table of columns instead:
+#
+#   - Entry ids and string values are interned, so an id that appears as a key and in references is stored once.
+#   - A column with few distinct values (port types, directions, flags, node types) is an array of one byte codes.
+#   - Other columns are lists of values, lists of ids are stored as tuples.
+#
+# The graph is only converted back to dicts for a response, and then only the parts that are sent. The FlowGraph model
+# is built when the whole graph is asked for, and kept with the graph until it changes.
+# Shared sections (schemas) and sections that are not maps of entries are kept as they are.
+
+TABLE_SECTIONS = tuple(s for s in SECTIONS if s not in SHARED_SECTIONS)
+
+
+class _Absent:
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<absent>'
+
+
+# Marks a row that does not have a value in a column (None is a value)
+ABSENT = _Absent()
+
+
+def _compact(value):
+    if type(value) is str:
+        return sys.intern(value)
+    if type(value) is list and all(type(x) is str for x in value):
+        return tuple(sys.intern(x) for x in value)
+    return value
+
+
+class EnumColumn:
+    """
+    A column with at most MAX_VALUES distinct values, stored as one byte per row. Code 0 is ABSENT.
+    """
+    __slots__ = ('codes', 'values', 'lookup')
+    MAX_VALUES = 255
+
+    def __init__(self, size: int = 0):
+        self.codes = array('B', bytes(size))
+        self.values = [ABSENT]
+        self.lookup: Dict[Tuple[type, object], int] = {}
+
+    def raw(self, row: int):
+        return self.values[self.codes[row]]
+
+    get = raw
+
+    def append(self):
+        self.codes.append(0)
+
+    def clear(self, row: int):
+        self.codes[row] = 0
+
+    def set(self, row: int, value) -> bool:
+        """
+        :return: False if the value does not fit this column, it has to be widened first.
+        """
+        # Keyed by type as well, True == 1 but they must stay apart
+        try:
+            code = self.lookup.get((type(value), value))
+        except TypeError:
+            return False
+        if code is None:
+            if len(self.values) > self.MAX_VALUES:
+                return False
+            value = _compact(value)
+            code = len(self.values)
+            self.values.append(value)
+            self.lookup[(type(value), value)] = code
+        self.codes[row] = code
+        return True
+
+    def rows_referring(self, ids: Set[str]) -> List[int]:
+        codes = {code for code, value in enumerate(self.values) if type(value) is str and value in ids}
+        if not codes:
+            return []
+        return [row for row, code in enumerate(self.codes) if code in codes]
+
+    def widen(self) -> 'ListColumn':
+        ret = ListColumn()
+        ret.values = [self.values[code] for code in self.codes]
+        return ret
+
+    def copy(self) -> 'EnumColumn':
+        ret = EnumColumn()
+        ret.codes = array('B', self.codes)
+        ret.values = list(self.values)
+        ret.lookup = dict(self.lookup)
+        return ret
+
+
+class ListColumn:
+    """
+    A column of arbitrary values.
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, size: int = 0):
+        self.values = [ABSENT] * size
+
+    def raw(self, row: int):
+        return self.values[row]
+
+    def get(self, row: int):
+        value = self.values[row]
+        return list(value) if type(value) is tuple else value
+
+    def append(self):
+        self.values.append(ABSENT)
+
+    def clear(self, row: int):
+        self.values[row] = ABSENT
+
+    def set(self, row: int, value) -> bool:
+        self.values[row] = _compact(value)
+        return True
+
+    def rows_referring(self, ids: Set[str]) -> List[int]:
+        """
+        The rows whose value is one of ``ids``, or a list that contains one of them.
+        """
+        return [row for row, value in enumerate(self.values)
+                if (type(value) is str and value in ids) or
+                (type(value) is tuple and not ids.isdisjoint(value)) or
+                (type(value) is list and not ids.isdisjoint(x for x in value if type(x) is str))]
+
+    def copy(self) -> 'ListColumn':
+        ret = ListColumn()
+        ret.values = list(self.values)
+        return ret
+
+
+class Table:
+    """
+    The entries of one section (id -> dict), stored by column. Removed entries leave an empty row behind until the table
+    is repacked.
+    """
+    __slots__ = ('ids', 'rows', 'columns')
+
+    def __init__(self):
+        self.ids: List[Optional[str]] = []
+        self.rows: Dict[str, int] = {}
+        self.columns: Dict[str, object] = {}
+
+    @classmethod
+    def pack(cls, entries: Iterable[Tuple[str, dict]]) -> 'Table':
+        ret = cls()
+        for entry_id, entry in entries:
+            ret.put(entry_id, entry)
+        return ret
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, entry_id: str):
+        return entry_id in self.rows
+
+    def put(self, entry_id: str, entry: dict):
+        row = self.rows.get(entry_id)
+        if row is None:
+            row = len(self.ids)
+            entry_id = sys.intern(entry_id)
+            self.ids.append(entry_id)
+            self.rows[entry_id] = row
+            for column in self.columns.values():
+                column.append()
+        else:
+            for column in self.columns.values():
+                column.clear(row)
+        for key, value in entry.items():
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[sys.intern(key)] = EnumColumn(len(self.ids))
+            if not column.set(row, value):
+                column = self.columns[key] = column.widen()
+                column.set(row, value)
+
+    def remove(self, entry_id: str):
+        row = self.rows.pop(entry_id, None)
+        if row is None:
+            return
+        self.ids[row] = None
+        for column in self.columns.values():
+            column.clear(row)
+
+    def entry(self, row: int) -> dict:
+        ret = {}
+        for key, column in self.columns.items():
+            value = column.get(row)
+            if value is not ABSENT:
+                ret[key] = value
+        return ret
+
+    def get(self, entry_id: str) -> Optional[dict]:
+        row = self.rows.get(entry_id)
+        return None if row is None else self.entry(row)
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        for row, entry_id in enumerate(self.ids):
+            if entry_id is not None:
+                yield entry_id, self.entry(row)
+
+    def to_dict(self) -> dict:
+        return dict(self.items())
+
+    def select(self, entry_ids: Iterable[str]) -> dict:
+        ret = {}
+        for entry_id in entry_ids:
+            row = self.rows.get(entry_id)
+            if row is not None:
+                ret[entry_id] = self.entry(row)
+        return ret
+
+    def referring(self, node_refs: Set[str], selected: Set[str]) -> dict:
+        """
+        Like graph_views.filter_section. Columns are scanned for the selected ids, only the matching rows are unpacked.
+        """
+        rows = {self.rows[entry_id] for entry_id in node_refs if entry_id in self.rows}
+        for column in self.columns.values():
+            rows.update(column.rows_referring(selected))
+        return {self.ids[row]: self.entry(row) for row in sorted(rows)}
+
+    def rows_where(self, key: str, ids: Set[str]) -> List[int]:
+        column = self.columns.get(key)
+        return [] if column is None else column.rows_referring(ids)
+
+    def copy(self) -> 'Table':
+        if len(self.ids) > 2 * len(self.rows) + 16:
+            # Mostly removed rows, repack instead
+            return Table.pack(self.items())
+        ret = Table()
+        ret.ids = list(self.ids)
+        ret.rows = dict(self.rows)
+        ret.columns = {key: column.copy() for key, column in self.columns.items()}
+        return ret
+
+
+class PackedGraph:
+    """
+    A flattened graph with its sections packed into Tables. Instances are not modified once they are cached, apply()
+    returns a new graph that shares the unchanged sections.
+    """
+    __slots__ = ('plain', 'tables', '_analysis', '_pending', '_model')
+
+    # Past this many operations, rebuilding the analysis is cheaper than replaying them
+    MAX_PENDING_OPS = 4096
+
+    def __init__(self, plain: dict, tables: Dict[str, Table]):
+        # Everything that is not a table: the request and response ids, shared sections, unknown fields
+        self.plain = plain
+        self.tables = tables
+        self._analysis: Optional[GraphAnalysis] = None
+        # (the analysis of an earlier version, the operations since then)
+        self._pending: Optional[Tuple[GraphAnalysis, List[dict]]] = None
+        self._model: Optional[FlowGraph] = None
+
+    @classmethod
+    def pack(cls, graph: dict) -> 'PackedGraph':
+        plain = {}
+        tables = {}
+        for key, value in graph.items():
+            if key in TABLE_SECTIONS and isinstance(value, dict) and \
+                    all(isinstance(k, str) and isinstance(v, dict) for k, v in value.items()):
+                tables[key] = Table.pack(value.items())
+            else:
+                plain[key] = value
+        return cls(plain, tables)
+
+    def get(self, key: str, default=None):
+        table = self.tables.get(key)
+        if table is not None:
+            return table.to_dict()
+        return self.plain.get(key, default)
+
+    def _keys(self) -> List[str]:
+        keys = [k for k in ID_FIELDS if k in self.plain]
+        keys += [k for k in SECTIONS if k in self.tables or k in self.plain]
+        keys += [k for k in self.plain if k not in keys]
+        return keys
+
+    def to_dict(self) -> dict:
+        """
+        The flattened graph, e.g. for FlowGraph.inflate.
+        """
+        return {k: self.get(k) for k in self._keys()}
+
+    def model(self) -> FlowGraph:
+        """
+        The whole graph as a FlowGraph. It is inflated on first use and shared, it must not be modified.
+        """
+        if self._model is None:
+            self._model = FlowGraph.inflate(self.to_dict())
+        return self._model
+
+    def select(self, fields: Iterable[str] = None, node_ids: Iterable[str] = None) -> dict:
+        """
+        Same as graph_views.select_graph, but only the selected entries are unpacked.
+        """
+        fields = check_fields(fields)
+        ret = {k: self.plain.get(k) for k in ID_FIELDS}
+        if node_ids is None:
+            for f in fields:
+                ret[f] = self.get(f)
+            return ret
+        nodes_table = self.tables.get('nodes')
+        ports_table = self.tables.get('ports')
+        if nodes_table is None or ports_table is None:
+            return select_graph(self.to_dict(), fields, node_ids)
+
+        nodes = nodes_table.select(node_ids)
+        selected = set(nodes)
+        node_refs = set()
+        for node in nodes.values():
+            node_refs |= entry_refs(node)
+        ports = ports_table.select(node_refs)
+        for row in ports_table.rows_where('node_id', selected):
+            port_id = ports_table.ids[row]
+            if port_id not in ports:
+                ports[port_id] = ports_table.entry(row)
+        selected |= set(ports)
+        for f in fields:
+            if f == 'nodes':
+                ret[f] = nodes
+            elif f == 'ports':
+                ret[f] = ports
+            elif f in SHARED_SECTIONS:
+                ret[f] = self.plain.get(f)
+            elif f in self.tables:
+                ret[f] = self.tables[f].referring(node_refs, selected)
+            else:
+                ret[f] = filter_section(self.plain.get(f), node_refs, selected)
+        return ret
+
+    def analysis(self) -> GraphAnalysis:
+        """
+        The structure of the graph (see graph_analysis). It is built on first use. Once a graph has one, the graphs
+        that apply() derives from it update a copy with their operations instead of building their own.
+        The result is shared and must not be modified.
+        """
+        if self._analysis is None:
+            pending = self._pending
+            if pending is not None:
+                base, ops = pending
+                self._analysis = base.copy().apply(ops)
+            else:
+                self._analysis = GraphAnalysis(self)
+            self._pending = None
+        return self._analysis
+
+    def apply(self, ops: List[dict]) -> 'PackedGraph':
+        """
+        Replay graph operations (see graph_log). Only the tables that change are copied.
+        """
+        tables = dict(self.tables)
+        copied = set()
+        other = []
+        for op in ops:
+            table = tables.get(op.get('section'))
+            if op['op'] == 'set' or table is None:
+                other.append(op)
+                continue
+            if op['section'] not in copied:
+                table = tables[op['section']] = table.copy()
+                copied.add(op['section'])
+            if op['op'] == 'put':
+                table.put(op['id'], op['value'])
+            elif op['op'] == 'merge':
+                table.put(op['id'], {**(table.get(op['id']) or {}), **op['value']})
+            else:
+                table.remove(op['id'])
+        # The other sections are plain, and independent of the tables, so their operations can be applied afterwards
+        ret = PackedGraph(apply_ops(self.plain, other) if other else self.plain, tables)
+        analysis, pending = self._analysis, self._pending
+        if analysis is not None:
+            ret._pending = (analysis, list(ops))
+        elif pending is not None and len(pending[1]) + len(ops) <= self.MAX_PENDING_OPS:
+            ret._pending = (pending[0], pending[1] + ops)
+        return ret
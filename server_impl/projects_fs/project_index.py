@@ -0,0 +1,346 @@
+import datetime
+import fcntl
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from openapi_server.models import ProjectBrief
+from server_impl.projects_fs.caches import make_etag
+from server_impl.projects_fs.listing import Field, ListQuery, Listing, Page
+
+# The project index is an append-only journal of JSON records, one per line:
+#
+#   {"op": "put", "brief": {...}}      - Add or replace a project (the content of its brief.yaml)
+#   {"op": "del", "tag": "..."}        - Remove a project
+#   {"op": "reserve", "tag": "..."}    - A name in PROJECT_DIR that is not a project, but can not be used as a tag
+#
+# Each process replays the journal into memory and afterwards only reads the lines appended since its last look, so a
+# list or a tag check costs one stat() when nothing changed. Writers hold an exclusive flock on the lock file. Once the
+# journal holds many more records than live entries, it is compacted by writing a new file and renaming it over the
+# old one. Readers notice the new inode and replay it from the start.
+
+
+def json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'$dt': obj.isoformat()}
+    raise TypeError('Can not encode %s in the project index' % type(obj))
+
+
+def json_object_hook(obj: dict):
+    if len(obj) == 1 and '$dt' in obj:
+        return datetime.datetime.fromisoformat(obj['$dt'])
+    return obj
+
+
+# The fields the project list can be sorted and filtered by. Briefs may hold a field under its attribute or JSON name.
+PROJECT_FIELDS = {
+    'tag': Field('tag'),
+    'name': Field('name'),
+    'last_modified': Field('last_modified', 'lastModified'),
+}
+
+
+class ProjectIndex:
+    def __init__(self, filename: str, scanner: Callable[[], Tuple[List[dict], List[str]]],
+                 compact_ratio: float = 2.0, compact_min: int = 64):
+        """
+        :param filename: The journal file.
+        :type filename: str
+        :param scanner: Scans the project directory, returning (briefs, reserved). Used to build a missing index.
+        :type scanner: () -> (List[dict], List[str])
+        :param compact_ratio: Compact once there are this many records per live entry...
+        :type compact_ratio: float
+        :param compact_min: ...and at least this many records in total.
+        :type compact_min: int
+        """
+        self.filename = filename
+        self.scanner = scanner
+        self.lock_filename = filename + '.lock'
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self._mutex = threading.RLock()
+        self._lock_file = None
+        self._depth = 0
+        self._entries: Dict[str, dict] = {}
+        self._reserved: Set[str] = set()
+        # Every name that can not be used as a tag (projects and reserved names). _tags is what readers look at: it is
+        # the same set, except while the journal is replayed from the start into a new one.
+        self._taken: Set[str] = set()
+        self._tags: Set[str] = self._taken
+        self._records = 0
+        self._ident: Optional[Tuple[int, int]] = None
+        self._offset = 0
+        self._version = 0
+        self._briefs: Optional[List[ProjectBrief]] = None
+        self._briefs_version = -1
+        # Sorted views of the entries, kept up to date as records are applied
+        self._listing = Listing(PROJECT_FIELDS, 'name')
+        self.cached_time = 0
+
+    # Reading ##########################################################################################################
+
+    def _apply(self, record: dict):
+        self._records += 1
+        op = record['op']
+        if op == 'put':
+            brief = record['brief']
+            tag = brief['tag'].lower()
+            self._entries[tag] = brief
+            self._listing.put(tag, brief)
+            self._taken.add(tag)
+        elif op == 'del':
+            tag = record['tag'].lower()
+            self._entries.pop(tag, None)
+            self._listing.discard(tag)
+            if tag not in self._reserved:
+                self._taken.discard(tag)
+        elif op == 'reserve':
+            tag = record['tag'].lower()
+            self._reserved.add(tag)
+            self._taken.add(tag)
+
+    def _replay(self, f, offset: int):
+        f.seek(offset)
+        chunk = f.read()
+        # A writer may be half way through a line. Only consume complete lines.
+        end = chunk.rfind(b'\n') + 1
+        for line in chunk[:end].splitlines():
+            if line.strip():
+                self._apply(json.loads(line, object_hook=json_object_hook))
+        self._offset = offset + end
+        if end:
+            self._version += 1
+
+    def refresh(self):
+        """
+        Bring the in-memory copy up to date with the journal. Creates the journal from the directory tree if it does
+        not exist yet.
+        """
+        try:
+            st = os.stat(self.filename)
+            if (st.st_dev, st.st_ino) == self._ident and st.st_size == self._offset:
+                # Nothing new. Checked without the lock, so concurrent readers (e.g. tag checks) do not queue up.
+                return
+        except FileNotFoundError:
+            pass
+        with self._mutex:
+            try:
+                f = open(self.filename, 'rb')
+            except FileNotFoundError:
+                self.rebuild(missing_only=True)
+                f = open(self.filename, 'rb')
+            with f:
+                # Look at the file that was opened. By now the name may point at a new journal (compaction or rebuild
+                # by another process), and replaying that from this file's offset would start in the middle of a line.
+                st = os.fstat(f.fileno())
+                ident = (st.st_dev, st.st_ino)
+                if ident != self._ident or st.st_size < self._offset:
+                    # New file (first load, compaction or rebuild), so replay from the start.
+                    self._entries = {}
+                    self._listing.reset()
+                    self._reserved = set()
+                    self._taken = set()
+                    self._records = 0
+                    self._offset = 0
+                    self._version += 1
+                    self._ident = ident
+                if st.st_size > self._offset:
+                    self._replay(f, self._offset)
+            self._tags = self._taken
+            self.cached_time = st.st_mtime
+
+    def clear(self):
+        """
+        Forget the in-memory copy, so the next read replays the journal from the start.
+        """
+        with self._mutex:
+            self._ident = None
+            self._briefs = None
+
+    def contains(self, tag: str) -> bool:
+        """
+        Case-insensitive check if a tag is used by a project or a reserved name. Costs one stat() and a set lookup.
+        """
+        self.refresh()
+        return tag.lower() in self._tags
+
+    def get(self, tag: str) -> Optional[dict]:
+        self.refresh()
+        return self._entries.get(tag.lower())
+
+    def validator(self) -> Tuple[str, float]:
+        """
+        :return: (etag, last_modified) for the project list. Costs one stat().
+        :rtype: Tuple[str, float]
+        """
+        with self._mutex:
+            self.refresh()
+            return make_etag(self.filename, self._ident, self._offset), self.cached_time
+
+    @property
+    def data(self) -> List[ProjectBrief]:
+        """
+        The project list, inflated only when the journal changed since the last call.
+        """
+        with self._mutex:
+            self.refresh()
+            if self._briefs is None or self._briefs_version != self._version:
+                self._briefs = [ProjectBrief.inflate(dict(x)) for x in self._entries.values()]
+                self._briefs_version = self._version
+            return self._briefs
+
+    def page(self, query: ListQuery) -> Page:
+        """
+        One page of the project list. Only the projects on the page are inflated.
+        :type query: ListQuery
+        :rtype: Page
+        """
+        with self._mutex:
+            self.refresh()
+            return self._listing.page(query, ProjectBrief.inflate)
+
+    # Writing ##########################################################################################################
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold the index lock (across threads and processes) for a sequence of file system changes and index updates.
+        Transactions can be nested.
+        """
+        with self._mutex:
+            if self._depth == 0:
+                self._lock_file = open(self.lock_filename, 'a')
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                self.refresh()
+                yield self
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    def _append(self, records: Iterable[dict]):
+        payload = ''.join(json.dumps(r, default=json_default) + '\n' for r in records).encode()
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, payload)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.refresh()
+        if self._records > self.compact_min and self._records > self.compact_ratio * len(self._entries):
+            self.compact()
+
+    def put(self, brief: dict):
+        with self.transaction():
+            self._append([{'op': 'put', 'brief': brief}])
+
+    def remove(self, tag: str):
+        with self.transaction():
+            self._append([{'op': 'del', 'tag': tag}])
+
+    def _write_compacted(self, briefs: Iterable[dict], reserved: Iterable[str]):
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp, 'w') as f:
+            for tag in sorted(reserved):
+                f.write(json.dumps({'op': 'reserve', 'tag': tag}) + '\n')
+            for brief in briefs:
+                f.write(json.dumps({'op': 'put', 'brief': brief}, default=json_default) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.filename)
+
+    def compact(self):
+        with self.transaction():
+            self._write_compacted(list(self._entries.values()), set(self._reserved))
+            self.refresh()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the lock file for a write outside of transaction(). Within a transaction, this process already holds it.
+        """
+        with self._mutex:
+            if self._depth > 0:
+                yield
+                return
+            with open(self.lock_filename, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                yield
+
+    def rebuild(self, briefs: List[dict] = None, reserved: List[str] = None, missing_only: bool = False) -> int:
+        """
+        Replace the index with the given content, or with the result of scanning the directory tree. The scan is done
+        under the lock, so no project can be created or deleted while it runs.
+        :param briefs: The content of every brief.yaml file
+        :type briefs: List[dict]
+        :param reserved: Entries in PROJECT_DIR that are not projects
+        :type reserved: List[str]
+        :param missing_only: Only create the index if there is none (another process may have done it meanwhile)
+        :type missing_only: bool
+        :return: The number of projects in the new index, or -1 if it was left alone
+        :rtype: int
+        """
+        with self._locked():
+            if missing_only and os.path.exists(self.filename):
+                return -1
+            if briefs is None:
+                briefs, reserved = self.scanner()
+            self._write_compacted(briefs, reserved)
+            # Force a full replay on the next read
+            self._ident = None
+        return len(briefs)
+
+    def drift(self, briefs: List[dict], reserved: List[str]) -> List[str]:
+        """
+        Compare the index with the result of a directory scan.
+        :return: A description of every difference. Empty if the index is in sync.
+        :rtype: List[str]
+        """
+        self.refresh()
+        problems = []
+        scanned = {b['tag'].lower(): b for b in briefs}
+        for tag in sorted(set(scanned) - set(self._entries)):
+            problems.append("Project '%s' is missing from the index" % tag)
+        for tag in sorted(set(self._entries) - set(scanned)):
+            problems.append("Project '%s' is in the index, but not in the project directory" % tag)
+        for tag in sorted(set(scanned) & set(self._entries)):
+            if scanned[tag] != self._entries[tag]:
+                problems.append("Project '%s' is out of date" % tag)
+        for tag in sorted({x.lower() for x in reserved} ^ self._reserved):
+            problems.append("Reserved name '%s' is out of date" % tag)
+        return problems
+
+
+def main(argv: List[str]):
+    """
+    Check or repair the project index:
+
+        python -m server_impl.projects_fs.project_index check
+        python -m server_impl.projects_fs.project_index rebuild
+    """
+    from server_impl.projects_fs.fs_internals import project_index
+
+    command = argv[0] if argv else 'check'
+    if command == 'check':
+        problems = project_index.drift(*project_index.scanner())
+        for p in problems:
+            print(p)
+        print('Index is %s' % ('out of sync' if problems else 'in sync'))
+        return 1 if problems else 0
+    elif command == 'rebuild':
+        count = project_index.rebuild()
+        print('Rebuilt the project index with %d projects' % count)
+        return 0
+    print(main.__doc__)
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,20 +1,26 @@
 from jsonschema import ValidationError
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 
-from openapi_core import create_spec
 from openapi_core.schema.infos.models import Info
 from werkzeug.datastructures import FileStorage
 import datetime
+import json
+import logging
 
 from generated.openapi import OpenApi
 from openapi_server.models import ProjectDetails, Module, FlowGraph
 from server_impl import TagBuilder
 from server_impl.errors.custom_errors import ENotFound, EConflict
+from server_impl.projects_fs.caches import make_etag
 from server_impl.projects_fs.file_names import FileNames
-from server_impl.projects_fs.fs_internals import read_yaml, save_yaml, Patterns
+from server_impl.projects_fs.fs_internals import read_yaml, save_yaml, Patterns, write_files
+from server_impl.projects_fs.storage import get_storage
+from server_impl.projects_fs.writes import write_batch
 from server_impl.projects_fs.graph_wrapper import GraphWrapper, build_graph
-from server_impl.spec_utils import valid_or_raise
-from server_impl.spec_utils.converter import convert
+from server_impl.spec_utils import valid_or_raise, load_spec
+from server_impl.spec_utils.converter import convert_parallel, plan_operations
+from server_impl.spec_utils.hashing import RefIndex, operation_hash
+from server_impl.spec_utils.parse import parse_spec
 
 from .fs import lookup_tag, update_project, load_graph
 import os
@@ -22,39 +28,30 @@ from server_impl.errors import EBadRequest
 import yaml
 import re
 
+log = logging.getLogger(__name__)
 
 pattern_v3_major = re.compile(r'^3\.\d+\.\d+$')
 
 
-def _preprocess_spec_file(file: FileStorage):
+def _preprocess_spec_file(file: FileStorage) -> Tuple[dict, str]:
     """
     Validate that the file is a useable OpenAPI specification.
     :param file: The incoming file.
     :type file: FileStorage
-    :return: The parsed content of the specification file.
-    :rtype: TODO
+    :return: The parsed content of the specification file, and its hash (see valid_or_raise).
+    :rtype: Tuple[dict, str]
     """
-    if file.filename.endswith('.json'):
-        content_type = 'text/json'
-    elif file.filename.endswith('.yaml') or file.filename.endswith('.yml'):
-        content_type = 'text/yaml'
-    else:
-        raise EBadRequest('File must have a .json, .yaml, or .yml extension')
-
     file.stream.seek(0)
-    try:
-        content = yaml.safe_load(file.stream)
-    except Exception:
-        raise EBadRequest("Failed to parse file. The file must be valid YAML or JSON")
+    content, raw_digest = parse_spec(file.stream, file.filename)
 
-    valid_or_raise(content)
+    digest = valid_or_raise(content, raw_digest)
 
-    return content
+    return content, digest
 
 def _save_api_file(spec_dir: str, api_file: FileStorage):
-    os.makedirs(spec_dir)
+    os.makedirs(spec_dir, exist_ok=True)
     dest = os.path.join(spec_dir, api_file.filename)
-    print("Saving API file to '%s'" % dest)
+    log.info("Saving API file to '%s'", dest)
     api_file.stream.seek(0)
     api_file.save(dest)
 
@@ -176,34 +173,32 @@ class ProjectWrapper:
         return self._modules
 
     def set_api(self, file: FileStorage):
-
-        if file.filename.endswith('.json'):
-            content_type = 'text/json'
-        elif file.filename.endswith('.yaml') or file.filename.endswith('.yml'):
-            content_type = 'text/yaml'
-        else:
-            raise EBadRequest('File must have a .json, .yaml, or .yml extension')
-        #
+        # The format is checked by _preprocess_spec_file (see parse.spec_format)
         spec_dir = self.spec_dir()
         # if os.path.exists(spec_dir):
         #     raise EConflict("An API was already uploaded to this project.")
         #
-        content = _preprocess_spec_file(file)
+        content, digest = _preprocess_spec_file(file)
 
-        api = create_spec(content)
+        api = load_spec(content, digest)
 
-        modules: Dict[str, Module]
-        graphs: Dict[str, FlowGraph]
-        modules, graphs = convert(api)
+        # Only regenerate the operations that were added or changed since the last upload. The files of unchanged
+        # operations are left alone, so their cache entries stay warm.
+        plan = plan_operations(api)
+        # Shared components are resolved once for all operations
+        index = self._load_ref_index(content, digest)
+        hashes = {mod_id: operation_hash(content, path, method, mod_id, index) for path, method, mod_id in plan}
+        previous = self._load_hashes()
+        changed = [entry for entry in plan if not self._module_current(entry[2], hashes, previous)]
+        removed = [mod_id for mod_id in previous if mod_id not in hashes]
+        log.info('Spec upload: %d operations, %d changed, %d removed', len(plan), len(changed), len(removed))
+
+        # mod_id -> (module, graph), serialized for the storage backend
+        storage = get_storage()
+        converted = convert_parallel(api, encode=storage.encode, plan=changed)
 
         info: Info = api.info
-        print('JCT INFO ====================')
-        print('JCT INFO ====================')
-        print('JCT INFO ====================')
-        print("INFO", info.__dict__)
-        print('JCT INFO ====================')
-        print('JCT INFO ====================')
-        print('JCT INFO ====================')
+        log.debug('API info: %s', info.__dict__)
         self.target.api_filename = file.filename
         self.target.api_version = info.version
         self.target.description = info.title
@@ -212,13 +207,14 @@ class ProjectWrapper:
         mdir = self.modules.init_dirs()
 
         # modules = _parse_and_save_module_list(api, self.modmap_filename())
-        for mod_id in modules.keys():
-            mod_file = Patterns.project_module_file(self.tag, mod_id)
-            save_yaml(mod_file, modules[mod_id].flatten())
-            graph_file = Patterns.project_graph_file(self.tag, mod_id)
-            save_yaml(graph_file, graphs[mod_id].flatten())
-            # self.modules.add_module(mod_id, graphs[mod_id])
-            # _save_raw_module(mod_dir, mod)
+        # One group commit for all module files. The hashes are renamed into place last, so an interrupted upload is
+        # simply redone next time. That includes the removals: they happen before the commit, while the old hashes
+        # still list the removed operations.
+        with write_batch():
+            storage.save_modules(self.tag, converted)
+            storage.remove_modules(self.tag, removed)
+            self._save_ref_index(digest, index)
+            self._save_hashes(hashes)
         # self.modules.save()
         #
         # self.target.api_version = content['info']['version']
@@ -232,6 +228,41 @@ class ProjectWrapper:
 
         return self
 
+    def _load_hashes(self) -> Dict[str, str]:
+        filename = Patterns.project_hashes_file(self.tag)
+        if not os.path.exists(filename):
+            return {}
+        with open(filename, 'r') as f:
+            return json.load(f)
+
+    def _load_ref_index(self, content: dict, digest: str) -> RefIndex:
+        """
+        The RefIndex of the uploaded spec. The reference graph saved with the last upload is reused if it was built
+        from the same spec.
+        """
+        filename = Patterns.project_ref_index_file(self.tag)
+        if os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    saved = json.load(f)
+                if saved.get('spec') == digest:
+                    return RefIndex(content, saved['refs'])
+            except (OSError, ValueError, KeyError, AttributeError) as e:
+                log.warning('Ignoring %s: %s', filename, e)
+        return RefIndex(content)
+
+    def _save_ref_index(self, digest: str, index: RefIndex):
+        write_files([(Patterns.project_ref_index_file(self.tag), json.dumps({'spec': digest, **index.to_dict()}))])
+
+    def _save_hashes(self, hashes: Dict[str, str]):
+        write_files([(Patterns.project_hashes_file(self.tag), json.dumps(hashes, indent=1, sort_keys=True))])
+
+    def _module_current(self, mod_id: str, hashes: Dict[str, str], previous: Dict[str, str]) -> bool:
+        if previous.get(mod_id) != hashes[mod_id]:
+            return False
+        # Guard against modules that were deleted by hand
+        return get_storage().has_module(self.tag, mod_id)
+
     def finish(self):
         """
         Finish any pending changes and save the project details yaml file, updating the last_modified field if anything
@@ -263,14 +294,27 @@ class ProjectWrapper:
     def api_filename(self):
         return self.target.api_filename
 
-    def read_api(self):
+    def api_path(self) -> str:
         if not self.target.api_filename:
             raise ENotFound("No API file has been uploaded")
         filepath = os.path.join(self.spec_dir(), self.target.api_filename)
         if not os.path.exists(filepath):
-            print("Failed to find API spec: '%s'" % filepath)
+            log.warning("Failed to find API spec: '%s'", filepath)
             raise ENotFound("API file not found")
-        print("Loading API spec: '%s'" % filepath)
+        return filepath
+
+    def api_validator(self) -> Tuple[str, float]:
+        """
+        :return: (etag, last_modified) of the uploaded API file
+        :rtype: Tuple[str, float]
+        """
+        filepath = self.api_path()
+        st = os.stat(filepath)
+        return make_etag(filepath, st.st_mtime_ns, st.st_size), st.st_mtime
+
+    def read_api(self):
+        filepath = self.api_path()
+        log.debug("Loading API spec: '%s'", filepath)
         with open(filepath, 'r') as f:
             content = f.read()
         return content
@@ -0,0 +1,227 @@
+import fcntl
+import hashlib
+import logging
+import marshal
+import mmap
+import os
+import shutil
+import struct
+import threading
+from typing import Callable, Optional
+
+from server_impl.projects_fs.caches import fingerprint
+from server_impl.projects_fs.watcher import Pattern, add_change_listener
+
+# An optional cache tier shared by every worker process on the machine (SHARED_CACHE=1). The parsed content of graph
+# and module files is stored in shared memory (a directory on /dev/shm by default), so only the first worker to miss
+# pays for reading and parsing YAML. Each worker still builds and keeps its own models (packed graphs, module lists)
+# from it, so this saves parse time, not the memory of holding hot graphs once per worker.
+#
+#   <dir>/versions                - An mmap'ed table of 64 bit counters. A scope (a directory in PROJECT_DIR) hashes
+#                                   to a slot, and every write to that directory by any worker increments it.
+#   <dir>/entries/<scope>/<hash>  - version of the scope, fingerprint of the source files, then the marshalled data
+#
+# An entry is used only if its version matches the current counter and its source files still have the same
+# fingerprint, so changes made outside of the server are picked up as well. Counters that share a slot only cause
+# extra misses.
+#
+# The entries live in RAM, so they are bounded: once the entries written since the last check add up to an eighth of
+# SHARED_CACHE_MAX_BYTES (default 256 MiB), the oldest entries are removed until the total is within the limit. The
+# entries of a deleted project are removed with it. If an entry can not be written (e.g. /dev/shm is full), the data is
+# just not shared.
+
+log = logging.getLogger(__name__)
+
+_header = struct.Struct('<Qqqq')
+_slot = struct.Struct('<Q')
+
+
+def _digest(value: str) -> bytes:
+    return hashlib.blake2b(value.encode(), digest_size=16).digest()
+
+
+class SharedCache:
+    def __init__(self, directory: str, slots: int = 65536, max_bytes: int = 256 << 20):
+        self.directory = directory
+        self.entry_dir = os.path.join(directory, 'entries')
+        os.makedirs(self.entry_dir, exist_ok=True)
+        self.slots = slots
+        self.max_bytes = max_bytes
+        # Bytes written by this process since the last size check
+        self._written = 0
+        self._sweep_lock = threading.Lock()
+        self._versions_file = open(os.path.join(directory, 'versions'), 'a+b')
+        fcntl.lockf(self._versions_file, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._versions_file.fileno()).st_size < slots * _slot.size:
+                os.ftruncate(self._versions_file.fileno(), slots * _slot.size)
+        finally:
+            fcntl.lockf(self._versions_file, fcntl.LOCK_UN)
+        self._versions = mmap.mmap(self._versions_file.fileno(), slots * _slot.size)
+
+    def _offset(self, scope: str) -> int:
+        return int.from_bytes(_digest(scope)[:8], 'little') % self.slots * _slot.size
+
+    def version(self, scope: str) -> int:
+        return _slot.unpack_from(self._versions, self._offset(scope))[0]
+
+    def bump(self, scope: str):
+        """
+        Invalidate every entry in ``scope`` for all processes.
+        """
+        offset = self._offset(scope)
+        fcntl.lockf(self._versions_file, fcntl.LOCK_EX, _slot.size, offset)
+        try:
+            _slot.pack_into(self._versions, offset, _slot.unpack_from(self._versions, offset)[0] + 1)
+        finally:
+            fcntl.lockf(self._versions_file, fcntl.LOCK_UN, _slot.size, offset)
+
+    def _scope_dir(self, scope: str) -> str:
+        return os.path.join(self.entry_dir, _digest(scope).hex())
+
+    def _entry_file(self, key: str, scope: str) -> str:
+        return os.path.join(self._scope_dir(scope), _digest(key).hex())
+
+    def get(self, key: str, scope: str, header: bytes):
+        try:
+            with open(self._entry_file(key, scope), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if m[:_header.size] != header:
+                        return None
+                    view = memoryview(m)
+                    try:
+                        return marshal.loads(view[_header.size:])
+                    finally:
+                        view.release()
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+
+    def put(self, key: str, scope: str, header: bytes, data: object):
+        """
+        Share ``data``. Failures (e.g. a full /dev/shm) are logged, the data is then simply not shared.
+        """
+        try:
+            payload = marshal.dumps(data)
+        except ValueError:
+            return
+        dest = self._entry_file(key, scope)
+        tmp = '%s.%d.%d.tmp' % (dest, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(header)
+                f.write(payload)
+            os.replace(tmp, dest)
+        except OSError as e:
+            log.warning('Failed to write a shared cache entry: %s', e)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self._written += len(header) + len(payload)
+        if self._written * 8 >= self.max_bytes:
+            self.sweep()
+
+    def sweep(self):
+        """
+        Remove the oldest entries until all entries together fit in max_bytes.
+        """
+        if not self._sweep_lock.acquire(blocking=False):
+            # Another thread is already at it
+            return
+        try:
+            self._written = 0
+            entries = []
+            total = 0
+            for scope in os.scandir(self.entry_dir):
+                if not scope.is_dir():
+                    # Left by an older layout, or a temporary file
+                    entries.append((0, 0, scope.path))
+                    continue
+                try:
+                    for entry in os.scandir(scope.path):
+                        st = entry.stat()
+                        entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                        total += st.st_size
+                except OSError:
+                    # Removed by another process meanwhile
+                    continue
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        finally:
+            self._sweep_lock.release()
+
+    def drop_scope(self, scope: str):
+        """
+        Remove every entry of ``scope``, e.g. when its directory was deleted.
+        """
+        shutil.rmtree(self._scope_dir(scope), ignore_errors=True)
+
+    def load(self, key: str, scope: str, pattern: Pattern, loader: Callable[[], object]):
+        """
+        Get the data for ``key`` from shared memory, or run ``loader`` and share its result.
+        :param key: Identifies the data.
+        :type key: str
+        :param scope: The directory that the source files are in.
+        :type scope: str
+        :param pattern: A glob pattern for the source files, or a tuple of them.
+        :type pattern: str | Tuple[str, ...]
+        :param loader: Reads the data from the source files. The result must be representable by marshal.
+        :type loader: () -> object
+        """
+        # Read the version before loading, so a write during the load leaves a stale entry rather than a wrong one
+        header = _header.pack(self.version(scope), *fingerprint(pattern))
+        data = self.get(key, scope, header)
+        if data is None:
+            data = loader()
+            self.put(key, scope, header, data)
+        return data
+
+    def on_change(self, path: str, is_dir: bool):
+        path = os.path.abspath(path)
+        self.bump(os.path.dirname(path))
+        if is_dir:
+            for scope in (path, os.path.join(path, 'modules')):
+                self.bump(scope)
+                if not os.path.exists(scope):
+                    self.drop_scope(scope)
+
+
+_shared: Optional[SharedCache] = None
+_shared_ready = False
+
+
+def get_shared_cache() -> Optional[SharedCache]:
+    """
+    Return the shared cache, or None unless SHARED_CACHE=1. The location defaults to a directory on /dev/shm named after
+    PROJECT_DIR, and can be set with SHARED_CACHE_DIR.
+    :rtype: Optional[SharedCache]
+    """
+    global _shared, _shared_ready
+    if not _shared_ready:
+        if os.getenv('SHARED_CACHE', '0') == '1':
+            from .file_names import PROJ_DIR
+            default = os.path.join('/dev/shm', 'dp-backend-%s' % _digest(os.path.abspath(PROJ_DIR)).hex()[:12])
+            _shared = SharedCache(os.getenv('SHARED_CACHE_DIR', default),
+                                  max_bytes=int(os.getenv('SHARED_CACHE_MAX_BYTES', str(256 << 20))))
+            add_change_listener(_shared.on_change)
+        _shared_ready = True
+    return _shared
+
+
+def shared_load(key: str, scope: str, pattern: Pattern, loader: Callable[[], object]):
+    """
+    Run ``loader`` through the shared cache if it is enabled.
+    """
+    shared = get_shared_cache()
+    if shared is None:
+        return loader()
+    return shared.load(key, scope, pattern, loader)
@@ -0,0 +1,106 @@
+import marshal
+import os
+import struct
+import sys
+from typing import Callable, Optional, Union
+
+from server_impl import metrics
+from server_impl.projects_fs.writes import write_behind
+
+# A snapshot holds the parsed content of a YAML file in marshal format, so a cold load does not have to run the YAML
+# parser again. It is stored next to the source file and is only used while the source's mtime and size match the
+# values in the header. Snapshots are a pure cache: deleting them is always safe.
+#
+#   <name>.yaml       - The source of truth
+#   <name>.yaml.snap  - magic, python version, source mtime (ns), source size, then the marshalled data
+
+SNAPSHOT_SUFFIX = '.snap'
+MARSHAL_VERSION = 4
+
+_MAGIC = b'DPS1'
+_header = struct.Struct('<4sBBqq')
+
+# Snapshots can be disabled (e.g. on read-only project directories) with SNAPSHOTS=0
+enabled = os.getenv('SNAPSHOTS', '1') != '0'
+
+
+def snapshot_name(filename: str) -> str:
+    return filename + SNAPSHOT_SUFFIX
+
+
+def _header_for(st: os.stat_result) -> bytes:
+    return _header.pack(_MAGIC, sys.version_info[0], sys.version_info[1], st.st_mtime_ns, st.st_size)
+
+
+def read_snapshot(filename: str, st: os.stat_result = None) -> Optional[Union[dict, list]]:
+    """
+    Load the snapshot for a source file.
+    :param filename: The source (YAML) file.
+    :type filename: str
+    :param st: The result of os.stat(filename), if the caller already has it.
+    :return: The snapshot data, or None if there is no snapshot or it is out of date.
+    """
+    try:
+        if st is None:
+            st = os.stat(filename)
+        with open(snapshot_name(filename), 'rb') as f:
+            if f.read(_header.size) != _header_for(st):
+                return None
+            data = marshal.load(f)
+            metrics.bytes_read.inc(f.tell())
+            return data
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def write_snapshot(filename: str, data: object, st: os.stat_result = None) -> bool:
+    """
+    Write a snapshot for a source file. Data that marshal can not represent is silently skipped.
+    :return: True if a snapshot was written
+    :rtype: bool
+    """
+    try:
+        payload = marshal.dumps(data, MARSHAL_VERSION)
+        if st is None:
+            st = os.stat(filename)
+    except (OSError, ValueError):
+        return False
+    dest = snapshot_name(filename)
+    tmp = '%s.%d.tmp' % (dest, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(_header_for(st))
+            f.write(payload)
+        metrics.bytes_written.inc(_header.size + len(payload))
+        os.replace(tmp, dest)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
+
+
+def remove_snapshot(filename: str):
+    try:
+        os.remove(snapshot_name(filename))
+    except FileNotFoundError:
+        pass
+
+
+def load_with_snapshot(filename: str, loader: Callable[[str], object]):
+    """
+    Read a file through its snapshot, falling back to ``loader`` (and refreshing the snapshot) if needed.
+    :param filename: The source file.
+    :type filename: str
+    :param loader: Parses the source file, e.g. read_yaml.
+    :type loader: (str) -> object
+    """
+    if not enabled:
+        return loader(filename)
+    st = os.stat(filename)
+    data = read_snapshot(filename, st)
+    if data is not None:
+        return data
+    data = loader(filename)
+    write_behind(lambda: write_snapshot(filename, data, st))
+    return data
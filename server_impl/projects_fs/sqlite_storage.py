@@ -0,0 +1,386 @@
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from openapi_server.models import ProjectBrief, ProjectDetails, Module, FlowGraph
+from server_impl.errors import EBadRequest
+from server_impl.errors.custom_errors import ENotFound
+from server_impl.projects_fs import graph_log
+from server_impl.projects_fs.caches import make_etag
+from server_impl.projects_fs.file_names import PROJ_DIR
+from server_impl.projects_fs.fs_internals import MODULE_FIELDS, project_index
+from server_impl.projects_fs.listing import Field, ListQuery, Page, decode_cursor, encode_cursor, sort_value
+from server_impl.projects_fs.project_index import PROJECT_FIELDS, json_default, json_object_hook
+from server_impl.projects_fs.storage import StorageEngine, EncodedModules, BACKEND_SQLITE
+
+# Projects, modules and graphs in one SQLite database. The database runs in WAL mode, so readers in any number of
+# threads and processes do not block each other or the writer. Every thread has its own connection, and the sqlite3
+# module keeps the compiled form of each statement in a per-connection cache, so the fixed statements below are only
+# prepared once per connection.
+#
+# Connections are opened on first use in a thread. A connection inherited through fork() is never used (SQLite does
+# not support that), the thread opens its own. The connections of threads that have exited are closed whenever another
+# thread opens one.
+#
+# The sort and filter values of the listings (see listing.sort_value) are stored in indexed columns, so a page is a
+# single index range scan. The project and module records themselves are stored as JSON.
+
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    tag TEXT PRIMARY KEY,
+    name_key TEXT NOT NULL,
+    modified_key TEXT NOT NULL,
+    brief TEXT NOT NULL,
+    details TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS projects_by_name ON projects (name_key, tag);
+CREATE INDEX IF NOT EXISTS projects_by_modified ON projects (modified_key, tag);
+
+CREATE TABLE IF NOT EXISTS modules (
+    project TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    name_key TEXT NOT NULL,
+    url_key TEXT NOT NULL,
+    method_key TEXT NOT NULL,
+    status_key TEXT NOT NULL,
+    module TEXT NOT NULL,
+    graph TEXT NOT NULL,
+    PRIMARY KEY (project, tag)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS modules_by_name ON modules (project, name_key, tag);
+CREATE INDEX IF NOT EXISTS modules_by_url ON modules (project, url_key, tag);
+
+-- Graph operations since the graph was last compacted (see graph_log)
+CREATE TABLE IF NOT EXISTS graph_ops (
+    project TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    ops TEXT NOT NULL,
+    PRIMARY KEY (project, tag, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS revisions (
+    scope TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL,
+    modified REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Listing field -> column
+PROJECT_COLUMNS = {'tag': 'tag', 'name': 'name_key', 'last_modified': 'modified_key'}
+MODULE_COLUMNS = {'tag': 'tag', 'name': 'name_key', 'url': 'url_key', 'method': 'method_key', 'status': 'status_key'}
+
+# Sorts after any text, to turn a prefix into a range
+_PREFIX_END = '\U0010ffff'
+
+
+def default_path() -> str:
+    return os.path.join(PROJ_DIR, '.projects.sqlite3')
+
+
+def encode_json(data: dict) -> str:
+    return json.dumps(data, default=json_default, separators=(',', ':'))
+
+
+def decode_json(text: str):
+    return json.loads(text, object_hook=json_object_hook)
+
+
+def _key(fields: Dict[str, Field], name: str, record: dict) -> str:
+    return sort_value(fields[name].get(record))
+
+
+def _after_fork(ref: 'weakref.ref[SQLiteStorage]'):
+    storage = ref()
+    if storage is not None:
+        storage._after_fork()
+
+
+class SQLiteStorage(StorageEngine):
+    name = BACKEND_SQLITE
+
+    def __init__(self, path: str, cached_statements: int = 128, busy_timeout: float = 30.0):
+        """
+        :param path: The database file. It is created if needed.
+        :type path: str
+        :param cached_statements: The size of each connection's prepared statement cache.
+        :type cached_statements: int
+        :param busy_timeout: Seconds to wait for another writer before failing.
+        :type busy_timeout: float
+        """
+        self.path = path
+        self.cached_statements = cached_statements
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (thread, connection) for every connection opened by this process
+        self._connections: List[Tuple[threading.Thread, sqlite3.Connection]] = []
+        self._pid = os.getpid()
+        os.register_at_fork(after_in_child=functools.partial(_after_fork, weakref.ref(self)))
+        # Not kept, so no connection exists before a server forks its workers
+        db = self._connect()
+        try:
+            db.executescript(SCHEMA)
+            db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        finally:
+            db.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Only used by one thread, but closed by whichever thread notices that its owner has exited
+        db = sqlite3.connect(self.path, timeout=self.busy_timeout, cached_statements=self.cached_statements,
+                             isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode = WAL')
+        # With WAL, NORMAL only risks the last transactions on power loss, never corruption
+        db.execute('PRAGMA synchronous = NORMAL')
+        return db
+
+    def _after_fork(self):
+        # The parent's connections belong to the parent, they are dropped without being closed
+        self._lock = threading.Lock()
+        self._connections = []
+        self._pid = os.getpid()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is not None and self._local.pid == self._pid:
+            return db
+        db = self._connect()
+        with self._lock:
+            # Close the connections of threads that have exited
+            alive = []
+            for thread, conn in self._connections:
+                if thread.is_alive():
+                    alive.append((thread, conn))
+                else:
+                    conn.close()
+            alive.append((threading.current_thread(), db))
+            self._connections = alive
+        self._local.db = db
+        self._local.pid = self._pid
+        return db
+
+    @contextmanager
+    def _snapshot(self):
+        """
+        A read transaction, so that several queries see the same version of the database.
+        """
+        db = self.db
+        db.execute('BEGIN')
+        try:
+            yield db
+        finally:
+            db.execute('COMMIT')
+
+    @contextmanager
+    def _transaction(self):
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def close(self):
+        """
+        Close this thread's connection.
+        """
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            self._local.db = None
+            if self._local.pid != self._pid:
+                return
+            with self._lock:
+                self._connections = [(t, c) for t, c in self._connections if c is not db]
+            db.close()
+
+    # Revisions ########################################################################################################
+
+    @staticmethod
+    def _bump(db: sqlite3.Connection, *scopes: str):
+        now = time.time()
+        db.executemany('INSERT INTO revisions (scope, revision, modified) VALUES (?, 1, ?) '
+                       'ON CONFLICT (scope) DO UPDATE SET revision = revision + 1, modified = excluded.modified',
+                       [(scope, now) for scope in scopes])
+
+    def _validator(self, scope: str) -> Tuple[str, float]:
+        row = self.db.execute('SELECT revision, modified FROM revisions WHERE scope = ?', (scope,)).fetchone()
+        revision, modified = row if row is not None else (0, 0.0)
+        return make_etag(self.path, scope, revision), modified
+
+    # Listings #########################################################################################################
+
+    def _page(self, table: str, columns: Dict[str, str], where: str, params: list, query: ListQuery, record: str,
+              inflate) -> Page:
+        column = columns.get(query.sort)
+        if column is None:
+            raise EBadRequest("Can not sort by '%s'. Use one of: %s" % (query.sort, ', '.join(sorted(columns))))
+        clauses = [where] if where else []
+        args = list(params)
+        if query.cursor:
+            clauses.append('(%s, tag) %s (?, ?)' % (column, '<' if query.descending else '>'))
+            args.extend(decode_cursor(query.cursor))
+        if query.prefix is not None:
+            clauses.append('name_key >= ? AND name_key < ?')
+            args.extend((query.prefix, query.prefix + _PREFIX_END))
+        for name, values in sorted(query.filters.items()):
+            if name not in columns:
+                raise EBadRequest("Can not filter by '%s'" % name)
+            clauses.append('%s IN (%s)' % (columns[name], ', '.join('?' * len(values))))
+            args.extend(sorted(values))
+        order = 'DESC' if query.descending else 'ASC'
+        sql = 'SELECT %s, tag, %s FROM %s' % (column, record, table)
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY %s %s, tag %s' % (column, order, order)
+        if query.limit is not None:
+            # One extra row tells if there is a next page
+            sql += ' LIMIT ?'
+            args.append(query.limit + 1)
+        rows = self.db.execute(sql, args).fetchall()
+        next_cursor = None
+        if query.limit is not None and len(rows) > query.limit:
+            rows = rows[:query.limit]
+            next_cursor = encode_cursor((rows[-1][0], rows[-1][1]))
+        return Page([inflate(decode_json(row[2])) for row in rows], next_cursor)
+
+    # Projects #########################################################################################################
+
+    def list_projects(self) -> List[ProjectBrief]:
+        rows = self.db.execute('SELECT brief FROM projects ORDER BY tag')
+        return [ProjectBrief.inflate(decode_json(brief)) for brief, in rows]
+
+    def list_projects_page(self, query: ListQuery) -> Page:
+        return self._page('projects', PROJECT_COLUMNS, '', [], query, 'brief', ProjectBrief.inflate)
+
+    def project_list_validator(self) -> Tuple[str, float]:
+        return self._validator('projects')
+
+    def project_details(self, tag: str) -> Optional[ProjectDetails]:
+        row = self.db.execute('SELECT brief, details FROM projects WHERE tag = ?', (tag.lower(),)).fetchone()
+        if row is None:
+            return None
+        return ProjectDetails.inflate({**decode_json(row[0]), **decode_json(row[1])})
+
+    def save_project(self, details: ProjectDetails):
+        data = details.flatten()
+        brief = ProjectBrief.inflate(dict(data)).flatten()
+        # Remove brief fields from detail fields
+        for key in brief:
+            data.pop(key, None)
+        tag = details.tag.lower()
+        with project_index.transaction():
+            with self._transaction() as db:
+                db.execute('INSERT OR REPLACE INTO projects (tag, name_key, modified_key, brief, details) '
+                           'VALUES (?, ?, ?, ?, ?)',
+                           (tag, _key(PROJECT_FIELDS, 'name', brief), _key(PROJECT_FIELDS, 'last_modified', brief),
+                            encode_json(brief), encode_json(data)))
+                self._bump(db, 'projects')
+            project_index.put(brief)
+
+    def delete_project(self, tag: str):
+        tag = tag.lower()
+        with self._transaction() as db:
+            mods = [mod for mod, in db.execute('SELECT tag FROM modules WHERE project = ?', (tag,))]
+            db.execute('DELETE FROM modules WHERE project = ?', (tag,))
+            db.execute('DELETE FROM graph_ops WHERE project = ?', (tag,))
+            db.execute('DELETE FROM projects WHERE tag = ?', (tag,))
+            self._bump(db, 'projects', 'modules:%s' % tag, *['graph:%s:%s' % (tag, mod) for mod in mods])
+
+    # Modules ##########################################################################################################
+
+    def list_modules(self, tag: str) -> List[Module]:
+        rows = self.db.execute('SELECT module FROM modules WHERE project = ? ORDER BY tag', (tag.lower(),))
+        return [Module.inflate(decode_json(module)) for module, in rows]
+
+    def list_modules_page(self, tag: str, query: ListQuery) -> Page:
+        return self._page('modules', MODULE_COLUMNS, 'project = ?', [tag.lower()], query, 'module', Module.inflate)
+
+    def module_list_validator(self, tag: str) -> Tuple[str, float]:
+        return self._validator('modules:%s' % tag.lower())
+
+    def load_graph(self, tag: str, mod: str) -> FlowGraph:
+        return FlowGraph.inflate(self.load_graph_data(tag, mod))
+
+    def load_graph_data(self, tag: str, mod: str) -> dict:
+        key = (tag.lower(), mod)
+        with self._snapshot() as db:
+            row = db.execute('SELECT graph FROM modules WHERE project = ? AND tag = ?', key).fetchone()
+            if row is None:
+                raise ENotFound("No module '%s' in project '%s'" % (mod, tag))
+            rows = db.execute('SELECT ops FROM graph_ops WHERE project = ? AND tag = ? ORDER BY seq', key)
+            ops = [op for ops, in rows for op in json.loads(ops)]
+        graph = decode_json(row[0])
+        return graph_log.apply_ops(graph, ops) if ops else graph
+
+    def graph_validator(self, tag: str, mod: str) -> Tuple[str, float]:
+        return self._validator('graph:%s:%s' % (tag.lower(), mod))
+
+    def patch_graph(self, tag: str, mod: str, ops: List[dict]):
+        key = (tag.lower(), mod)
+        encoded = json.dumps(ops, separators=(',', ':'))
+        with self._transaction() as db:
+            if db.execute('SELECT 1 FROM modules WHERE project = ? AND tag = ?', key).fetchone() is None:
+                raise ENotFound("No module '%s' in project '%s'" % (mod, tag))
+            seq, size = db.execute('SELECT COALESCE(MAX(seq), 0) + 1, COALESCE(SUM(LENGTH(ops)), 0) FROM graph_ops '
+                                   'WHERE project = ? AND tag = ?', key).fetchone()
+            db.execute('INSERT INTO graph_ops (project, tag, seq, ops) VALUES (?, ?, ?, ?)', (*key, seq, encoded))
+            self._bump(db, 'graph:%s:%s' % key)
+        if size + len(encoded) >= graph_log.compact_bytes:
+            graph_log.compact_later((self.path, key), lambda: self.compact_graph(*key))
+
+    def compact_graph(self, tag: str, mod: str):
+        """
+        Fold the stored operations of a graph into the graph.
+        """
+        key = (tag.lower(), mod)
+        with self._transaction() as db:
+            rows = db.execute('SELECT seq, ops FROM graph_ops WHERE project = ? AND tag = ? ORDER BY seq',
+                              key).fetchall()
+            row = db.execute('SELECT graph FROM modules WHERE project = ? AND tag = ?', key).fetchone()
+            if not rows or row is None:
+                return
+            graph = graph_log.apply_ops(decode_json(row[0]), [op for _, ops in rows for op in json.loads(ops)])
+            db.execute('UPDATE modules SET graph = ? WHERE project = ? AND tag = ?', (encode_json(graph), *key))
+            db.execute('DELETE FROM graph_ops WHERE project = ? AND tag = ? AND seq <= ?', (*key, rows[-1][0]))
+
+    encode = staticmethod(encode_json)
+
+    def has_module(self, tag: str, mod: str) -> bool:
+        row = self.db.execute('SELECT 1 FROM modules WHERE project = ? AND tag = ?', (tag.lower(), mod)).fetchone()
+        return row is not None
+
+    def save_modules(self, tag: str, modules: EncodedModules):
+        tag = tag.lower()
+        rows = []
+        for mod_id, (module_json, graph_json) in modules.items():
+            module = decode_json(module_json)
+            rows.append((tag, mod_id, _key(MODULE_FIELDS, 'name', module), _key(MODULE_FIELDS, 'url', module),
+                         _key(MODULE_FIELDS, 'method', module), _key(MODULE_FIELDS, 'status', module),
+                         module_json, graph_json))
+        with self._transaction() as db:
+            db.executemany('INSERT OR REPLACE INTO modules '
+                           '(project, tag, name_key, url_key, method_key, status_key, module, graph) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            # Edits of the previous graphs do not apply to the new ones
+            db.executemany('DELETE FROM graph_ops WHERE project = ? AND tag = ?', [(tag, mod_id) for mod_id in modules])
+            self._bump(db, 'modules:%s' % tag, *['graph:%s:%s' % (tag, mod_id) for mod_id in modules])
+
+    def remove_modules(self, tag: str, mods: List[str]):
+        if not mods:
+            return
+        tag = tag.lower()
+        with self._transaction() as db:
+            db.executemany('DELETE FROM modules WHERE project = ? AND tag = ?', [(tag, mod) for mod in mods])
+            db.executemany('DELETE FROM graph_ops WHERE project = ? AND tag = ?', [(tag, mod) for mod in mods])
+            self._bump(db, 'modules:%s' % tag, *['graph:%s:%s' % (tag, mod) for mod in mods])
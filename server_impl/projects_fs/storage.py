@@ -0,0 +1,261 @@
+import abc
+import functools
+import os
+from typing import Dict, List, Optional, Tuple
+
+from openapi_server.models import ProjectBrief, ProjectDetails, Module, FlowGraph
+from server_impl.errors.custom_errors import ENotFound
+from server_impl.projects_fs import graph_log
+from server_impl.projects_fs.caches import GlobCache
+from server_impl.projects_fs.file_names import FileNames
+from server_impl.projects_fs.fs_internals import CacheRegistry, Patterns, project_index, save_project, dump_yaml, \
+    write_files, patch_graph
+from server_impl.projects_fs.graph_analysis import GraphAnalysis
+from server_impl.projects_fs.graph_views import select_graph
+from server_impl.projects_fs.listing import ListQuery, Page
+from server_impl.projects_fs.snapshots import remove_snapshot
+from server_impl.projects_fs.watcher import notify_changed
+from server_impl.projects_fs.writes import write_batch
+
+# Where projects, modules and graphs are kept. Selected with STORAGE_BACKEND:
+#   fs      - YAML files in PROJECT_DIR (default)
+#   sqlite  - An SQLite database, by default PROJECT_DIR/.projects.sqlite3 (set with STORAGE_SQLITE_PATH)
+#
+# With either backend, the project index (tag checks) and the uploaded spec files stay in PROJECT_DIR.
+
+BACKEND_FS = 'fs'
+BACKEND_SQLITE = 'sqlite'
+
+# (mod_id -> (encoded module, encoded graph)), as produced by convert_parallel(encode=StorageEngine.encode)
+EncodedModules = Dict[str, Tuple[object, object]]
+
+
+class StorageEngine(abc.ABC):
+    """
+    The interface of a storage backend. Validators are (etag, last_modified) pairs for conditional requests. A backend
+    that misses an abstract method fails when it is created, not on the first request that needs it.
+    """
+    name = None
+
+    @abc.abstractmethod
+    def list_projects(self) -> List[ProjectBrief]:
+        pass
+
+    @abc.abstractmethod
+    def list_projects_page(self, query: ListQuery) -> Page:
+        pass
+
+    @abc.abstractmethod
+    def project_list_validator(self) -> Tuple[str, float]:
+        pass
+
+    @abc.abstractmethod
+    def project_details(self, tag: str) -> Optional[ProjectDetails]:
+        pass
+
+    @abc.abstractmethod
+    def save_project(self, details: ProjectDetails):
+        """
+        Create or update a project. Also updates the project index.
+        """
+
+    @abc.abstractmethod
+    def delete_project(self, tag: str):
+        """
+        Remove everything stored for a project. Called inside a project index transaction, after the project
+        directory was removed.
+        """
+
+    @abc.abstractmethod
+    def list_modules(self, tag: str) -> List[Module]:
+        pass
+
+    @abc.abstractmethod
+    def list_modules_page(self, tag: str, query: ListQuery) -> Page:
+        pass
+
+    @abc.abstractmethod
+    def module_list_validator(self, tag: str) -> Tuple[str, float]:
+        pass
+
+    @abc.abstractmethod
+    def load_graph(self, tag: str, mod: str) -> FlowGraph:
+        pass
+
+    @abc.abstractmethod
+    def load_graph_data(self, tag: str, mod: str) -> dict:
+        """
+        The flattened graph. The result may be shared with the cache and must not be modified.
+        """
+
+    def load_graph_view(self, tag: str, mod: str, fields: List[str] = None, node_ids: List[str] = None) -> dict:
+        """
+        Some sections and/or nodes of a graph, see graph_views.select_graph.
+        """
+        return select_graph(self.load_graph_data(tag, mod), fields, node_ids)
+
+    def analyze_graph(self, tag: str, mod: str) -> GraphAnalysis:
+        """
+        The structure of a graph, see graph_analysis. The result may be shared with the cache and must not be modified.
+        """
+        return GraphAnalysis(self.load_graph_data(tag, mod))
+
+    @abc.abstractmethod
+    def graph_validator(self, tag: str, mod: str) -> Tuple[str, float]:
+        pass
+
+    @abc.abstractmethod
+    def patch_graph(self, tag: str, mod: str, ops: List[dict]):
+        """
+        Apply graph operations (see graph_log) to a stored graph.
+        """
+
+    @staticmethod
+    @abc.abstractmethod
+    def encode(data: dict) -> object:
+        """
+        Serialize a flattened module or graph for save_modules. Runs in the converter's encoding processes, so it must
+        be a plain function.
+        """
+
+    @abc.abstractmethod
+    def has_module(self, tag: str, mod: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def save_modules(self, tag: str, modules: EncodedModules):
+        """
+        Store modules and their graphs, replacing existing ones with the same id.
+        """
+
+    @abc.abstractmethod
+    def remove_modules(self, tag: str, mods: List[str]):
+        pass
+
+
+class FileSystemStorage(StorageEngine):
+    """
+    The original backend: YAML files in PROJECT_DIR, read through CacheRegistry.
+    """
+    name = BACKEND_FS
+
+    def list_projects(self) -> List[ProjectBrief]:
+        return CacheRegistry.project_list.data
+
+    def list_projects_page(self, query: ListQuery) -> Page:
+        return project_index.page(query)
+
+    def project_list_validator(self) -> Tuple[str, float]:
+        return CacheRegistry.project_list.validator()
+
+    def project_details(self, tag: str) -> Optional[ProjectDetails]:
+        if not os.path.exists(FileNames.project_dir(tag)):
+            return None
+        return CacheRegistry.project_details.of(tag).data
+
+    def save_project(self, details: ProjectDetails):
+        save_project(details)
+
+    def delete_project(self, tag: str):
+        CacheRegistry.remove_project(tag)
+
+    # The caches are only asked for things that exist, so requests for unknown projects and modules (e.g. probes) do not
+    # fill them with entries and watcher subscriptions
+
+    def _module_list(self, tag: str) -> GlobCache:
+        if not os.path.exists(FileNames.project_dir(tag)):
+            raise ENotFound("No project exists with tag '%s'" % tag)
+        return CacheRegistry.module_list.of(tag)
+
+    def _graph(self, tag: str, mod: str) -> GlobCache:
+        if not os.path.exists(Patterns.project_graph_file(tag, mod)):
+            raise ENotFound("No module '%s' in project '%s'" % (mod, tag))
+        return CacheRegistry.graphs.of(tag, mod)
+
+    def list_modules(self, tag: str) -> List[Module]:
+        return self._module_list(tag).data.modules
+
+    def list_modules_page(self, tag: str, query: ListQuery) -> Page:
+        return self._module_list(tag).data.page(query, Module.inflate)
+
+    def module_list_validator(self, tag: str) -> Tuple[str, float]:
+        return self._module_list(tag).validator()
+
+    def load_graph(self, tag: str, mod: str) -> FlowGraph:
+        # The cache holds packed graphs (see packed_graph), the model is built on the first full fetch of each version
+        return self._graph(tag, mod).data.model()
+
+    def load_graph_data(self, tag: str, mod: str) -> dict:
+        return self._graph(tag, mod).data.to_dict()
+
+    def load_graph_view(self, tag: str, mod: str, fields: List[str] = None, node_ids: List[str] = None) -> dict:
+        return self._graph(tag, mod).data.select(fields, node_ids)
+
+    def analyze_graph(self, tag: str, mod: str) -> GraphAnalysis:
+        return self._graph(tag, mod).data.analysis()
+
+    def graph_validator(self, tag: str, mod: str) -> Tuple[str, float]:
+        return self._graph(tag, mod).validator()
+
+    def patch_graph(self, tag: str, mod: str, ops: List[dict]):
+        patch_graph(tag, mod, ops)
+
+    encode = staticmethod(dump_yaml)
+
+    def has_module(self, tag: str, mod: str) -> bool:
+        return os.path.exists(Patterns.project_module_file(tag, mod)) and \
+            os.path.exists(Patterns.project_graph_file(tag, mod))
+
+    def save_modules(self, tag: str, modules: EncodedModules):
+        os.makedirs(os.path.join(FileNames.project_dir(tag), 'modules'), exist_ok=True)
+        files = []
+        for mod_id, (module_yaml, graph_yaml) in modules.items():
+            files.append((Patterns.project_module_file(tag, mod_id), module_yaml))
+            files.append((Patterns.project_graph_file(tag, mod_id), graph_yaml))
+        with write_batch() as batch:
+            # Edits of the previous graph do not apply to the new one. The log is emptied in place, under its lock, once
+            # the new graph is in place, so an edit waiting for the lock is appended to the new graph's log rather than
+            # to a replaced file. Locks are taken in path order, so concurrent uploads can not deadlock.
+            for log_file in sorted(Patterns.project_graph_log(tag, mod_id) for mod_id in modules):
+                if os.path.exists(log_file):
+                    f = batch.hold(graph_log.locked(log_file, exclusive=True))
+                    batch.after_commit(functools.partial(_clear_log, f, log_file))
+            write_files(files)
+
+    def remove_modules(self, tag: str, mods: List[str]):
+        for mod_id in mods:
+            for filename in (Patterns.project_module_file(tag, mod_id), Patterns.project_graph_file(tag, mod_id),
+                             Patterns.project_graph_log(tag, mod_id)):
+                if os.path.exists(filename):
+                    os.remove(filename)
+                    notify_changed(filename)
+                remove_snapshot(filename)
+            CacheRegistry.graphs.remove(tag, mod_id)
+
+
+def _clear_log(f, log_file: str):
+    f.truncate(0)
+    notify_changed(log_file)
+
+
+_storage: Optional[StorageEngine] = None
+
+
+def make_storage(backend: str) -> StorageEngine:
+    if backend == BACKEND_FS:
+        return FileSystemStorage()
+    if backend == BACKEND_SQLITE:
+        from server_impl.projects_fs.sqlite_storage import SQLiteStorage, default_path
+        return SQLiteStorage(os.getenv('STORAGE_SQLITE_PATH', default_path()))
+    raise Exception('Unknown STORAGE_BACKEND: "%s"' % backend)
+
+
+def get_storage() -> StorageEngine:
+    """
+    Return the storage backend selected by STORAGE_BACKEND, creating it on first use.
+    :rtype: StorageEngine
+    """
+    global _storage
+    if _storage is None:
+        _storage = make_storage(os.getenv('STORAGE_BACKEND', BACKEND_FS).lower())
+    return _storage
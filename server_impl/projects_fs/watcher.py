@@ -0,0 +1,466 @@
+import abc
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import threading
+import time
+from fnmatch import fnmatch
+from glob import glob
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+# How cache entries notice changes on disk. The default ('stat') globs and stats on every read, the others push
+# invalidations to the caches so that a hit never touches the file system.
+#   stat    - glob + stat on every access (original behaviour)
+#   inotify - use Linux inotify to mark caches dirty when their files change
+#   poll    - a background thread re-stats the watched patterns every CACHE_POLL_INTERVAL seconds
+#   auto    - inotify if available, otherwise poll
+#
+# The watcher's thread is started by the first cache that uses it in a process, so each forked worker (e.g. of
+# gunicorn --preload) runs its own. inotify only watches PROJECT_DIR and the directories of the cached entries, so the
+# number of watches follows the caches' eviction policies instead of the number of projects. An entry whose directory
+# can not be watched (e.g. max_user_watches is reached) stats its files on every read instead, as in 'stat' mode.
+MODE_STAT = 'stat'
+MODE_INOTIFY = 'inotify'
+MODE_POLL = 'poll'
+MODE_AUTO = 'auto'
+
+_GLOB_CHARS = set('*?[')
+
+log = logging.getLogger(__name__)
+
+
+# A cache depends on the files matched by one glob pattern, or by any of a tuple of them (e.g. a graph and its log)
+Pattern = Union[str, Tuple[str, ...]]
+
+
+def _has_glob(path: str) -> bool:
+    return any(c in _GLOB_CHARS for c in path)
+
+
+def split_patterns(pattern: Pattern) -> Tuple[str, ...]:
+    return (pattern,) if isinstance(pattern, str) else tuple(pattern)
+
+
+def _absolute(pattern: Pattern) -> Tuple[str, ...]:
+    return tuple(os.path.abspath(p) for p in split_patterns(pattern))
+
+
+class CacheWatcher(abc.ABC):
+    """
+    Dispatches file system changes to the caches that depend on them. Caches subscribe with their glob pattern(s), and
+    are marked dirty by calling their ``invalidate()`` method. Patterns whose directory part is a plain path are
+    indexed by that directory, so a change only has to look at the caches for one directory. Patterns with a wildcard
+    in the directory part (e.g. the project list) are matched with fnmatch.
+    """
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._by_dir: Dict[str, Set] = {}
+        self._wildcard: Set = set()
+        # The absolute patterns of each subscribed cache. Events carry absolute paths, so a pattern with a relative or
+        # non-normalized directory (e.g. PROJECT_DIR=../projects) would never match them.
+        self._patterns: Dict[object, Tuple[str, ...]] = {}
+        # The process the watcher runs in, None until started (and again in a forked child)
+        self._pid: Optional[int] = None
+        self._running = False
+
+    def subscribe(self, cache) -> bool:
+        """
+        :return: False if changes to the cache's files can not be watched, the cache has to check them itself.
+        :rtype: bool
+        """
+        patterns = _absolute(cache.pattern)
+        with self._lock:
+            self._patterns[cache] = patterns
+            for directory in {os.path.dirname(p) for p in patterns}:
+                if _has_glob(directory):
+                    self._wildcard.add(cache)
+                else:
+                    self._by_dir.setdefault(directory, set()).add(cache)
+        return True
+
+    def unsubscribe(self, cache):
+        with self._lock:
+            patterns = self._patterns.pop(cache, ())
+            self._wildcard.discard(cache)
+            for directory in {os.path.dirname(p) for p in patterns}:
+                subscribers = self._by_dir.get(directory)
+                if subscribers is not None:
+                    subscribers.discard(cache)
+                    if not subscribers:
+                        del self._by_dir[directory]
+
+    def notify(self, path: str, is_dir: bool = False):
+        """
+        Mark every cache that depends on ``path`` as dirty. This is called for file system events, and also directly
+        by the writers in this process so that a request always sees its own writes.
+        :param path: The file or directory that changed.
+        :type path: str
+        :param is_dir: True if ``path`` is a directory that was created, removed or renamed.
+        :type is_dir: bool
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            targets = list(self._by_dir.get(os.path.dirname(path), ()))
+            if is_dir:
+                # Everything at or below the directory is affected, as is anything listing directories.
+                prefix = path + os.sep
+                for directory, subscribers in self._by_dir.items():
+                    if directory == path or directory.startswith(prefix):
+                        targets.extend(subscribers)
+                targets.extend(self._wildcard)
+            else:
+                # Other files in the same directory (e.g. snapshots) should not invalidate these caches.
+                targets = [c for c in targets if self._matches(c, path)]
+                targets.extend(c for c in self._wildcard if self._matches(c, path))
+        for cache in targets:
+            cache.invalidate()
+
+    def _matches(self, cache, path: str) -> bool:
+        return any(fnmatch(path, p) for p in self._patterns[cache])
+
+    def invalidate_all(self):
+        with self._lock:
+            targets = list(self._wildcard)
+            for subscribers in self._by_dir.values():
+                targets.extend(subscribers)
+        for cache in targets:
+            cache.invalidate()
+
+    def running(self) -> bool:
+        """
+        Start the watcher in this process if it is not running here yet. Caches call this before trusting their dirty
+        flag, so a forked worker starts its own thread on first use.
+        :return: False if the watcher could not be started, the caches have to check their files themselves.
+        :rtype: bool
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._running
+        with self._start_lock:
+            if self._pid != pid:
+                started = self._pid is not None
+                try:
+                    self.start()
+                    self._running = True
+                except Exception as e:
+                    log.error('Failed to start the cache watcher: %s', e)
+                    self._running = False
+                self._pid = pid
+                if started:
+                    # Changes between the fork and now were not seen by this process
+                    self.invalidate_all()
+        return self._running
+
+    def mark_started(self):
+        """
+        Record that start() was called in this process.
+        """
+        self._running = True
+        self._pid = os.getpid()
+
+    def after_fork(self):
+        """
+        Called in a forked child. The parent's thread does not exist here and its locks may have been held.
+        """
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._running = False
+
+    @abc.abstractmethod
+    def start(self):
+        """
+        Start watching in the current process.
+        """
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(CacheWatcher):
+    """
+    Fallback for platforms without inotify. A daemon thread periodically re-stats each subscribed pattern and
+    invalidates the caches whose files changed, so the cost is moved off the request path.
+    """
+    def __init__(self, root: str, interval: float = 1.0):
+        super(PollingWatcher, self).__init__(root)
+        self.interval = interval
+        self._signatures: Dict[object, tuple] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self, cache) -> bool:
+        self._signatures[cache] = cache.signature()
+        return super(PollingWatcher, self).subscribe(cache)
+
+    def unsubscribe(self, cache):
+        super(PollingWatcher, self).unsubscribe(cache)
+        self._signatures.pop(cache, None)
+
+    def poll(self):
+        for cache in list(self._signatures.keys()):
+            sig = cache.signature()
+            if self._signatures.get(cache, sig) != sig:
+                cache.invalidate()
+            if cache in self._signatures:
+                self._signatures[cache] = sig
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception as e:
+                log.warning('Cache poller failed: %s', e)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='cache-poller', daemon=True)
+        self._thread.start()
+
+
+class InotifyWatcher(CacheWatcher):
+    """
+    Watches the project directory and the directories of the subscribed caches with inotify. Directories are watched
+    while at least one cache depends on them, and watched again when they are re-created.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+        IN_DELETE_SELF | IN_MOVE_SELF
+
+    _event = struct.Struct('iIII')
+
+    def __init__(self, root: str):
+        super(InotifyWatcher, self).__init__(root)
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = -1
+        # wd -> directory, directory -> wd, and the number of subscribers per watched directory
+        self._paths: Dict[int, str] = {}
+        self._wds: Dict[str, int] = {}
+        self._refs: Dict[str, int] = {}
+        # The directories watched for each subscribed cache
+        self._dirs: Dict[object, List[str]] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def _add_watch(self, path: str):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_add_watch failed for '%s': %s" % (path, os.strerror(err)))
+        self._paths[wd] = path
+        self._wds[path] = wd
+
+    def _watched_dirs(self, directory: str) -> List[str]:
+        """
+        The directories to watch for a subscription: the directory itself, or every existing match of a wildcard.
+        """
+        if not _has_glob(directory):
+            return [directory]
+        return [d for d in glob(directory) if os.path.isdir(d)]
+
+    def subscribe(self, cache) -> bool:
+        directories = sorted({os.path.dirname(p) for p in _absolute(cache.pattern)})
+        with self._lock:
+            added = []
+            try:
+                for d in (d for directory in directories for d in self._watched_dirs(directory)):
+                    if d not in self._refs and d != self.root and self._fd >= 0:
+                        self._add_watch(d)
+                    self._refs[d] = self._refs.get(d, 0) + 1
+                    added.append(d)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    log.warning('Out of inotify watches (see fs.inotify.max_user_watches), %s is checked on every '
+                                'read instead', cache.pattern)
+                elif e.errno != errno.ENOENT:
+                    log.warning('%s, it is checked on every read instead', e)
+                self._release(added)
+                return False
+            self._dirs[cache] = added
+        super(InotifyWatcher, self).subscribe(cache)
+        return True
+
+    def unsubscribe(self, cache):
+        super(InotifyWatcher, self).unsubscribe(cache)
+        with self._lock:
+            self._release(self._dirs.pop(cache, []))
+
+    def _release(self, directories: List[str]):
+        for d in directories:
+            count = self._refs[d] - 1
+            if count:
+                self._refs[d] = count
+                continue
+            del self._refs[d]
+            wd = self._wds.pop(d, None)
+            if wd is not None and d != self.root and self._fd >= 0:
+                # The IN_IGNORED event that follows removes the wd from _paths
+                self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _rewatch(self, path: str):
+        """
+        A directory was created (or moved) at ``path``. Watch it and everything below it that caches depend on.
+        """
+        prefix = path + os.sep
+        with self._lock:
+            wanted = [d for d in self._refs if d == path or d.startswith(prefix)]
+            wanted.extend(d for d in self._wildcard_dirs() if fnmatch(path, d) and d not in self._refs)
+            for d in wanted:
+                self._add_watch(d)
+
+    def _wildcard_dirs(self) -> Set[str]:
+        directories = {os.path.dirname(p) for c in self._wildcard for p in self._patterns[c]}
+        return {d for d in directories if _has_glob(d)}
+
+    def _handle(self, wd: int, mask: int, name: str):
+        if mask & self.IN_Q_OVERFLOW:
+            self.invalidate_all()
+            return
+        if mask & self.IN_IGNORED:
+            path = self._paths.pop(wd, None)
+            if path is not None and self._wds.get(path) == wd:
+                del self._wds[path]
+            return
+        base = self._paths.get(wd)
+        if base is None:
+            return
+        path = os.path.join(base, name) if name else base
+        is_dir = bool(mask & self.IN_ISDIR) or not name
+        if is_dir and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+            try:
+                self._rewatch(path)
+            except OSError as e:
+                # The directory may already be gone again. Either way, fall back to a full invalidation.
+                log.warning('Failed to watch %s: %s', path, e)
+                self.invalidate_all()
+        self.notify(path, is_dir)
+
+    def _run(self, fd: int):
+        while True:
+            try:
+                buf = os.read(fd, 64 * 1024)
+            except OSError:
+                # Closed by close() or after a fork
+                return
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = self._event.unpack_from(buf, offset)
+                offset += self._event.size
+                name = buf[offset:offset + length].rstrip(b'\0').decode(errors='surrogateescape')
+                offset += length
+                self._handle(wd, mask, name)
+
+    def start(self):
+        fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._fd = fd
+        try:
+            with self._lock:
+                self._paths.clear()
+                self._wds.clear()
+                self._add_watch(self.root)
+                for d in list(self._refs):
+                    if d != self.root:
+                        try:
+                            self._add_watch(d)
+                        except OSError as e:
+                            log.warning('%s, invalidating on every change of %s instead', e, self.root)
+        except OSError:
+            self.close()
+            raise
+        self._thread = threading.Thread(target=self._run, args=(fd,), name='cache-inotify', daemon=True)
+        self._thread.start()
+
+    def after_fork(self):
+        super(InotifyWatcher, self).after_fork()
+        # The descriptor is shared with the parent, whose thread reads it. The child opens its own in start().
+        self.close()
+
+    def close(self):
+        if self._fd >= 0:
+            fd, self._fd = self._fd, -1
+            os.close(fd)
+
+
+_watcher: Optional[CacheWatcher] = None
+_watcher_ready = False
+
+
+def _build_watcher(root: str) -> Optional[CacheWatcher]:
+    mode = os.getenv('CACHE_INVALIDATION', MODE_STAT).lower()
+    interval = float(os.getenv('CACHE_POLL_INTERVAL', '1.0'))
+    if mode == MODE_STAT:
+        return None
+    if mode in (MODE_INOTIFY, MODE_AUTO):
+        watcher = None
+        try:
+            watcher = InotifyWatcher(root)
+            watcher.start()
+            watcher.mark_started()
+            return watcher
+        except (OSError, AttributeError) as e:
+            if watcher is not None:
+                watcher.close()
+            if mode == MODE_INOTIFY:
+                raise
+            log.warning('inotify is not available (%s), polling for cache invalidation instead', e)
+    elif mode != MODE_POLL:
+        raise Exception('Unknown CACHE_INVALIDATION mode: "%s"' % mode)
+    return PollingWatcher(root, interval)
+
+
+def get_watcher() -> Optional[CacheWatcher]:
+    """
+    Return the process wide watcher, creating it on first use. Returns None in 'stat' mode. Call running() on it before
+    relying on it.
+    :rtype: Optional[CacheWatcher]
+    """
+    global _watcher, _watcher_ready
+    if not _watcher_ready:
+        from .file_names import PROJ_DIR
+        _watcher = _build_watcher(PROJ_DIR)
+        _watcher_ready = True
+    return _watcher
+
+
+def _after_fork():
+    if _watcher is not None:
+        _watcher.after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+_listeners: List[Callable[[str, bool], None]] = []
+
+
+def add_change_listener(listener: Callable[[str, bool], None]):
+    """
+    Call ``listener(path, is_dir)`` for every change made by this process (e.g. to invalidate other caches).
+    """
+    _listeners.append(listener)
+
+
+def notify_changed(path: str, is_dir: bool = False):
+    """
+    Tell the watcher (if any) and the change listeners that this process changed ``path``.
+    """
+    if _watcher is not None:
+        _watcher.notify(path, is_dir)
+    for listener in _listeners:
+        listener(path, is_dir)
@@ -0,0 +1,225 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+from contextlib import ExitStack
+from typing import Callable, List, Optional, Tuple, Union
+
+from server_impl import metrics
+from server_impl.projects_fs.watcher import notify_changed
+
+log = logging.getLogger(__name__)
+
+# Every file in PROJECT_DIR is written to a temporary file in the same directory and renamed over the target, so a
+# reader (e.g. a cache reload in another worker) sees either the old or the new content, never a partial file.
+#
+# Writes made inside `with write_batch():` are group committed: all temporary files are written and synced, then
+# renamed in the order they were written (a file written twice takes the place of its last write), and each directory
+# involved is synced once at the end. Files that mark others as done (e.g. operation hashes) are written last, so a
+# crash part way through a commit never leaves them ahead of the files they describe.
+#
+#   WRITE_FSYNC=0     - Skip fsync (faster, but a crash may lose recent writes)
+#   WRITE_BEHIND=1    - Run non-critical writes (see write_behind) on a background thread
+
+fsync_enabled = os.getenv('WRITE_FSYNC', '1') != '0'
+
+Content = Union[str, bytes]
+
+_local = threading.local()
+
+
+def _tmp_name(filename: str) -> str:
+    return '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+
+
+def _write_tmp(filename: str, content: Content) -> str:
+    tmp = _tmp_name(filename)
+    try:
+        with open(tmp, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+            metrics.bytes_written.inc(f.tell())
+            if fsync_enabled:
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        _remove_tmp(tmp)
+        raise
+    return tmp
+
+
+def _remove_tmp(tmp: str):
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
+        pass
+
+
+def _fsync_dir(directory: str):
+    if not fsync_enabled:
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteBatch:
+    """
+    A group of file writes that are committed together. Use through write_batch().
+    """
+    def __init__(self):
+        self.files: List[Tuple[str, Content]] = []
+        self._held = ExitStack()
+        self._after_commit: List[Callable[[], None]] = []
+
+    def add(self, filename: str, content: Content):
+        self.files.append((filename, content))
+
+    def hold(self, context):
+        """
+        Enter ``context`` (e.g. a lock) now, and exit it once the batch is committed or abandoned.
+        :return: The result of entering it
+        """
+        return self._held.enter_context(context)
+
+    def after_commit(self, callback: Callable[[], None]):
+        """
+        Run ``callback`` after the files are renamed into place, while everything from hold() is still held.
+        """
+        self._after_commit.append(callback)
+
+    def close(self):
+        self._after_commit = []
+        self._held.close()
+
+    def commit(self):
+        # Later writes to the same file win, and move it to the position of that write
+        latest = {}
+        for filename, content in self.files:
+            latest.pop(filename, None)
+            latest[filename] = content
+        self.files = []
+        ordered = list(latest.items())
+        renames = []
+        done = 0
+        try:
+            for filename, content in ordered:
+                renames.append((_write_tmp(filename, content), filename))
+            for tmp, filename in renames:
+                os.replace(tmp, filename)
+                done += 1
+        except BaseException:
+            for tmp, _ in renames[done:]:
+                _remove_tmp(tmp)
+            for _, filename in renames[:done]:
+                notify_changed(filename)
+            raise
+        for directory in sorted({os.path.dirname(f) for f, _ in ordered}):
+            _fsync_dir(directory)
+        for filename, _ in ordered:
+            notify_changed(filename)
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+
+class write_batch:
+    """
+    Collect every write made by this thread (through save_yaml / write_file) into one group commit. Nested batches
+    join the outermost one. If the block raises, nothing is written.
+
+        with write_batch():
+            save_yaml(a, ...)
+            save_yaml(b, ...)
+    """
+    def __enter__(self) -> WriteBatch:
+        batch = getattr(_local, 'batch', None)
+        self.outer = batch is None
+        if self.outer:
+            batch = _local.batch = WriteBatch()
+        return batch
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.outer:
+            batch = _local.batch
+            _local.batch = None
+            try:
+                if exc_type is None:
+                    batch.commit()
+            finally:
+                batch.close()
+        return False
+
+
+def current_batch() -> Optional[WriteBatch]:
+    return getattr(_local, 'batch', None)
+
+
+def write_file(filename: str, content: Content):
+    """
+    Atomically replace ``filename``. Joins the current batch if there is one.
+    """
+    batch = current_batch()
+    if batch is not None:
+        batch.add(filename, content)
+        return
+    tmp = _write_tmp(filename, content)
+    try:
+        os.replace(tmp, filename)
+    except BaseException:
+        _remove_tmp(tmp)
+        raise
+    notify_changed(filename)
+
+
+class WriteBehindQueue:
+    """
+    Runs writes whose loss or delay is harmless (caches, snapshots) on a background thread, so they are off the request
+    path. Pending writes are flushed at exit.
+    """
+    def __init__(self, maxsize: int = 1024):
+        self._queue: 'queue.Queue[Callable[[], None]]' = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job()
+            except Exception as e:
+                log.warning('Write-behind job failed: %s', e)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, job: Callable[[], None]):
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            # Do not let a slow disk back up requests, just do it now
+            job()
+
+    def flush(self):
+        self._queue.join()
+
+
+_write_behind: Optional[WriteBehindQueue] = None
+_write_behind_lock = threading.Lock()
+
+
+def write_behind(job: Callable[[], None]):
+    """
+    Run a non-critical write. With WRITE_BEHIND=1 it is queued for a background thread, otherwise it runs immediately.
+    """
+    global _write_behind
+    if os.getenv('WRITE_BEHIND', '0') != '1':
+        job()
+        return
+    if _write_behind is None:
+        with _write_behind_lock:
+            if _write_behind is None:
+                _write_behind = WriteBehindQueue()
+    _write_behind.submit(job)
@@ -1 +1 @@
-from .validate import valid_or_raise
\ No newline at end of file
+from .validate import valid_or_raise, load_spec
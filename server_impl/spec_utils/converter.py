@@ -1,4 +1,11 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Generic, TypeVar, Dict, List, Mapping, Optional, Tuple, Callable, cast
+import logging
+import multiprocessing
+import os
+import threading
 
 from openapi_server.util import Path as ParsePath
 
@@ -10,6 +17,11 @@ from openapi_server.models import *
 
 T = TypeVar('T')
 
+log = logging.getLogger(__name__)
+
+# Bump this whenever the output of the conversion changes, so incremental uploads regenerate every module
+CONVERTER_VERSION = 1
+
 
 class RefPointer(Generic[T]):
     def __init__(self, data: Dict[str, T], rid: str, id_field: str, value: T = None):
@@ -99,7 +111,7 @@ def _attach_request_node(path: str, method: str, op: Operation, builder: GraphBu
         if seg == '':
             continue
         if seg.startswith('{'):
-            print("PARAM! %s" % seg)
+            log.debug('Path parameter: %s', seg)
         segments.append(UrlSegment(label=seg))
 
     req = RequestNode(request_node_id=node_ref.id, method=m, segments=segments)
@@ -163,12 +175,16 @@ def operation_to_module(path: str, op: Operation, graph: FlowGraph, mod_id: str)
                   tag=mod_id, status='OK')
 
 
-def convert(api: Spec) -> Tuple[Dict[str, Module], Dict[str,FlowGraph]]:
+def plan_operations(api: Spec) -> List[Tuple[str, str, str]]:
+    """
+    Decide which operations become modules, and their module ids.
+    :return: (path, method, mod_id) for each module, in spec order.
+    :rtype: List[Tuple[str, str, str]]
+    """
     path: str
     path_object: Path
     fixer = operation_id_fixer()
-    graphs = {}
-    modules = {}
+    plan = []
     for path, path_object in api.paths.items():
         if path.startswith('/dev'):
             continue
@@ -176,11 +192,139 @@ def convert(api: Spec) -> Tuple[Dict[str, Module], Dict[str,FlowGraph]]:
             method: str
             operation: Operation
             for method, operation in path_object.operations.items():
-                mod_id = fixer(operation.operation_id)
-                graph = operation_to_graph(path, method, operation)
-                graphs[mod_id] = graph
-
-                module = operation_to_module(path, operation, graph, mod_id)
-                modules[mod_id] = module
+                plan.append((path, method, fixer(operation.operation_id)))
                 break
+    return plan
+
+
+def convert_operation(api: Spec, path: str, method: str, mod_id: str) -> Tuple[Module, FlowGraph]:
+    operation: Operation = api.paths[path].operations[method]
+    graph = operation_to_graph(path, method, operation)
+    module = operation_to_module(path, operation, graph, mod_id)
+    return module, graph
+
+
+def convert(api: Spec) -> Tuple[Dict[str, Module], Dict[str,FlowGraph]]:
+    graphs = {}
+    modules = {}
+    for path, method, mod_id in plan_operations(api):
+        modules[mod_id], graphs[mod_id] = convert_operation(api, path, method, mod_id)
     return modules, graphs
+
+
+# Parallel encoding ####################################################################################################
+#
+# The conversion itself runs in this process, on the Spec that was already built: openapi_core's Spec objects can not
+# be sent to another process, and building one per worker costs far more than converting every operation. What is
+# fanned out is the serialization of the results. Flattened models are plain data, and encoding them (YAML for the file
+# system backend) is most of the time spent per operation.
+#
+# The pool is started once per process, with the forkserver start method (spawn where that is not available). Its
+# workers are never forked from a server process whose other threads (watcher, compaction, write-behind) may hold
+# locks.
+#
+#   CONVERT_WORKERS=0         - Encoding processes, 0 for the number of CPUs. 1 encodes in the request thread.
+#   CONVERT_PARALLEL_MIN=200  - Below this many operations, shipping the work to the pool costs more than it saves
+
+PARALLEL_MIN_OPERATIONS = int(os.getenv('CONVERT_PARALLEL_MIN', '200'))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_pid: Optional[int] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def default_workers() -> int:
+    return int(os.getenv('CONVERT_WORKERS', '0')) or os.cpu_count() or 1
+
+
+def _encode_pool(workers: int) -> ProcessPoolExecutor:
+    global _pool, _pool_pid, _pool_workers
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid() and _pool_workers == workers:
+            return _pool
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=False)
+        # A pool inherited through fork() belongs to the parent, it is just dropped
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        _pool_pid = os.getpid()
+        _pool_workers = workers
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def _encode_chunk(encode: Callable[[dict], object], chunk: List[Tuple[str, dict, dict]]) \
+        -> List[Tuple[str, object, object]]:
+    return [(mod_id, encode(module), encode(graph)) for mod_id, module, graph in chunk]
+
+
+def encode_parallel(flat: List[Tuple[str, dict, dict]], encode: Callable[[dict], object], workers: int = None) \
+        -> 'OrderedDict[str, Tuple[object, object]]':
+    """
+    Encode flattened modules and graphs, fanning the work out over the encoding pool for large batches.
+    :param flat: (mod_id, module.flatten(), graph.flatten()) for each module
+    :type flat: List[Tuple[str, dict, dict]]
+    :param encode: The serialization, e.g. StorageEngine.encode. Must be picklable (a module level function).
+    :type encode: (dict) -> object
+    :param workers: The number of processes. Defaults to CONVERT_WORKERS, or the number of CPUs.
+    :type workers: int
+    :return: mod_id -> (encoded module, encoded graph), in the order of ``flat``.
+    :rtype: OrderedDict[str, Tuple[object, object]]
+    """
+    if workers is None:
+        workers = default_workers()
+    results = OrderedDict()
+    if workers > 1 and len(flat) >= PARALLEL_MIN_OPERATIONS:
+        # A few chunks per worker keeps them busy without paying per-operation IPC
+        size = max(1, len(flat) // (workers * 4))
+        chunks = [flat[i:i + size] for i in range(0, len(flat), size)]
+        try:
+            for chunk in _encode_pool(workers).map(_encode_chunk, [encode] * len(chunks), chunks):
+                for mod_id, module, graph in chunk:
+                    results[mod_id] = (module, graph)
+            return results
+        except BrokenProcessPool as e:
+            log.warning('The encoding pool failed (%s), encoding in this process instead', e)
+            _reset_pool()
+            results.clear()
+    for mod_id, module, graph in _encode_chunk(encode, flat):
+        results[mod_id] = (module, graph)
+    return results
+
+
+def convert_parallel(api: Spec, encode: Callable[[dict], object] = None, plan: List[Tuple[str, str, str]] = None,
+                     workers: int = None) -> 'OrderedDict[str, Tuple[object, object]]':
+    """
+    Convert every operation, and encode the results in parallel (see encode_parallel).
+    :param api: The specification
+    :type api: Spec
+    :param encode: If given, return encode(model.flatten()) instead of the models.
+    :type encode: (dict) -> object
+    :param plan: Only convert these operations (e.g. the ones that changed). Defaults to plan_operations(api).
+    :type plan: List[Tuple[str, str, str]]
+    :param workers: The number of encoding processes. Defaults to CONVERT_WORKERS, or the number of CPUs.
+    :type workers: int
+    :return: mod_id -> (module, graph), in spec order.
+    :rtype: OrderedDict[str, Tuple[object, object]]
+    """
+    if plan is None:
+        plan = plan_operations(api)
+    if encode is None:
+        results = OrderedDict()
+        for path, method, mod_id in plan:
+            results[mod_id] = convert_operation(api, path, method, mod_id)
+        return results
+    flat = []
+    for path, method, mod_id in plan:
+        module, graph = convert_operation(api, path, method, mod_id)
+        flat.append((mod_id, module.flatten(), graph.flatten()))
+    return encode_parallel(flat, encode, workers)
@@ -0,0 +1,146 @@
+import hashlib
+import json
+from typing import Dict, List, Optional
+
+from server_impl.graph_utils import strongly_connected
+from server_impl.spec_utils.converter import CONVERTER_VERSION
+
+
+def _lookup(root: dict, ref: str):
+    node = root
+    for part in ref[2:].split('/'):
+        part = part.replace('~1', '/').replace('~0', '~')
+        node = node[part]
+    return node
+
+
+def _refs_in(node) -> List[str]:
+    """
+    The local references in ``node``, in the order resolve_refs meets them. The siblings of a $ref are not visited,
+    since resolve_refs replaces the whole object.
+    """
+    refs = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            ref = node.get('$ref')
+            if isinstance(ref, str) and ref.startswith('#/'):
+                refs.append(ref)
+                continue
+            stack.extend(reversed(list(node.values())))
+        elif isinstance(node, list):
+            stack.extend(reversed(node))
+    return refs
+
+
+class RefIndex:
+    """
+    A pre-pass over a specification for resolving its local $refs. The references between components are collected
+    once, and grouped into strongly connected components (cycles). A reference resolves to the same value wherever it
+    is used, as long as no other member of its cycle is being resolved already (only those can be cut off as
+    recursive). Those resolutions are done once and shared by every operation. The result of resolve_refs is the same
+    with or without an index.
+    """
+    def __init__(self, root: dict, graph: Dict[str, List[str]] = None):
+        """
+        :param root: The whole specification
+        :type root: dict
+        :param graph: The references in the target of each reference, as returned by to_dict(). Scanned from ``root``
+                      if not given.
+        :type graph: Dict[str, List[str]]
+        """
+        self.root = root
+        self.graph = graph if graph is not None else self._scan(root)
+        self.components, self.cyclic = strongly_connected(self.graph)
+        self.resolved: Dict[str, object] = {}
+
+    def context_free(self, ref: str, stack: List[str]) -> bool:
+        """
+        Whether ``ref`` resolves to the same value under any stack of references that are being resolved.
+        """
+        if ref not in self.cyclic:
+            return True
+        component = self.components.get(ref)
+        return not any(self.components.get(r) == component for r in stack)
+
+    @staticmethod
+    def _scan(root: dict) -> Dict[str, List[str]]:
+        graph = {}
+        pending = _refs_in(root)
+        while pending:
+            ref = pending.pop()
+            if ref in graph:
+                continue
+            try:
+                targets = _refs_in(_lookup(root, ref))
+            except (KeyError, TypeError):
+                targets = []
+            graph[ref] = sorted(set(targets))
+            pending.extend(targets)
+        return graph
+
+    def to_dict(self) -> dict:
+        return {'refs': self.graph, 'cyclic': sorted(self.cyclic)}
+
+
+def resolve_refs(node, root: dict, stack: Optional[List[str]] = None, index: RefIndex = None):
+    """
+    Return a copy of ``node`` with every local $ref replaced by its target. A reference back into a component that is
+    already being resolved is left as a $ref, so recursive schemas terminate.
+    :param node: Part of the specification
+    :param root: The whole specification
+    :type root: dict
+    :param index: The RefIndex of ``root``. Resolved components are then shared, and must not be modified.
+    :type index: RefIndex
+    """
+    if stack is None:
+        stack = []
+    if isinstance(node, dict):
+        ref = node.get('$ref')
+        if isinstance(ref, str) and ref.startswith('#/'):
+            if ref in stack:
+                return {'$ref': ref}
+            shared = index is not None and index.context_free(ref, stack)
+            if shared and ref in index.resolved:
+                return index.resolved[ref]
+            stack.append(ref)
+            try:
+                ret = resolve_refs(_lookup(root, ref), root, stack, index)
+            except (KeyError, TypeError):
+                ret = {'$ref': ref}
+            finally:
+                stack.pop()
+            if shared:
+                index.resolved[ref] = ret
+            return ret
+        return {k: resolve_refs(v, root, stack, index) for k, v in node.items()}
+    if isinstance(node, list):
+        return [resolve_refs(x, root, stack, index) for x in node]
+    return node
+
+
+def canonical_hash(data) -> str:
+    encoded = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def operation_hash(content: dict, path: str, method: str, mod_id: str, index: RefIndex = None) -> str:
+    """
+    Hash everything that the conversion of one operation depends on: the operation with its references resolved, the
+    parameters shared by its path, its position (path, method, module id) and the converter version.
+    :param content: The raw specification
+    :type content: dict
+    :param index: A RefIndex of ``content``, shared by the operations of one upload.
+    :type index: RefIndex
+    :rtype: str
+    """
+    path_item = content['paths'][path]
+    return canonical_hash({
+        'version': CONVERTER_VERSION,
+        'path': path,
+        'method': method,
+        'mod_id': mod_id,
+        'operation': resolve_refs(path_item[method], content, index=index),
+        'parameters': resolve_refs(path_item.get('parameters', []), content, index=index),
+    })
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import logging
+import os
+from typing import IO, Tuple
+
+import yaml
+
+from server_impl.errors import EBadRequest
+
+log = logging.getLogger(__name__)
+
+# Uploaded specifications are read in chunks, hashed while they are read, and parsed with the fastest parser for their
+# format: the json module for .json files, and libyaml (when PyYAML was built with it) for YAML. The hash of the raw
+# bytes lets valid_or_raise skip canonical hashing for a byte-identical re-upload.
+#
+# Limits, checked before the expensive stages run:
+#   SPEC_MAX_BYTES=67108864   - Larger uploads are rejected as soon as the limit is passed while reading
+#   SPEC_MAX_DEPTH=128        - The deepest nesting of objects and lists
+#   SPEC_MAX_NODES=10000000   - Objects and lists in the document, counting each use of a YAML alias again (so alias
+#                               bombs are rejected before anything walks them)
+
+max_bytes = int(os.getenv('SPEC_MAX_BYTES', str(64 << 20)))
+max_depth = int(os.getenv('SPEC_MAX_DEPTH', '128'))
+max_nodes = int(os.getenv('SPEC_MAX_NODES', '10000000'))
+
+CHUNK_SIZE = 1 << 20
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+FORMATS = {
+    '.json': 'json',
+    '.yaml': 'yaml',
+    '.yml': 'yaml',
+}
+
+
+def spec_format(filename: str) -> str:
+    """
+    :return: 'json' or 'yaml', from the extension of an uploaded file.
+    :rtype: str
+    """
+    fmt = FORMATS.get(os.path.splitext(filename or '')[1].lower())
+    if fmt is None:
+        raise EBadRequest('File must have a .json, .yaml, or .yml extension')
+    return fmt
+
+
+def read_limited(stream: IO[bytes]) -> Tuple[bytes, str]:
+    """
+    Read an upload, stopping as soon as it is larger than SPEC_MAX_BYTES.
+    :return: (The content, the sha256 of the content)
+    :rtype: Tuple[bytes, str]
+    """
+    digest = hashlib.sha256()
+    chunks = []
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise EBadRequest('API file is larger than %d bytes' % max_bytes)
+        digest.update(chunk)
+        chunks.append(chunk)
+    return b''.join(chunks), digest.hexdigest()
+
+
+def check_shape(content):
+    """
+    Enforce SPEC_MAX_DEPTH and SPEC_MAX_NODES on a parsed document. The walk is iterative, so a deep document can not
+    exhaust the stack.
+    """
+    nodes = 0
+    stack = [(content, 1)]
+    while stack:
+        node, depth = stack.pop()
+        nodes += 1
+        if nodes > max_nodes:
+            raise EBadRequest('API file has more than %d objects and lists' % max_nodes)
+        if depth > max_depth:
+            raise EBadRequest('API file is nested deeper than %d levels' % max_depth)
+        children = node.values() if isinstance(node, dict) else node
+        for child in children:
+            if isinstance(child, (dict, list)):
+                stack.append((child, depth + 1))
+
+
+def parse_spec(stream: IO[bytes], filename: str) -> Tuple[object, str]:
+    """
+    Read and parse an uploaded specification.
+    :param stream: The upload, positioned at the start.
+    :param filename: The name of the upload, which decides the format.
+    :type filename: str
+    :return: (The parsed content, the sha256 of the raw bytes)
+    :rtype: Tuple[object, str]
+    """
+    fmt = spec_format(filename)
+    data, digest = read_limited(stream)
+    try:
+        if fmt == 'json':
+            content = json.loads(data)
+        else:
+            content = yaml.load(data, Loader=YamlLoader)
+    except RecursionError:
+        raise EBadRequest('API file is nested deeper than %d levels' % max_depth)
+    except Exception as e:
+        log.info('Failed to parse %s as %s: %s', filename, fmt.upper(), e)
+        if fmt == 'json':
+            raise EBadRequest("Failed to parse file. The file must be valid JSON")
+        raise EBadRequest("Failed to parse file. The file must be valid YAML or JSON")
+    if isinstance(content, (dict, list)):
+        check_shape(content)
+    return content, digest
@@ -1,31 +1,158 @@
+from collections import OrderedDict
 from jsonschema import ValidationError
+import hashlib
+import logging
+import os
 import re
+import threading
 
+from openapi_core import create_spec
+from openapi_core.schema.specs.models import Spec
 from openapi_spec_validator import validate_spec
 
 from server_impl.errors import EBadRequest
+from server_impl.spec_utils.hashing import canonical_hash
+from server_impl.spec_utils.validation_cache import get_validation_cache
 
 pattern_v3_major = re.compile(r'^3\.\d+\.\d+$')
 
+log = logging.getLogger(__name__)
 
-def valid_or_raise(content):
+_http_methods = ('get', 'put', 'post', 'delete', 'options', 'head', 'patch', 'trace')
+
+
+def _validator_version() -> str:
+    try:
+        from importlib.metadata import version
+        return version('openapi-spec-validator')
+    except Exception:
+        return 'unknown'
+
+
+# Part of every content hash, so results of an older validator are not reused after an upgrade
+VALIDATOR_VERSION = _validator_version()
+
+
+def precheck(content):
     """
-    Validate that a dictionary is a valid OpenAPI specification file.
+    Cheap structural checks that reject obviously broken documents before the full validator runs.
     :param content: The content of the API specification, parsed into a dictionary
-    :type content: dict
     :return: Throws an exception that causes an 4XX return code if the spec is invalid.
     :rtype: None
     """
-    if 'openapi' in content:
-        openapi_version: str = content['openapi']
-        if pattern_v3_major.match(openapi_version):
-            print('VALID OPENAPI VERSION: %s' % openapi_version)
-            try:
-                validate_spec(content)
-            except ValidationError as e:
-                print(' --> Validation failed')
-                print(e)
-                raise EBadRequest('API file is not valid.')
-        else:
-            print('Received unsupported OpenAPI version: %s' % openapi_version)
-            raise EBadRequest("Unsupported OpenAPI version")
+    if not isinstance(content, dict):
+        raise EBadRequest('API file is not valid: the document must be an object')
+    openapi_version = content.get('openapi')
+    if openapi_version is None:
+        raise EBadRequest("API file is not valid: 'openapi' is missing")
+    if not isinstance(openapi_version, str) or not pattern_v3_major.match(openapi_version):
+        log.info('Received unsupported OpenAPI version: %s', openapi_version)
+        raise EBadRequest("Unsupported OpenAPI version")
+    info = content.get('info')
+    if not isinstance(info, dict) or 'title' not in info or 'version' not in info:
+        raise EBadRequest("API file is not valid: 'info' must have a title and a version")
+    paths = content.get('paths')
+    if not isinstance(paths, dict):
+        raise EBadRequest("API file is not valid: 'paths' must be an object")
+    for path, path_item in paths.items():
+        if not isinstance(path, str) or not path.startswith('/'):
+            raise EBadRequest("API file is not valid: path '%s' must start with '/'" % path)
+        if not isinstance(path_item, dict):
+            raise EBadRequest("API file is not valid: path '%s' must be an object" % path)
+        for method in _http_methods:
+            operation = path_item.get(method)
+            if operation is not None and not (isinstance(operation, dict) and
+                                              isinstance(operation.get('responses'), dict)):
+                raise EBadRequest("API file is not valid: %s %s must be an object with responses" %
+                                  (method.upper(), path))
+
+
+def valid_or_raise(content, raw_digest: str = None) -> str:
+    """
+    Validate that a dictionary is a valid OpenAPI specification file. The result is remembered by the hash of the
+    content (see validation_cache), so an identical document is only validated once.
+    :param content: The content of the API specification, parsed into a dictionary
+    :type content: dict
+    :param raw_digest: The hash of the file that ``content`` was parsed from (see parse.parse_spec). A byte-identical
+                       upload is then recognized without hashing the parsed content.
+    :type raw_digest: str
+    :return: A hash that identifies the content. Throws an exception that causes an 4XX return code if the spec is
+             invalid.
+    :rtype: str
+    """
+    precheck(content)
+    log.debug('Valid OpenAPI version: %s', content['openapi'])
+    cache = get_validation_cache()
+    digests = []
+    known, error = False, None
+    if raw_digest is not None:
+        digests.append(hashlib.sha256(('%s:%s' % (VALIDATOR_VERSION, raw_digest)).encode()).hexdigest())
+        if cache is not None:
+            known, error = cache.get(digests[0])
+    if not known and (cache is not None or not digests):
+        # The same document, formatted differently
+        digests.append(canonical_hash({'validator': VALIDATOR_VERSION, 'spec': content}))
+        if cache is not None:
+            known, error = cache.get(digests[-1])
+            if known and len(digests) > 1:
+                cache.put(digests[0], error)
+    if known:
+        if error is not None:
+            log.info('Validation failed (cached): %s', error)
+            raise EBadRequest('API file is not valid.')
+        return digests[0]
+    try:
+        validate_spec(content)
+    except ValidationError as e:
+        log.info('Validation failed: %s', e)
+        if cache is not None:
+            for digest in digests:
+                cache.put(digest, e.message)
+        raise EBadRequest('API file is not valid.')
+    if cache is not None:
+        for digest in digests:
+            cache.put(digest, None)
+    return digests[0]
+
+
+# Specs built by create_spec, by content hash. They can not be stored on disk (see converter), so only a few are kept
+# in memory, for clients that upload the same document repeatedly.
+#
+#   SPEC_CACHE_SIZE=4
+_spec_cache_size = int(os.getenv('SPEC_CACHE_SIZE', '4'))
+_specs: 'OrderedDict[str, Spec]' = OrderedDict()
+_specs_lock = threading.Lock()
+
+
+def load_spec(content: dict, digest: str) -> Spec:
+    """
+    create_spec(content), reusing the result for a document with the same hash.
+    :param content: The validated specification
+    :type content: dict
+    :param digest: The hash returned by valid_or_raise
+    :type digest: str
+    :rtype: Spec
+    """
+    with _specs_lock:
+        spec = _specs.get(digest)
+        if spec is not None:
+            _specs.move_to_end(digest)
+            return spec
+    spec = create_spec(content)
+    if _spec_cache_size > 0:
+        with _specs_lock:
+            _specs[digest] = spec
+            while len(_specs) > _spec_cache_size:
+                _specs.popitem(last=False)
+    return spec
+
+
+def clear_caches():
+    """
+    Forget remembered validation results and specs, e.g. to measure cold uploads.
+    """
+    cache = get_validation_cache()
+    if cache is not None:
+        cache.clear()
+    with _specs_lock:
+        _specs.clear()
@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# The outcome of validating a specification, keyed by the canonical hash of its content (and the validator version),
+# so a re-upload of the same document does not run the validator again. Results are kept in a journal of JSON records
+# that is replayed on first use, so they survive restarts:
+#
+#   {"hash": "...", "error": null}        - The document is valid
+#   {"hash": "...", "error": "..."}       - The document is invalid, and why
+#
+# Only the newest SPEC_VALIDATION_CACHE_SIZE results are kept. Once the journal holds twice that many records, it is
+# rewritten with the live ones. The journal is a pure cache: deleting it is always safe.
+#
+#   SPEC_VALIDATION_CACHE=1                   - Set to 0 to validate every upload
+#   SPEC_VALIDATION_CACHE_SIZE=1024
+#   SPEC_VALIDATION_CACHE_FILE=<PROJECT_DIR>/.spec-validation.jsonl
+
+enabled = os.getenv('SPEC_VALIDATION_CACHE', '1') != '0'
+
+
+class ValidationCache:
+    def __init__(self, filename: Optional[str], size: int = 1024):
+        """
+        :param filename: The journal, or None to keep the results in memory only.
+        :type filename: Optional[str]
+        :param size: The number of results to keep.
+        :type size: int
+        """
+        self.filename = filename
+        self.size = size
+        self._results: 'OrderedDict[str, Optional[str]]' = OrderedDict()
+        self._records = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self._loaded = True
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self._results[record['hash']] = record['error']
+                    except (ValueError, KeyError, TypeError):
+                        # A torn or foreign line, the rest is still usable
+                        continue
+                    self._results.move_to_end(record['hash'])
+                    self._records += 1
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            log.warning('Can not read %s: %s', self.filename, e)
+        while len(self._results) > self.size:
+            self._results.popitem(last=False)
+
+    def get(self, digest: str) -> Tuple[bool, Optional[str]]:
+        """
+        :return: (whether a result is known, the error or None if the document is valid)
+        :rtype: Tuple[bool, Optional[str]]
+        """
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if digest not in self._results:
+                return False, None
+            self._results.move_to_end(digest)
+            return True, self._results[digest]
+
+    def put(self, digest: str, error: Optional[str]):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._results[digest] = error
+            self._results.move_to_end(digest)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+            if self.filename is None:
+                return
+            try:
+                if self._records + 1 > 2 * self.size:
+                    self._rewrite()
+                else:
+                    with open(self.filename, 'a') as f:
+                        f.write(json.dumps({'hash': digest, 'error': error}) + '\n')
+                    self._records += 1
+            except OSError as e:
+                log.warning('Can not write %s: %s', self.filename, e)
+
+    def _rewrite(self):
+        tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp, 'w') as f:
+            for digest, error in self._results.items():
+                f.write(json.dumps({'hash': digest, 'error': error}) + '\n')
+        os.replace(tmp, self.filename)
+        self._records = len(self._results)
+
+    def clear(self):
+        """
+        Forget the results in memory (e.g. to measure cold validation). The journal is kept, but not read again.
+        """
+        with self._lock:
+            self._results.clear()
+            self._loaded = True
+
+
+_cache: Optional[ValidationCache] = None
+
+
+def get_validation_cache() -> Optional[ValidationCache]:
+    """
+    :return: The validation cache, or None if it is disabled.
+    :rtype: Optional[ValidationCache]
+    """
+    global _cache
+    if not enabled:
+        return None
+    if _cache is None:
+        filename = os.getenv('SPEC_VALIDATION_CACHE_FILE')
+        if filename is None and os.getenv('PROJECT_DIR'):
+            filename = os.path.join(os.getenv('PROJECT_DIR'), '.spec-validation.jsonl')
+        _cache = ValidationCache(filename or None, int(os.getenv('SPEC_VALIDATION_CACHE_SIZE', '1024')))
+    return _cache
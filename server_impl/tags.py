@@ -1,9 +1,12 @@
 import re
+from typing import Callable, List
 
 urlSafe = re.compile('^[a-zA-Z0-9_-]*$')
 
 normalizePattern = re.compile(r'[\W_]+')
 
+trailingNumber = re.compile(r'(.*?)(\d+)')
+
 
 def is_valid_tag(tag: str):
     m = urlSafe.fullmatch(tag)
@@ -11,10 +14,10 @@ def is_valid_tag(tag: str):
 
 
 class TagBuilder:
-    def __init__(self, base: str):
+    def __init__(self, base: str, start: int = 0):
         self.tags = []
         self.base = base
-        self.counter = 0
+        self.counter = start
 
     def useGeneratedTag(self):
         tag = self.base + str(self.counter)
@@ -30,3 +33,25 @@ class TagBuilder:
             self.tags.append(normed)
             return normed
         return self.useGeneratedTag()
+
+
+def suggest_tags(base: str, is_taken: Callable[[str], bool], count: int = 3) -> List[str]:
+    """
+    Find free tags close to one that is taken, by adding a numeric suffix (base1, base2, ...).
+    :param base: The tag that was asked for.
+    :type base: str
+    :param is_taken: Checks if a tag is in use.
+    :type is_taken: (str) -> bool
+    :param count: The number of suggestions.
+    :type count: int
+    :rtype: List[str]
+    """
+    # Continue an existing numbered series rather than suggesting 'tag2' for 'tag1'
+    m = trailingNumber.fullmatch(base)
+    builder = TagBuilder(m.group(1), int(m.group(2)) + 1) if m else TagBuilder(base, 1)
+    ret = []
+    while len(ret) < count:
+        tag = builder.useGeneratedTag()
+        if not is_taken(tag):
+            ret.append(tag)
+    return ret
@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# PROJECT_DIR is read when server_impl.projects_fs is imported, so it is set up before any test module is collected. It
+# is deliberately not normalized (like the launch_server.py default of <cwd>/../projects), so every test also checks
+# that paths built from it are handled.
+_base = tempfile.mkdtemp(prefix='dp-tests-')
+os.makedirs(os.path.join(_base, 'work'))
+os.makedirs(os.path.join(_base, 'projects'))
+os.environ['PROJECT_DIR'] = os.path.join(_base, 'work', '..', 'projects')
@@ -0,0 +1,37 @@
+import os
+from glob import glob
+
+from server_impl.projects_fs.caches import GlobCache, fingerprint
+from server_impl.projects_fs.file_names import PROJ_DIR
+
+
+def _names(pattern: str):
+    return sorted(os.path.basename(f) for f in glob(pattern))
+
+
+def test_deleted_file_reloads_data_and_changes_etag():
+    directory = os.path.join(PROJ_DIR, 'deleted', 'modules')
+    os.makedirs(directory)
+    for name in ('a-modules.yaml', 'b-modules.yaml'):
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write('{}\n')
+    pattern = os.path.join(directory, '*-modules.yaml')
+    cache = GlobCache(pattern, _names, [pattern])
+    assert cache.data == ['a-modules.yaml', 'b-modules.yaml']
+    etag, _ = cache.validator()
+
+    # Deleting the older file leaves the newest mtime as it was
+    os.remove(os.path.join(directory, 'a-modules.yaml'))
+    assert cache.data == ['b-modules.yaml']
+    assert cache.validator()[0] != etag
+
+
+def test_graph_fingerprint_ignores_other_modules():
+    from server_impl.projects_fs.fs_internals import Patterns
+
+    os.makedirs(os.path.join(PROJ_DIR, 'graphs', 'modules'))
+    for mod in ('get', 'get-graph-x'):
+        for filename in (Patterns.project_graph_file('graphs', mod), Patterns.project_graph_log('graphs', mod)):
+            with open(filename, 'w') as f:
+                f.write('{}\n')
+    assert fingerprint(Patterns.project_graph_files('graphs', 'get'))[0] == 2
@@ -0,0 +1,120 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from server_impl.db import ConnectionPool, Database, PoolTimeout
+
+
+class CountingCursor(sqlite3.Cursor):
+    fetches = 0
+
+    def fetchmany(self, *args, **kwargs):
+        CountingCursor.fetches += 1
+        return super(CountingCursor, self).fetchmany(*args, **kwargs)
+
+
+class CountingConnection(sqlite3.Connection):
+    def cursor(self, *args, **kwargs):
+        return super(CountingConnection, self).cursor(CountingCursor)
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    filename = str(tmp_path / 'db.sqlite')
+    con = sqlite3.connect(filename)
+    con.execute('CREATE TABLE project (tag TEXT PRIMARY KEY, name TEXT, last_modified TEXT, description TEXT, '
+                'api_spec_url TEXT)')
+    con.executemany('INSERT INTO project VALUES (?, ?, ?, ?, ?)',
+                    [('p%d' % i, 'Project %d' % i, '2020-01-01', '', '') for i in range(5)])
+    con.commit()
+    con.close()
+    return filename
+
+
+def make_pool(filename: str, **kwargs) -> ConnectionPool:
+    return ConnectionPool(lambda: sqlite3.connect(filename, check_same_thread=False, factory=CountingConnection),
+                          paramstyle='qmark', **kwargs)
+
+
+def test_statement_translation(db_file):
+    pool = make_pool(db_file)
+    sql = 'SELECT 1 FROM project WHERE tag = %s AND name = %s'
+    translated = pool.statement(sql)
+    assert translated == 'SELECT 1 FROM project WHERE tag = ? AND name = ?'
+    # The same text every time, so the driver's statement cache is hit
+    assert pool.statement(sql) is translated
+    assert ConnectionPool(lambda: None).statement(sql) == sql
+
+
+def test_exhausted_pool_times_out(db_file):
+    pool = make_pool(db_file, max_size=1, timeout=0.05)
+    con = pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    assert pool.statistics()['waits'] == 1
+    pool.release(con)
+    assert pool.acquire() is con
+
+
+def test_waiting_acquire_gets_released_connection(db_file):
+    pool = make_pool(db_file, max_size=1, timeout=5)
+    con = pool.acquire()
+    threading.Timer(0.05, pool.release, (con,)).start()
+    assert pool.acquire() is con
+    assert pool.statistics()['open'] == 1
+
+
+def test_broken_connection_is_dropped(db_file):
+    pool = make_pool(db_file, max_size=1)
+    with pytest.raises(sqlite3.ProgrammingError):
+        with pool.connection() as con:
+            con.close()
+            con.execute('SELECT 1')
+    stats = pool.statistics()
+    assert (stats['open'], stats['idle'], stats['discarded']) == (0, 0, 1)
+    # The slot is free again
+    with pool.connection() as con:
+        assert con.execute('SELECT 1').fetchone() == (1,)
+
+
+def test_failed_query_keeps_healthy_connection(db_file):
+    pool = make_pool(db_file, max_size=1)
+    with pytest.raises(sqlite3.OperationalError):
+        with pool.connection() as con:
+            con.execute('SELECT * FROM missing')
+    stats = pool.statistics()
+    assert (stats['open'], stats['idle'], stats['discarded']) == (1, 1, 0)
+
+
+def test_idle_connection_is_checked(db_file):
+    pool = make_pool(db_file, max_size=1, check_after=0)
+    con = pool.acquire()
+    pool.release(con)
+    con.close()
+    time.sleep(0.01)
+    fresh = pool.acquire()
+    assert fresh is not con
+    assert pool.statistics()['discarded'] == 1
+
+
+def test_rows_are_fetched_in_batches(db_file):
+    db = Database(make_pool(db_file))
+    db.FETCH_BATCH = 2
+    CountingCursor.fetches = 0
+    rows = list(db._rows('SELECT tag FROM project WHERE tag != %s ORDER BY tag', ('p4',)))
+    assert rows == [('p0',), ('p1',), ('p2',), ('p3',)]
+    # Two full batches, then an empty one
+    assert CountingCursor.fetches == 3
+    assert db.pool.statistics()['idle'] == 1
+
+
+def test_tag_available(db_file):
+    db = Database(make_pool(db_file))
+    assert db.tagAvailable('p1') is False
+    assert db.tagAvailable('free') is True
+
+
+def test_missing_project_details(db_file):
+    assert Database(make_pool(db_file)).hProjectDetails('free') == ('Not Found', 404)
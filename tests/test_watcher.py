@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+
+import pytest
+
+from server_impl.projects_fs.file_names import PROJ_DIR
+from server_impl.projects_fs.watcher import InotifyWatcher, PollingWatcher
+
+
+class FakeCache:
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.invalidations = 0
+
+    def invalidate(self):
+        self.invalidations += 1
+
+    def signature(self):
+        return ()
+
+
+def _module_dir(tag: str) -> str:
+    directory = os.path.join(PROJ_DIR, tag, 'modules')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def test_project_dir_is_not_normalized():
+    assert os.path.normpath(PROJ_DIR) != PROJ_DIR
+
+
+def test_notify_matches_non_normalized_patterns():
+    directory = _module_dir('notify')
+    watcher = PollingWatcher(PROJ_DIR)
+    graph = FakeCache(os.path.join(directory, 'm-graph*.yaml'))
+    projects = FakeCache(os.path.join(PROJ_DIR, '*', 'brief.yaml'))
+    assert watcher.subscribe(graph)
+    assert watcher.subscribe(projects)
+
+    watcher.notify(os.path.join(directory, 'm-graph.yaml'))
+    assert graph.invalidations == 1
+    watcher.notify(os.path.join(directory, 'm-modules.yaml'))
+    assert graph.invalidations == 1
+    watcher.notify(os.path.join(PROJ_DIR, 'notify', 'brief.yaml'))
+    assert projects.invalidations == 1
+
+    watcher.unsubscribe(graph)
+    watcher.notify(os.path.join(directory, 'm-graph.yaml'))
+    assert graph.invalidations == 1
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is only available on Linux')
+def test_inotify_invalidates_with_non_normalized_root():
+    directory = _module_dir('inotify')
+    watcher = InotifyWatcher(PROJ_DIR)
+    watcher.start()
+    try:
+        cache = FakeCache(os.path.join(directory, 'm-graph*.yaml'))
+        assert watcher.subscribe(cache)
+        with open(os.path.join(directory, 'm-graph.yaml'), 'w') as f:
+            f.write('{}\n')
+        deadline = time.monotonic() + 5
+        while cache.invalidations == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert cache.invalidations > 0
+    finally:
+        watcher.close()
+
+
+def test_graph_files_do_not_match_other_modules():
+    from server_impl.projects_fs.fs_internals import Patterns
+
+    watcher = PollingWatcher(PROJ_DIR)
+    graph = FakeCache(Patterns.project_graph_files('graphs', 'get'))
+    assert watcher.subscribe(graph)
+
+    watcher.notify(Patterns.project_graph_file('graphs', 'get-graph-x'))
+    watcher.notify(Patterns.project_graph_log('graphs', 'get-graph.x'))
+    assert graph.invalidations == 0
+    watcher.notify(Patterns.project_graph_file('graphs', 'get'))
+    watcher.notify(Patterns.project_graph_log('graphs', 'get'))
+    assert graph.invalidations == 2